@@ -22,6 +22,9 @@ BOARD_NAME = 'am5728'
 # Supported modes
 MODE_SD = 'sd'
 MODE_SD_IMG = 'sd-img'
+MODE_SD_FLASH = 'sd-flash'
+MODE_SD_DUPLICATE = 'sd-duplicate'
+MODE_SD_STATION = 'sd-station'
 
 # Supported components
 COMP_IPL = 'ipl'
@@ -31,7 +34,8 @@ COMP_FS = 'fs'
 
 class Am5728(Board):
     
-    MODES = [MODE_SD, MODE_SD_IMG]
+    MODES = [MODE_SD, MODE_SD_IMG, MODE_SD_FLASH, MODE_SD_DUPLICATE,
+             MODE_SD_STATION]
     COMPONENTS = [COMP_BOOTLOADER, COMP_KERNEL, COMP_FS, COMP_IPL]
     
     mach_description = "AM5728 EVM"
@@ -86,15 +90,27 @@ class Am5728(Board):
 
         parser_sd = subparsers.add_parser(MODE_SD)
         parser_sd_img = subparsers.add_parser(MODE_SD_IMG)
+        parser_sd_flash = subparsers.add_parser(MODE_SD_FLASH)
+        parser_sd_duplicate = subparsers.add_parser(MODE_SD_DUPLICATE)
+        parser_sd_station = subparsers.add_parser(MODE_SD_STATION)
 
         self._parser.add_args_sd(parser_sd)
         self._parser.add_args_sd_img(parser_sd_img)
+        self._parser.add_args_sd_flash(parser_sd_flash)
+        self._parser.add_args_sd_duplicate(parser_sd_duplicate)
+        self._parser.add_args_sd_station(parser_sd_station)
 
     def check_args(self, args):
         if args.mode == MODE_SD:
             self._parser.check_args_sd(args)
         elif args.mode == MODE_SD_IMG:
             self._parser.check_args_sd_img(args)
+        elif args.mode == MODE_SD_FLASH:
+            self._parser.check_args_sd_flash(args)
+        elif args.mode == MODE_SD_DUPLICATE:
+            self._parser.check_args_sd_duplicate(args)
+        elif args.mode == MODE_SD_STATION:
+            self._parser.check_args_sd_station(args)
 
     def sd_init_comp_installer(self, args):
         self._comp_installer = Am5728SdCompInstaller()
@@ -111,6 +127,8 @@ class Am5728(Board):
             self._comp_installer.kernel_devicetree = args.kernel_devicetree
         if hasattr(args, 'rootfs'): # sd-script mode doesn't need this
             self._comp_installer.rootfs = args.rootfs
+        if hasattr(args, 'incremental'): # only sd mode
+            self._comp_installer.incremental = args.incremental
         self._comp_installer.workdir = args.workdir
 
     def sd_install_components(self, sd):
@@ -23,6 +23,9 @@ BOARD_NAME = 'dm36x-leopard'
 # Supported modes
 MODE_SD = 'sd'
 MODE_SD_IMG = 'sd-img'
+MODE_SD_FLASH = 'sd-flash'
+MODE_SD_DUPLICATE = 'sd-duplicate'
+MODE_SD_STATION = 'sd-station'
 MODE_SD_SCRIPT = 'sd-script'
 MODE_SD_SCRIPT_IMG = 'sd-script-img'
 MODE_NAND = 'nand'
@@ -42,7 +45,8 @@ COMP_FS = 'fs'
 class Dm36xLeopard(Board):
     
     MODES = [MODE_SD, MODE_SD_IMG, MODE_SD_SCRIPT, MODE_SD_SCRIPT_IMG,
-             MODE_NAND, MODE_RAM, MODE_ENV, MODE_USB_SCRIPT]
+             MODE_NAND, MODE_RAM, MODE_ENV, MODE_USB_SCRIPT, MODE_SD_FLASH,
+             MODE_SD_DUPLICATE, MODE_SD_STATION]
     COMPONENTS = [COMP_IPL, COMP_BOOTLOADER, COMP_KERNEL, COMP_FS]
     
     mach_description = "Leopard Board DM36x"
@@ -116,6 +120,9 @@ class Dm36xLeopard(Board):
 
         parser_sd = subparsers.add_parser(MODE_SD)
         parser_sd_img = subparsers.add_parser(MODE_SD_IMG)
+        parser_sd_flash = subparsers.add_parser(MODE_SD_FLASH)
+        parser_sd_duplicate = subparsers.add_parser(MODE_SD_DUPLICATE)
+        parser_sd_station = subparsers.add_parser(MODE_SD_STATION)
         parser_sd_script = subparsers.add_parser(MODE_SD_SCRIPT)
         parser_sd_script_img = subparsers.add_parser(MODE_SD_SCRIPT_IMG)
         parser_ram = subparsers.add_parser(MODE_RAM)
@@ -132,6 +139,9 @@ class Dm36xLeopard(Board):
         
         self._parser.add_args_sd(parser_sd)
         self._parser.add_args_sd_img(parser_sd_img)
+        self._parser.add_args_sd_flash(parser_sd_flash)
+        self._parser.add_args_sd_duplicate(parser_sd_duplicate)
+        self._parser.add_args_sd_station(parser_sd_station)
         self._parser.add_args_sd_script(parser_sd_script)
         self._parser.add_args_sd_script_img(parser_sd_script_img)
         self._parser.add_args_nand(parser_nand)
@@ -148,6 +158,12 @@ class Dm36xLeopard(Board):
             self._parser.check_args_sd(args)
         elif args.mode == MODE_SD_IMG:
             self._parser.check_args_sd_img(args)
+        elif args.mode == MODE_SD_FLASH:
+            self._parser.check_args_sd_flash(args)
+        elif args.mode == MODE_SD_DUPLICATE:
+            self._parser.check_args_sd_duplicate(args)
+        elif args.mode == MODE_SD_STATION:
+            self._parser.check_args_sd_station(args)
         elif args.mode == MODE_SD_SCRIPT:
             self._parser.check_args_sd_script(args)
         elif args.mode == MODE_SD_SCRIPT_IMG:
@@ -174,6 +190,8 @@ class Dm36xLeopard(Board):
             self._comp_installer.kernel_image = args.kernel_file
         if hasattr(args, 'rootfs'): # sd-script mode doesn't need this
             self._comp_installer.rootfs = args.rootfs
+        if hasattr(args, 'incremental'): # only sd mode
+            self._comp_installer.incremental = args.incremental
         self._comp_installer.workdir = args.workdir
 
     def usb_init_comp_installer(self, args):
@@ -14,6 +14,11 @@
 # ==========================================================================
 
 from openfd.utils import ArgChecker
+from openfd.utils import ArgCheckerError
+from openfd.utils.tarball import is_tarball
+from openfd.utils.tarball import is_compressed_image
+from openfd.utils.duplicator import DEFAULT_STALL_TIMEOUT
+from openfd.utils.compressor import IMAGE_FORMATS
 from openfd.methods.board import TftpRamLoader
 
 class Dm36xLeopardArgsParser(object):
@@ -31,6 +36,8 @@ class Dm36xLeopardArgsParser(object):
                            metavar='<dev>',
                            dest='device',
                            required=True)
+        self.add_args_sd_wipe(parser)
+        self.add_args_sd_layout(parser)
     
         parser.add_argument('--mmap-file',
                            help='Memory map config file',
@@ -48,8 +55,22 @@ class Dm36xLeopardArgsParser(object):
                            required=True)
         
         self.add_args_sd_fs(parser)
+
+        parser.add_argument('--incremental',
+                           help="If the partitions of the device already "
+                           "match the memory map, don't repartition nor "
+                           "reformat it: only write the files that changed "
+                           "and remove the stale ones, boot files "
+                           "included",
+                           dest='incremental',
+                           action='store_true',
+                           default=False)
         
     def check_args_sd(self, args):
+        self.check_args_sd_layout(args)
+        if args.incremental and args.rootfs and is_tarball(args.rootfs):
+            raise ArgCheckerError('--incremental requires a rootfs '
+                                  'directory, not a tarball')
         self.checker.is_file(args.mmap_file, '--mmap-file')
         self.check_args_sd_bootloader(args)
         self.check_args_sd_kernel(args)
@@ -57,6 +78,32 @@ class Dm36xLeopardArgsParser(object):
         args.workdir = args.workdir.rstrip('/')
         self.check_args_sd_fs(args) 
         
+    def add_args_sd_wipe(self, parser):
+        parser.add_argument('--wipe-method',
+                           help="Method to wipe the bootloader environment "
+                           "from the device: auto (default; the fastest "
+                           "supported), discard, zeroout or zeros",
+                           metavar='<method>',
+                           dest='wipe_method',
+                           choices=['auto', 'discard', 'zeroout', 'zeros'],
+                           default='auto')
+
+    def add_args_sd_layout(self, parser):
+        parser.add_argument('--partition-align-mb',
+                           help="Align the partitions to this size in MB, "
+                           "i.e. the erase block size of the card (default: "
+                           "4); 0 for the legacy cylinder layout",
+                           metavar='<size>',
+                           dest='partition_align_mb',
+                           default='4')
+
+    def check_args_sd_layout(self, args):
+        self.checker.is_int(args.partition_align_mb, '--partition-align-mb')
+        args.partition_align_mb = int(args.partition_align_mb)
+        if args.partition_align_mb < 0:
+            raise ArgCheckerError('--partition-align-mb must not be '
+                                  'negative (%s)' % args.partition_align_mb)
+
     def add_args_sd_kernel(self, parser):
         parser.add_argument('--kernel-file',
                            help='Path to the Kernel file to be installed.',
@@ -114,13 +161,18 @@ class Dm36xLeopardArgsParser(object):
         
     def add_args_sd_fs(self, parser):
         parser.add_argument('--rootfs',
-                           help='Path to the rootfs that will be installed.',
-                           metavar='<dir>',
+                           help='Path to the rootfs that will be installed: '
+                           'a directory, or a tarball (.tar, .tar.gz, '
+                           '.tar.bz2, .tar.xz, .tar.zst, .tar.lz4) that is '
+                           'streamed into the rootfs partition.',
+                           metavar='<dir|tarball>',
                            dest='rootfs',
                            default=None)
         
     def check_args_sd_fs(self, args):
-        if args.rootfs:
+        if args.rootfs and is_tarball(args.rootfs):
+            self.checker.is_file(args.rootfs, '--rootfs')
+        elif args.rootfs:
             self.checker.is_dir(args.rootfs, '--rootfs')
         
     # ==========================================================================
@@ -157,7 +209,37 @@ class Dm36xLeopardArgsParser(object):
                            dest='imagesize_mb',
                            required=True)
 
+        parser.add_argument('--image-format',
+                           help="Compress the image in parallel chunks "
+                           "(image name plus .zst, .xz or .gz) and write its "
+                           "sha256 checksum next to it (default: raw)",
+                           metavar='<format>',
+                           dest='image_format',
+                           choices=IMAGE_FORMATS,
+                           default='raw')
+
+        self.add_args_sd_layout(parser)
+
+        parser.add_argument('--rootless',
+                           help="Build the image without superuser access "
+                           "(needs mke2fs with -d support)",
+                           dest='rootless',
+                           action='store_true',
+                           default=False)
+
+        parser.add_argument('--populate-rootfs',
+                           help="Create the rootfs partition directly from "
+                           "the rootfs directory (mke2fs -d), instead of "
+                           "mounting it and copying the rootfs",
+                           dest='populate_rootfs',
+                           action='store_true',
+                           default=False)
+
     def check_args_sd_img(self, args):
+        self.check_args_sd_layout(args)
+        if args.populate_rootfs and args.rootfs and is_tarball(args.rootfs):
+            raise ArgCheckerError('--populate-rootfs requires a rootfs '
+                                  'directory, not a tarball')
         self.checker.is_file(args.mmap_file, '--mmap-file')
         self.check_args_sd_bootloader(args)
         self.check_args_sd_kernel(args)
@@ -167,6 +249,192 @@ class Dm36xLeopardArgsParser(object):
         self.checker.is_int(args.imagesize_mb, '--image-size-mb')
         args.imagesize_mb = int(args.imagesize_mb)
 
+    # ==========================================================================
+    # Mode sd-flash args
+    # ==========================================================================
+
+    def add_args_sd_flash(self, parser):
+        parser.add_argument('--device',
+                           help="Device to flash",
+                           metavar='<dev>',
+                           dest='device',
+                           required=True)
+
+        parser.add_argument('--image',
+                           help="Filename of the SD card image to flash, can be "
+                           "compressed (.xz, .zst, .gz, .bz2, .lz4)",
+                           metavar='<file>',
+                           dest='image',
+                           required=True)
+
+        parser.add_argument('--bmap',
+                           help="Block map of the image (default: the image "
+                           "name plus '.bmap'; if missing the image is mapped "
+                           "on the fly)",
+                           metavar='<file>',
+                           dest='bmap_file',
+                           default='')
+
+        parser.add_argument('--no-verify',
+                           help="Don't read back and verify the written blocks",
+                           dest='verify',
+                           action='store_false',
+                           default=True)
+
+        parser.add_argument('--compare',
+                           help="Read each block of the device first and write "
+                           "only the blocks that differ from the image (faster "
+                           "when reflashing a card with a previous build)",
+                           dest='compare',
+                           action='store_true',
+                           default=False)
+
+    def check_args_sd_flash(self, args):
+        self.checker.is_file(args.image, '--image')
+        if args.bmap_file:
+            self.checker.is_file(args.bmap_file, '--bmap')
+
+    # ==========================================================================
+    # Mode sd-duplicate args
+    # ==========================================================================
+
+    def add_args_sd_duplicate(self, parser):
+        parser.add_argument('--device',
+                           help="Device to flash; give it once per device to "
+                           "flash several devices at once",
+                           metavar='<dev>',
+                           dest='devices',
+                           action='append',
+                           required=True)
+
+        parser.add_argument('--image',
+                           help="Filename of the SD card image to flash",
+                           metavar='<file>',
+                           dest='image',
+                           required=True)
+
+        parser.add_argument('--bmap',
+                           help="Block map of the image (default: the image "
+                           "name plus '.bmap'; if missing the image is mapped "
+                           "on the fly)",
+                           metavar='<file>',
+                           dest='bmap_file',
+                           default='')
+
+        parser.add_argument('--stall-timeout',
+                           help="Seconds a device can stall before it is "
+                           "dropped (default: %s)" % DEFAULT_STALL_TIMEOUT,
+                           metavar='<secs>',
+                           dest='stall_timeout',
+                           default=DEFAULT_STALL_TIMEOUT)
+
+    def check_args_sd_duplicate(self, args):
+        self.checker.is_file(args.image, '--image')
+        if is_compressed_image(args.image):
+            raise ArgCheckerError('--image must be uncompressed, flash '
+                                  'compressed images with sd-flash')
+        if args.bmap_file:
+            self.checker.is_file(args.bmap_file, '--bmap')
+        if len(set(args.devices)) != len(args.devices):
+            raise ArgCheckerError('Duplicated --device')
+        self.checker.is_int(args.stall_timeout, '--stall-timeout')
+        args.stall_timeout = int(args.stall_timeout)
+
+    # ==========================================================================
+    # Mode sd-station args
+    # ==========================================================================
+
+    def add_args_sd_station(self, parser):
+        parser.add_argument('--image',
+                           help="Filename of the SD card image to flash, can be "
+                           "compressed (.xz, .zst, .gz, .bz2, .lz4)",
+                           metavar='<file>',
+                           dest='image',
+                           required=True)
+
+        parser.add_argument('--bmap',
+                           help="Block map of the image (default: the image "
+                           "name plus '.bmap'; created if missing)",
+                           metavar='<file>',
+                           dest='bmap_file',
+                           default='')
+
+        parser.add_argument('--no-verify',
+                           help="Don't read back and verify the written blocks",
+                           dest='verify',
+                           action='store_false',
+                           default=True)
+
+        parser.add_argument('--jobs',
+                           help="Cards flashed at a time (default: 4)",
+                           metavar='<jobs>',
+                           dest='jobs',
+                           default='4')
+
+        parser.add_argument('--count',
+                           help="Exit after flashing this many cards "
+                           "(default: run until interrupted)",
+                           metavar='<cards>',
+                           dest='count',
+                           default='0')
+
+        parser.add_argument('--match',
+                           help="Flash only devices with this kernel name, "
+                           "shell-style pattern; can be given several times "
+                           "(default: sd*, mmcblk*)",
+                           metavar='<pattern>',
+                           dest='name_patterns',
+                           action='append')
+
+        parser.add_argument('--min-size-gb',
+                           help="Flash only devices of at least this size",
+                           metavar='<size>',
+                           dest='min_size_gb',
+                           default='0')
+
+        parser.add_argument('--max-size-gb',
+                           help="Flash only devices up to this size "
+                           "(default: 128)",
+                           metavar='<size>',
+                           dest='max_size_gb',
+                           default='128')
+
+        parser.add_argument('--vendor',
+                           help="Flash only devices whose vendor contains "
+                           "this text (i.e. 'Generic'; MMC cards have none)",
+                           metavar='<text>',
+                           dest='vendor',
+                           default='')
+
+        parser.add_argument('--model',
+                           help="Flash only devices whose model (the name, "
+                           "for MMC cards) contains this text",
+                           metavar='<text>',
+                           dest='model',
+                           default='')
+
+        parser.add_argument('--allow-fixed',
+                           help="Also flash non-removable devices (i.e. loop "
+                           "devices or card readers reported as fixed)",
+                           dest='removable_only',
+                           action='store_false',
+                           default=True)
+
+    def check_args_sd_station(self, args):
+        self.checker.is_file(args.image, '--image')
+        if args.bmap_file:
+            self.checker.is_file(args.bmap_file, '--bmap')
+        for arg, name in [(args.jobs, '--jobs'), (args.count, '--count'),
+                          (args.min_size_gb, '--min-size-gb'),
+                          (args.max_size_gb, '--max-size-gb')]:
+            self.checker.is_int(arg, name)
+        args.jobs = int(args.jobs)
+        args.count = int(args.count)
+        args.min_size_gb = int(args.min_size_gb)
+        args.max_size_gb = int(args.max_size_gb)
+        if args.jobs < 1:
+            raise ArgCheckerError('--jobs must be at least 1')
+
     # ==========================================================================
     # Mode sd-script args
     # ==========================================================================
@@ -224,9 +492,12 @@ class Dm36xLeopardArgsParser(object):
                            metavar='<dev>',
                            dest='device',
                            required=True)
+        self.add_args_sd_wipe(parser)
+        self.add_args_sd_layout(parser)
         self.add_args_sd_bootloader(parser)
     
     def check_args_sd_script(self, args):
+        self.check_args_sd_layout(args)
         self.check_args_sd_script_files(args)      
         self.check_args_sd_bootloader(args)
 
@@ -244,7 +515,26 @@ class Dm36xLeopardArgsParser(object):
                            dest='imagesize_mb',
                            required=True)
 
+        parser.add_argument('--image-format',
+                           help="Compress the image in parallel chunks "
+                           "(image name plus .zst, .xz or .gz) and write its "
+                           "sha256 checksum next to it (default: raw)",
+                           metavar='<format>',
+                           dest='image_format',
+                           choices=IMAGE_FORMATS,
+                           default='raw')
+
+        self.add_args_sd_layout(parser)
+
+        parser.add_argument('--rootless',
+                           help="Build the image without superuser access "
+                           "(needs mke2fs with -d support)",
+                           dest='rootless',
+                           action='store_true',
+                           default=False)
+
     def check_args_sd_script_img(self, args):
+        self.check_args_sd_layout(args)
         self.check_args_sd_script_files(args)      
         self.check_args_sd_bootloader(args)
         self.checker.is_int(args.imagesize_mb, '--image-size-mb')
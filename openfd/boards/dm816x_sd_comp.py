@@ -19,6 +19,7 @@
 
 import os
 import openfd.utils as utils
+import openfd.utils.tarball as tarball
 from openfd.storage import SDCardPartition
 from openfd.storage import LoopDevicePartition
 from board import BoardError
@@ -47,6 +48,7 @@ class Dm816xSdCompInstaller(object):
         self._bootargs = None
         self._kernel_image = None
         self._rootfs = None
+        self._incremental = False
         self._dryrun = dryrun
         self._e.dryrun = dryrun
 
@@ -107,6 +109,19 @@ class Dm816xSdCompInstaller(object):
                       doc="""Path to the rootfs directory. Set to None if this
             installation does not require a rootfs, i.e. NFS will be used.""")
     
+    def __set_incremental(self, incremental):
+        self._incremental = incremental
+
+    def __get_incremental(self):
+        return self._incremental
+    
+    incremental = property(__get_incremental, __set_incremental,
+                           doc="""Only write the files that changed: the
+            boot files with the same contents are not copied again, and the
+            rootfs is synced, removing the files not in :attr:`rootfs`. The
+            stale boot files are removed by the device, see
+            :func:`SDCard.mount`.""")
+    
     def __set_workdir(self, workdir):
         self._workdir = workdir
         
@@ -126,11 +141,14 @@ class Dm816xSdCompInstaller(object):
         """
         
         self._l.info('Installing uboot')
-        cmd = 'sudo cp %s %s/MLO' % (self._uboot_min_file, mount_point)
+        cmd = utils.copy_file_cmd(self._uboot_min_file, '%s/MLO' % mount_point,
+                                  self._incremental)
         if self._e.check_call(cmd) != 0:
             raise BoardError('Failed copying %s to %s' %
                                (self._uboot_min_file, mount_point))
-        cmd = 'sudo cp %s %s/u-boot.bin' % (self._uboot_file, mount_point)
+        cmd = utils.copy_file_cmd(self._uboot_file,
+                                  '%s/u-boot.bin' % mount_point,
+                                  self._incremental)
         if self._e.check_call(cmd) != 0:
             raise BoardError('Failed copying %s to %s' %
                                (self._uboot_file, mount_point))
@@ -154,7 +172,7 @@ class Dm816xSdCompInstaller(object):
                 uenv.write("%s\n" % bootargs)
                 self._l.debug("  uEnv.txt <= '%s'" % uenvcmd)
                 uenv.write("%s\n" % uenvcmd)
-        cmd = 'sudo cp %s %s' % (uenv_file, mount_point)
+        cmd = utils.copy_file_cmd(uenv_file, mount_point, self._incremental)
         if self._e.check_call(cmd) != 0:
             raise BoardError('Failed to install uboot env file.')
         
@@ -169,14 +187,17 @@ class Dm816xSdCompInstaller(object):
         """
 
         self._l.info('Installing kernel')
-        cmd = 'sudo cp %s %s/uImage' % (self._kernel_image, mount_point)
+        cmd = utils.copy_file_cmd(self._kernel_image,
+                                  '%s/uImage' % mount_point,
+                                  self._incremental)
         if self._e.check_call(cmd) != 0:
             raise BoardError('Failed copying %s to %s' %
                                (self._kernel_image, mount_point))
     
     def install_rootfs(self, mount_point):
         """
-        If any, installs :attr:`rootfs` to the given mount point.
+        If any, installs :attr:`rootfs` to the given mount point. A rootfs
+        tarball is decompressed and streamed into the mount point.
         
         :param mount_point: Path to where install rootfs.
         :exception BoardError: On error.
@@ -184,12 +205,16 @@ class Dm816xSdCompInstaller(object):
                                  
         if self._rootfs:
             self._l.info('Installing rootfs (this may take a while)')
-            cmd = 'cd %s ; find . | sudo cpio -pdum %s' % (self._rootfs,
-                                                           mount_point)
-            if self._e.check_call(cmd) != 0:
+            if tarball.is_tarball(self._rootfs):
+                cmd = tarball.extract_cmd(self._rootfs, mount_point)
+                ret = self._e.check_call(cmd)
+            else:
+                ret = self._e.copy_tree(self._rootfs, mount_point,
+                                        sync=self._incremental)
+            if ret != 0:
                 raise BoardError('Failed installing rootfs '
                                               'into %s' % mount_point)
-            if self._e.check_call('sync') != 0:
+            if self._e.check_call('sync -f %s' % mount_point) != 0:
                 raise BoardError('Unable  to sync')
         else:
             self._l.warning('No directory for "%s", omitting...'
@@ -202,11 +227,8 @@ class Dm816xSdCompInstaller(object):
         :exception BoardError: On failure installing the components.
         """
         
-        i = 1
         for part in sd.partitions:
-            cmd = 'mount | grep %s  | cut -f 3 -d " "' % sd.partition_name(i)
-            output = self._e.check_output(cmd)[1]
-            mount_point = output.replace('\n', '')
+            mount_point = sd.mount_point(part)
             for comp in part.components:
                 if comp == SDCardPartition.COMPONENT_BOOTLOADER:
                     self.install_uboot(mount_point)
@@ -217,7 +239,6 @@ class Dm816xSdCompInstaller(object):
                     self.install_rootfs(mount_point)
                 else:
                     raise BoardError('Invalid component: %s' % comp)
-            i += 1
 
     def install_ld_components(self, ld):
         """
@@ -227,9 +248,7 @@ class Dm816xSdCompInstaller(object):
         """
         
         for part in ld.partitions:
-            cmd = 'mount | grep %s  | cut -f 3 -d " "' % part.device
-            output = self._e.check_output(cmd)[1]
-            mount_point = output.replace('\n', '')
+            mount_point = ld.mount_point(part)
             for comp in part.components:
                 if comp == LoopDevicePartition.COMPONENT_BOOTLOADER:
                     self.install_uboot(mount_point)
@@ -237,7 +256,9 @@ class Dm816xSdCompInstaller(object):
                 elif comp == LoopDevicePartition.COMPONENT_KERNEL:
                     self.install_kernel(mount_point)
                 elif comp == LoopDevicePartition.COMPONENT_ROOTFS:
-                    self.install_rootfs(mount_point)
+                    # Already in the partition if populated at mkfs time
+                    if not ld.is_populated(part):
+                        self.install_rootfs(mount_point)
                 else:
                     raise BoardError('Invalid component: %s' % comp)
 
@@ -249,17 +270,13 @@ class Dm816xSdCompInstaller(object):
         :exception BoardError: On failure installing the components.
         """
         
-        i = 1
         for part in sd.partitions:
-            cmd = 'mount | grep %s  | cut -f 3 -d " "' % sd.partition_name(i)
-            output = self._e.check_output(cmd)[1]
-            mount_point = output.replace('\n', '')
+            mount_point = sd.mount_point(part)
             for comp in part.components:
                 if comp == SDCardPartition.COMPONENT_BOOTLOADER:
                     self.install_uboot(mount_point)
                 else:
                     raise BoardError('Invalid component: %s' % comp)
-            i += 1
 
     def install_ld_components_external(self, ld):
         """
@@ -270,9 +287,7 @@ class Dm816xSdCompInstaller(object):
         """
         
         for part in ld.partitions:
-            cmd = 'mount | grep %s  | cut -f 3 -d " "' % part.device
-            output = self._e.check_output(cmd)[1]
-            mount_point = output.replace('\n', '')
+            mount_point = ld.mount_point(part)
             for comp in part.components:
                 if comp == LoopDevicePartition.COMPONENT_BOOTLOADER:
                     self.install_uboot(mount_point)
@@ -22,6 +22,7 @@
 import os
 import openfd.utils as utils
 import openfd.utils.hexutils as hexutils
+import openfd.utils.tarball as tarball
 from openfd.storage import SDCardPartition
 from openfd.storage import LoopDevicePartition
 from board import BoardError
@@ -54,6 +55,7 @@ class Imx6SdCompInstaller(object):
         self._kernel_tftp = False
         self._tftp_loader = None
         self._rootfs = None
+        self._incremental = False
         self._dryrun = dryrun
         self._e.dryrun = dryrun
 	self._uboot_spl = None
@@ -194,6 +196,19 @@ class Imx6SdCompInstaller(object):
                       doc="""Path to the rootfs directory. Set to None if this
             installation does not require a rootfs, i.e. NFS will be used.""")
     
+    def __set_incremental(self, incremental):
+        self._incremental = incremental
+
+    def __get_incremental(self):
+        return self._incremental
+    
+    incremental = property(__get_incremental, __set_incremental,
+                           doc="""Only write the files that changed: the
+            boot files with the same contents are not copied again, and the
+            rootfs is synced, removing the files not in :attr:`rootfs`. The
+            stale boot files are removed by the device, see
+            :func:`SDCard.mount`.""")
+    
     def __set_workdir(self, workdir):
         self._workdir = workdir
         
@@ -206,33 +221,35 @@ class Imx6SdCompInstaller(object):
     
     def install_uboot(self, device):
         """
-        Flashes  uboot to the given device, using dd.
+        Flashes  uboot to the given device, using the raw writer.
         
         This method needs`, 
         :attr:`uboot_file` to be already set.
-	:attr:`uboot_spl` to be already set.
-	:attr:`uboot_seek` to be already set.
-	:attr:`uboot_bs` to be already set.
+        :attr:`uboot_spl` to be already set.
+        :attr:`uboot_seek` to be already set.
+        :attr:`uboot_bs` to be already set.
         
         :param device: Device where to flash UBL and uboot (i.e. '/dev/sdb').
         :exception BoardError: On error.
         """
         
         self._l.info('Installing uboot')
-        cmd = ('sudo dd' + 
-              ' if=' + self._uboot_file + 
-              ' of=' + device +
-               ' seek=' + self._uboot_seek + ' bs=' + self._uboot_bs ) #The default values are: seek=2 bs=512
-        if self._e.check_call(cmd) != 0:
+        # uboot_seek and uboot_bs are given as dd arguments (default values:
+        # seek=2 bs=512)
+        try:
+            offset = int(self._uboot_seek) * utils.dd_size(self._uboot_bs)
+        except ValueError:
+            raise BoardError('Invalid uboot seek/bs: %s/%s' %
+                             (self._uboot_seek, self._uboot_bs))
+        if self._e.raw_write(device, self._uboot_file, offset=offset,
+                             direct=True) != 0:
             raise BoardError('Failed to flash uboot into %s' % device)
-	
-	if self._uboot_spl != None:
-	    cmd = ('sudo dd' + 
-		' if=' + self._uboot_spl + 
-		' of=' + device + 
-		' seek=1 bs=1K')
-	    if self._e.check_call(cmd) != 0:
-		raise BoardError('Failed to flash SPL into %s' % device)
+        
+        if self._uboot_spl != None:
+            # seek=1 bs=1K
+            if self._e.raw_write(device, self._uboot_spl, offset=1024,
+                                 direct=True) != 0:
+                raise BoardError('Failed to flash SPL into %s' % device)
     
     def install_uboot_env(self, mount_point):
         """
@@ -272,7 +289,7 @@ class Imx6SdCompInstaller(object):
                 uenv.write("autostart=no\n")
                 self._l.debug("  uEnv.txt <= '%s'" % uenvcmd)
                 uenv.write("%s\n" % uenvcmd)
-        cmd = 'sudo cp %s %s' % (uenv_file, mount_point)
+        cmd = utils.copy_file_cmd(uenv_file, mount_point, self._incremental)
         if self._e.check_call(cmd) != 0:
             raise BoardError('Failed to install uboot env file.')
 
@@ -289,7 +306,8 @@ class Imx6SdCompInstaller(object):
         if self._bootscript:
             self._l.info('Installing uboot script')
 
-            cmd = 'sudo cp %s %s/' % (self._bootscript, mount_point)
+            cmd = utils.copy_file_cmd(self._bootscript, '%s/' % mount_point,
+                                      self._incremental)
             if self._e.check_call(cmd) != 0:
                 raise BoardError('Failed copying %s to %s' %
                                  (self._bootscript, mount_point))
@@ -308,7 +326,9 @@ class Imx6SdCompInstaller(object):
         """
 
         self._l.info('Installing kernel')
-        cmd = 'sudo cp %s %s/%s' % (self._kernel_image, mount_point, self.kernel_file_type)
+        cmd = utils.copy_file_cmd(self._kernel_image, '%s/%s' %
+                                  (mount_point, self.kernel_file_type),
+                                  self._incremental)
         if self._e.check_call(cmd) != 0:
             raise BoardError('Failed copying %s to %s' %
                                (self._kernel_image, mount_point))
@@ -325,14 +345,16 @@ class Imx6SdCompInstaller(object):
 
         
         self._l.info('Installing kernel devicetree')
-        cmd = 'sudo cp %s %s' % (self._kernel_devicetree, mount_point)
+        cmd = utils.copy_file_cmd(self._kernel_devicetree, mount_point,
+                                  self._incremental)
         if self._e.check_call(cmd) != 0:
             raise BoardError('Failed copying %s to %s' %
                              (self._kernel_devicetree, mount_point))
 
     def install_rootfs(self, mount_point):
         """
-        If any, installs :attr:`rootfs` to the given mount point.
+        If any, installs :attr:`rootfs` to the given mount point. A rootfs
+        tarball is decompressed and streamed into the mount point.
         
         :param mount_point: Path to where install rootfs.
         :exception BoardError: On error.
@@ -340,12 +362,16 @@ class Imx6SdCompInstaller(object):
                                  
         if self._rootfs:
             self._l.info('Installing rootfs (this may take a while)')
-            cmd = 'cd %s ; find . | sudo cpio -pdum %s' % (self._rootfs,
-                                                           mount_point)
-            if self._e.check_call(cmd) != 0:
+            if tarball.is_tarball(self._rootfs):
+                cmd = tarball.extract_cmd(self._rootfs, mount_point)
+                ret = self._e.check_call(cmd)
+            else:
+                ret = self._e.copy_tree(self._rootfs, mount_point,
+                                        sync=self._incremental)
+            if ret != 0:
                 raise BoardError('Failed installing rootfs '
                                               'into %s' % mount_point)
-            if self._e.check_call('sync') != 0:
+            if self._e.check_call('sync -f %s' % mount_point) != 0:
                 raise BoardError('Unable  to sync')
         else:
             self._l.warning('No directory for "%s", omitting...'
@@ -359,11 +385,8 @@ class Imx6SdCompInstaller(object):
         :exception BoardError: On failure installing the components.
         """
         
-        i = 1
         for part in sd.partitions:
-            cmd = 'mount | grep %s  | cut -f 3 -d " "' % sd.partition_name(i)
-            output = self._e.check_output(cmd)[1]
-            mount_point = output.replace('\n', '')
+            mount_point = sd.mount_point(part)
             for comp in part.components:
                 if comp == SDCardPartition.COMPONENT_BOOTLOADER:
                     self.install_uboot(sd.name)
@@ -378,7 +401,6 @@ class Imx6SdCompInstaller(object):
                     self.install_rootfs(mount_point)
                 else:
                     raise BoardError('Invalid component: %s' % comp)
-            i += 1
 
     def install_ld_components(self, ld):
         """
@@ -388,9 +410,7 @@ class Imx6SdCompInstaller(object):
         """
         
         for part in ld.partitions:
-            cmd = 'mount | grep %s  | cut -f 3 -d " "' % part.device
-            output = self._e.check_output(cmd)[1]
-            mount_point = output.replace('\n', '')
+            mount_point = ld.mount_point(part)
             for comp in part.components:
                 if comp == LoopDevicePartition.COMPONENT_BOOTLOADER:
                     self.install_uboot(ld.name)
@@ -401,7 +421,9 @@ class Imx6SdCompInstaller(object):
                     if self._kernel_devicetree:
                         self.install_kernel_devicetree(mount_point)
                 elif comp == LoopDevicePartition.COMPONENT_ROOTFS:
-                    self.install_rootfs(mount_point)
+                    # Already in the partition if populated at mkfs time
+                    if not ld.is_populated(part):
+                        self.install_rootfs(mount_point)
                 else:
                     raise BoardError('Invalid component: %s' % comp)
                 
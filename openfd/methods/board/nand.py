@@ -293,26 +293,28 @@ class NandInstaller(object):
         if not force and not self._is_img_install_needed(comp, img_env):
             self._l.info("%s doesn't need to be installed" % comp.capitalize())
             return
-        self._l.debug("Loading %s image to RAM" % comp)
-        self._u.set_env('autostart', 'no')
-        self._load_file_to_ram(filename, self._ram_load_addr)
-        self._u.set_env('autostart', 'yes')
-        self._l.debug("Erasing %s NAND space" % comp)
-        cmd = "%s %s %s" % \
-            (self._board.erase_cmd(comp), to_hex(offset), to_hex(part_size))
-        self._u.cmd(cmd, prompt_timeout=timeout)
-        self._l.debug("Writing %s image from RAM to NAND" % comp)
-        cmd = self._board.pre_write_cmd(comp)
-        if cmd: self._u.cmd(cmd, prompt_timeout=timeout)
-        cmd = "%s %s %s %s" % (self._board.write_cmd(comp),
-                               to_hex(self._ram_load_addr), to_hex(offset),
-                               to_hex(img_size_aligned))
-        self._u.cmd(cmd, prompt_timeout=timeout)
-        cmd = self._board.post_write_cmd(comp)
-        if cmd: self._u.cmd(cmd, prompt_timeout=timeout)
-        self._l.debug("Saving %s partition info" % comp)
-        self._save_img_env(comp, img_env)
-        self._u.save_env()
+        with utils.trace_span('nand install %s' % comp, 'phase',
+                              bytes=img_size_aligned):
+            self._l.debug("Loading %s image to RAM" % comp)
+            self._u.set_env('autostart', 'no')
+            self._load_file_to_ram(filename, self._ram_load_addr)
+            self._u.set_env('autostart', 'yes')
+            self._l.debug("Erasing %s NAND space" % comp)
+            cmd = "%s %s %s" % \
+                (self._board.erase_cmd(comp), to_hex(offset), to_hex(part_size))
+            self._u.cmd(cmd, prompt_timeout=timeout)
+            self._l.debug("Writing %s image from RAM to NAND" % comp)
+            cmd = self._board.pre_write_cmd(comp)
+            if cmd: self._u.cmd(cmd, prompt_timeout=timeout)
+            cmd = "%s %s %s %s" % (self._board.write_cmd(comp),
+                                   to_hex(self._ram_load_addr), to_hex(offset),
+                                   to_hex(img_size_aligned))
+            self._u.cmd(cmd, prompt_timeout=timeout)
+            cmd = self._board.post_write_cmd(comp)
+            if cmd: self._u.cmd(cmd, prompt_timeout=timeout)
+            self._l.debug("Saving %s partition info" % comp)
+            self._save_img_env(comp, img_env)
+            self._u.save_env()
         self._l.info('%s installation complete' % comp.capitalize())
     
     def install_ipl(self, force=False):
@@ -133,9 +133,8 @@ class TftpRamLoader(RamLoader):
                      doc="""Host IP address.""")
 
     def check_tftp_settings(self):
-        cmd = 'netstat -an | grep udp | grep -q :%d' % self._port
-        ret = self._e.check_call(cmd)
-        if ret != 0:
+        is_open = self._e.probe(utils.is_udp_port_open, self._port)
+        if not is_open and not self._dryrun:
             raise RamLoaderException("Seems like you aren't running tftp udp server "
               "on port %d, please check your server settings" % self._port)
     
@@ -212,12 +211,14 @@ class TftpRamLoader(RamLoader):
         self._l.debug("Starting TFTP transfer from file '%s' to RAM address "
                       "'%s'" % (tftp_filename, hex_load_addr))
         cmd = 'tftp %s %s' % (to_hex(hex_load_addr), basename)
-        try:
-            self._u.cmd(cmd, prompt_timeout=self._transfer_timeout(size_b))
-        except UbootTimeoutException:
-            self._u.cancel_cmd()
-            raise RamLoaderException("TFTP transfer failed from '%s:%s'." %
-                               (self._host_ipaddr, self._port))
+        with utils.trace_span('tftp', 'transfer', file=basename,
+                              bytes=size_b):
+            try:
+                self._u.cmd(cmd, prompt_timeout=self._transfer_timeout(size_b))
+            except UbootTimeoutException:
+                self._u.cancel_cmd()
+                raise RamLoaderException("TFTP transfer failed from '%s:%s'." %
+                                   (self._host_ipaddr, self._port))
         
         filesize = self._u.get_env('filesize')
         if filesize:
@@ -261,9 +262,11 @@ class TftpRamLoader(RamLoader):
         self._l.debug("Starting TFTP transfer from file '%s' to RAM address "
                       "'%s'" % (tftp_filename, hex_load_addr))
         cmd = 'tftp %s %s' % (hex_load_addr, basename)
-        self._u.cmd(cmd, prompt_timeout=None)
-        autobooting = self._u.expect("Automatic boot of image at addr",
-                                  timeout=self._transfer_timeout(size_b))[0]
+        with utils.trace_span('tftp', 'transfer', file=basename,
+                              bytes=size_b):
+            self._u.cmd(cmd, prompt_timeout=None)
+            autobooting = self._u.expect("Automatic boot of image at addr",
+                                      timeout=self._transfer_timeout(size_b))[0]
         if not autobooting:
             raise RamLoaderException("Didn't detect Autoboot from addr "
                                          "%s" % hex_load_addr)
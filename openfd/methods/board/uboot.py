@@ -252,43 +252,46 @@ class Uboot(object):
 
         if self._dryrun: return True, ''
         
-        found = False
-        line = ''
-        start_time = time.time()
-        
-        if self._uboot_mode == 'termnet':
-            while not found and (time.time() - start_time) < timeout:
-                try:
-                    line = self._termnet.read_until('\n',1).strip('\r\n')
-		    if not line:
-                        line = self._termnet.read_until('#',1).strip('\r\n')
-                    if self._l_termnet:
-                        msg = "%s => '%s'" % (self._log_prefix, line)
-                        if log_output:
-                            self._l_termnet.info(msg)
-                        else:
-                            self._l_termnet.debug(msg)
-                except EOFError as e:
-                    self._l.error(e)
-                    return False, ''
-                if response in line:
-                    found = True
+        with utils.trace_span('uboot expect', 'uboot',
+                              response=response) as span:
+            found = False
+            line = ''
+            start_time = time.time()
 
-        if self._uboot_mode == 'serial':
-            while not found and (time.time() - start_time) < timeout:
-                try:
-                    line = self._port.readline().strip(' \r\n')
-                    if self._l_serial:
-                        msg = "%s => '%s'" % (self._log_prefix, line)
-                        if log_output:
-                            self._l_serial.info(msg)
-                        else:
-                            self._l_serial.debug(msg)
-                except (serial.SerialException, OSError) as e:
-                    self._l.error(e)
-                    return False, ''
-                if response in line:
-                    found = True
+            if self._uboot_mode == 'termnet':
+                while not found and (time.time() - start_time) < timeout:
+                    try:
+                        line = self._termnet.read_until('\n',1).strip('\r\n')
+                        if not line:
+                            line = self._termnet.read_until('#',1).strip('\r\n')
+                        if self._l_termnet:
+                            msg = "%s => '%s'" % (self._log_prefix, line)
+                            if log_output:
+                                self._l_termnet.info(msg)
+                            else:
+                                self._l_termnet.debug(msg)
+                    except EOFError as e:
+                        self._l.error(e)
+                        return False, ''
+                    if response in line:
+                        found = True
+
+            if self._uboot_mode == 'serial':
+                while not found and (time.time() - start_time) < timeout:
+                    try:
+                        line = self._port.readline().strip(' \r\n')
+                        if self._l_serial:
+                            msg = "%s => '%s'" % (self._log_prefix, line)
+                            if log_output:
+                                self._l_serial.info(msg)
+                            else:
+                                self._l_serial.debug(msg)
+                    except (serial.SerialException, OSError) as e:
+                        self._l.error(e)
+                        return False, ''
+                    if response in line:
+                        found = True
+            span.args['found'] = found
 
         return found, line
 
@@ -385,32 +388,33 @@ class Uboot(object):
         else:
             self._l.info("%s <= '%s'" % (self._log_prefix, cmd.strip()))
         
-        if not self._dryrun:
-	    if self._uboot_mode == 'termnet':
-		self._termnet.write('%s\n' % cmd)
-	    if self._uboot_mode == 'serial':        
-            	self._port.write('%s\n' % cmd)
-            
-	    time.sleep(0.1)
-            # Wait for the echo
-            if echo_timeout:
-                found_echo, line = self.expect(cmd.strip(), echo_timeout)
-                if not found_echo:
-                    msg = ("Uboot didn't echo the '%s' command, maybe it "
-                        "froze. " % cmd.strip())
-                    if line:
-                        msg += "This is the log of the last line: %s" % line
-                    raise UbootTimeoutException(msg)
-
-            # Wait for the prompt
-            if self._prompt and prompt_timeout:
-                found_prompt, line = self.expect(self._prompt, timeout=prompt_timeout)
-                if not found_prompt:
-                    msg = ("Didn't get the uboot prompt back  after "
-                           "executing the '%s' command." % cmd.strip())
-                    if line:
-                        msg += "This is the log of the last line: %s" % line
-                    raise UbootTimeoutException(msg)
+        with utils.trace_span('uboot cmd', 'uboot', cmd=cmd.strip()):
+            if not self._dryrun:
+                if self._uboot_mode == 'termnet':
+                    self._termnet.write('%s\n' % cmd)
+                if self._uboot_mode == 'serial':
+                    self._port.write('%s\n' % cmd)
+
+                time.sleep(0.1)
+                # Wait for the echo
+                if echo_timeout:
+                    found_echo, line = self.expect(cmd.strip(), echo_timeout)
+                    if not found_echo:
+                        msg = ("Uboot didn't echo the '%s' command, maybe it "
+                            "froze. " % cmd.strip())
+                        if line:
+                            msg += "This is the log of the last line: %s" % line
+                        raise UbootTimeoutException(msg)
+
+                # Wait for the prompt
+                if self._prompt and prompt_timeout:
+                    found_prompt, line = self.expect(self._prompt, timeout=prompt_timeout)
+                    if not found_prompt:
+                        msg = ("Didn't get the uboot prompt back  after "
+                               "executing the '%s' command." % cmd.strip())
+                        if line:
+                            msg += "This is the log of the last line: %s" % line
+                        raise UbootTimeoutException(msg)
     def cancel_cmd(self):
         """
         Cancels the command being executed by uboot (equivalent to CTRL+C).
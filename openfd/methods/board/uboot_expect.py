@@ -198,28 +198,29 @@ class UbootExpect(object):
         else:
             self._l.info("%s <= '%s'" % (self._log_prefix, cmd.strip()))
         
-        if not self._dryrun:
-        
-            self._child.send('%s\n' % cmd)
-            time.sleep(0.1)
-            
-            # Wait for the echo
-            if echo_timeout:
-                try:
-                    self._child.expect(cmd.strip(), timeout=echo_timeout)
-                except (pexpect.TIMEOUT, pexpect.EOF):
-                    msg = ("Uboot didn't echo the '%s' command, maybe it "
-                        "froze. " % cmd.strip())
-                    raise UbootTimeoutException(msg)
-            
-            # Wait for the prompt
-            if self._prompt and prompt_timeout:
-                try:
-                    self._child.expect(self._prompt, timeout=prompt_timeout)
-                except (pexpect.TIMEOUT, pexpect.EOF):
-                    msg = ("Didn't get the uboot prompt back after "
-                               "executing the '%s' command." % cmd.strip())
-                    raise UbootTimeoutException(msg)
+        with utils.trace_span('uboot cmd', 'uboot', cmd=cmd.strip()):
+            if not self._dryrun:
+
+                self._child.send('%s\n' % cmd)
+                time.sleep(0.1)
+
+                # Wait for the echo
+                if echo_timeout:
+                    try:
+                        self._child.expect(cmd.strip(), timeout=echo_timeout)
+                    except (pexpect.TIMEOUT, pexpect.EOF):
+                        msg = ("Uboot didn't echo the '%s' command, maybe it "
+                            "froze. " % cmd.strip())
+                        raise UbootTimeoutException(msg)
+
+                # Wait for the prompt
+                if self._prompt and prompt_timeout:
+                    try:
+                        self._child.expect(self._prompt, timeout=prompt_timeout)
+                    except (pexpect.TIMEOUT, pexpect.EOF):
+                        msg = ("Didn't get the uboot prompt back after "
+                                   "executing the '%s' command." % cmd.strip())
+                        raise UbootTimeoutException(msg)
 
     def expect(self, response, timeout=DEFAULT_UBOOT_TIMEOUT,
                log_console_output=False):
@@ -242,26 +243,29 @@ class UbootExpect(object):
         if self._check_is_alive() is False: return False, ''
         if self._dryrun: return True, ''
         
-        found = False
-        line = ''
-        start_time = time.time()
-        
-        while not found and (time.time() - start_time) < timeout:
-            try:
-                line = self._child.readline().strip(' \r\n')
-                if self._l_console:
-                    msg = "%s => '%s'" % (self._log_prefix, line)
-                    if log_console_output:
-                        self._l_console.info(msg)
-                    else:
-                        self._l_console.debug(msg)
-            except pexpect.EOF as e:
-                self._l.error(e)
-                return False, ''
-            except pexpect.TIMEOUT:
-                pass
-            if response in line:
-                found = True
+        with utils.trace_span('uboot expect', 'uboot',
+                              response=response) as span:
+            found = False
+            line = ''
+            start_time = time.time()
+
+            while not found and (time.time() - start_time) < timeout:
+                try:
+                    line = self._child.readline().strip(' \r\n')
+                    if self._l_console:
+                        msg = "%s => '%s'" % (self._log_prefix, line)
+                        if log_console_output:
+                            self._l_console.info(msg)
+                        else:
+                            self._l_console.debug(msg)
+                except pexpect.EOF as e:
+                    self._l.error(e)
+                    return False, ''
+                except pexpect.TIMEOUT:
+                    pass
+                if response in line:
+                    found = True
+            span.args['found'] = found
             
         return found, line
 
@@ -1,2 +1,3 @@
 from sdcard import *
 from sdcard_external import *
+from station import *
@@ -18,10 +18,24 @@
 # Imports
 # ==========================================================================
 
+import os
 import openfd.utils as utils
 from openfd.storage.device import SDCard
 from openfd.storage.device import LoopDevice
+from openfd.storage.device import ImageDevice
+from openfd.storage.bmap import BmapError
+from openfd.storage.bmap import CHECKSUM_TOOLS
+from openfd.storage.bmap import create_bmap
+from openfd.storage.bmap import read_bmap
+from openfd.storage.bmap import write_bmap
 from openfd.boards.board import BoardError
+from openfd.utils.duplicator import DEFAULT_STALL_TIMEOUT
+from openfd.utils.compressor import CompressorError
+from openfd.utils.compressor import ImageCompressor
+from openfd.utils.compressor import compressed_name
+from openfd.utils.tarball import decompress_cmd
+from openfd.utils.tarball import is_compressed_image
+from openfd.utils.tarball import uncompressed_name
 
 # ==========================================================================
 # Public Classes
@@ -33,6 +47,12 @@ WARN_DEVICE_SIZE_GB = 128
 #: Color for dangerous warning messages.
 WARN_COLOR = 'yellow'
 
+#: Extension of the block map files, appended to the image name.
+BMAP_EXTENSION = '.bmap'
+
+#: Block size used by dd when verifying flashed images.
+VERIFY_DD_BS = '1M'
+
 # ==========================================================================
 # Public Classes
 # ==========================================================================
@@ -57,6 +77,10 @@ class SDCardInstaller(object):
         3. mount_partitions()
         4. install_components()
         5. release()
+    
+    Or, to flash an image:
+    ::
+        1. flash(), or duplicate() to flash several SD cards at once
     """
     
     def __init__(self, board, device='', dryrun=False,
@@ -82,12 +106,17 @@ class SDCardInstaller(object):
         self._sd.dryrun = dryrun
         self._board.dryrun = dryrun
         self._interactive = interactive
+        self._incremental = False
         self._partitions = []
         self._loopdevice_partitions = {}
     
     def __set_device(self, device):
+        wipe_method = self._sd.wipe_method
+        partition_align_b = self._sd.partition_align_b
         self._sd = SDCard(device)
         self._sd.dryrun = self._dryrun
+        self._sd.wipe_method = wipe_method
+        self._sd.partition_align_b = partition_align_b
     
     def __get_device(self):
         return self._sd.name
@@ -127,6 +156,39 @@ class SDCardInstaller(object):
     enable_colors = property(__get_enable_colors, __set_enable_colors,
                            doc="""Enable colored messages.""")
 
+    def __set_wipe_method(self, method):
+        self._sd.wipe_method = method
+    
+    def __get_wipe_method(self):
+        return self._sd.wipe_method
+    
+    wipe_method = property(__get_wipe_method, __set_wipe_method,
+                           doc="""Method used to wipe the bootloader
+                           environment, see :func:`Device.wipe_method`.""")
+
+    def __set_partition_align_b(self, align_b):
+        self._sd.partition_align_b = align_b
+    
+    def __get_partition_align_b(self):
+        return self._sd.partition_align_b
+    
+    partition_align_b = property(__get_partition_align_b,
+                                 __set_partition_align_b,
+                                 doc="""Alignment of the partitions (bytes),
+                                 see :func:`Device.partition_align_b`.""")
+
+    def __set_incremental(self, incremental):
+        self._incremental = incremental
+    
+    def __get_incremental(self):
+        return self._incremental
+    
+    incremental = property(__get_incremental, __set_incremental,
+                           doc="""Update the SD card in place when its
+                           partitions already match the memory map: format()
+                           doesn't repartition nor reformat it, so only the
+                           files that changed are written.""")
+
     def mount_partitions(self, directory):
         """
         Mounts the partitions in the specified directory.
@@ -134,7 +196,9 @@ class SDCardInstaller(object):
         :exception DeviceException: When unable to mount.
         """
         
-        self._sd.mount(directory)
+        with utils.trace_span('mount_partitions', 'phase',
+                              device=self._sd.name):
+            self._sd.mount(directory)
 
     def _format_checks(self):
         if self._sd.exists is False:
@@ -160,24 +224,44 @@ class SDCardInstaller(object):
         confirmed = self._e.prompt_user(msg, WARN_COLOR)
         if not confirmed:
             raise SDCardInstallerError('User canceled')
+
+    def _update_confirms(self):
+        if self._sd.confirm_size_gb(WARN_DEVICE_SIZE_GB) is False:
+            raise SDCardInstallerError('User canceled')
+        msg = ('You are about to update %s in place (the files not in the '
+               'rootfs will be removed)' % self._sd.name)
+        confirmed = self._e.prompt_user(msg, WARN_COLOR)
+        if not confirmed:
+            raise SDCardInstallerError('User canceled')
         
     def format(self):
         """
-        Creates and formats the partitions in the SD card.
+        Creates and formats the partitions in the SD card. In
+        :attr:`incremental` mode, nothing is done if the partitions already
+        match.
         
         :returns: Returns true on success; false otherwise.
         :exception DeviceException: On failure formatting the device.
         :exception SDCardInstallerError: On failure executing this action. 
         """
         
-        if not self.dryrun:
-            self._format_checks()
-        if self._interactive:
-            self._format_confirms()
-        self._l.info('Formatting %s (this may take a while)' % self._sd.name)
-        self._sd.wipe_bootloader_env()
-        self._sd.create_partitions()
-        self._sd.format_partitions()
+        with utils.trace_span('format', 'phase', device=self._sd.name):
+            if not self.dryrun:
+                self._format_checks()
+            if self._incremental and self._sd.partitions_match():
+                if self._interactive:
+                    self._update_confirms()
+                # Wiping the bootloader environment would also erase the
+                # start of the first partition
+                self._l.info('Partitions in %s match, updating it in place' %
+                             self._sd.name)
+                return
+            if self._interactive:
+                self._format_confirms()
+            self._l.info('Formatting %s (this may take a while)' % self._sd.name)
+            self._sd.wipe_bootloader_env()
+            self._sd.create_partitions()
+            self._sd.format_partitions()
 
     def release(self):
         """
@@ -186,9 +270,10 @@ class SDCardInstaller(object):
         :exception DeviceException: On failure releasing the device.
         """
         
-        self._sd.unmount()
-        self._sd.optimize_filesystems()
-        self._sd.check_filesystems()
+        with utils.trace_span('release', 'phase', device=self._sd.name):
+            self._sd.unmount()
+            self._sd.optimize_filesystems()
+            self._sd.check_filesystems()
     
     def read_partitions(self, filename):
         """
@@ -207,10 +292,195 @@ class SDCardInstaller(object):
         :exception SDCardInstallerError: On failure installing the components.
         """
         
+        with utils.trace_span('install_components', 'phase',
+                              device=self._sd.name):
+            try:
+                self._board.sd_install_components(self._sd)
+            except BoardError as e:
+                raise SDCardInstallerError(e)
+
+    def _read_bmap(self, image, bmap_file):
         try:
-            self._board.sd_install_components(self._sd)
-        except BoardError as e:
+            if os.path.isfile(bmap_file):
+                return read_bmap(bmap_file)
+            self._l.warning('No block map %s, mapping %s' % (bmap_file, image))
+            return create_bmap(image)
+        except BmapError as e:
             raise SDCardInstallerError(e)
+    
+    def _flash_checks(self, sd, image_size_b):
+        if sd.exists is False:
+            raise SDCardInstallerError('No disk on %s' % sd.name)
+        if sd.is_mounted:
+            if self._interactive:
+                ret = sd.confirmed_unmount()
+                if ret is False:
+                    raise SDCardInstallerError('User canceled')
+            else:
+                sd.unmount()
+        if sd.size_b < image_size_b:
+            raise SDCardInstallerError('Image of %s MB is too large to fit '
+                   'in %s' % (image_size_b >> 20, sd.name))
+    
+    def _flash_confirms(self, image):
+        if self._sd.confirm_size_gb(WARN_DEVICE_SIZE_GB) is False:
+            raise SDCardInstallerError('User canceled')
+        msg = ('You are about to flash %s into %s (all your data will be '
+               'lost)' % (image, self._sd.name))
+        confirmed = self._e.prompt_user(msg, WARN_COLOR)
+        if not confirmed:
+            raise SDCardInstallerError('User canceled')
+    
+    def _verify_range(self, bmap, offset, length, checksum):
+        cmd = ('sudo dd if=%s bs=%s iflag=skip_bytes,count_bytes skip=%s '
+               'count=%s 2>/dev/null | %s' % (self._sd.name, VERIFY_DD_BS,
+               offset, length, CHECKSUM_TOOLS[bmap.checksum_type]))
+        ret, output = self._e.check_output(cmd)
+        if self._dryrun:
+            return
+        if ret != 0 or output.split()[:1] != [checksum]:
+            raise SDCardInstallerError('Verification failed on %s at offset '
+                                       '%s' % (self._sd.name, offset))
+    
+    def flash(self, image, bmap_file='', verify=True, compare=False):
+        """
+        Flashes an image into the SD card, writing only the blocks mapped in
+        its block map (see :mod:`openfd.storage.bmap`) with the raw writer.
+        The unmapped blocks of the SD card are left untouched.
+        
+        Compressed images (i.e. `sd.img.xz`, see
+        :func:`tarball.is_compressed_image`) are decompressed on the fly
+        into the raw writer, without a temporary file. Without a block map
+        the zero blocks are skipped instead.
+        
+        :param image: Image file.
+        :param bmap_file: Block map of the image; by default the
+            (uncompressed) image name plus `.bmap`. If the file doesn't exist
+            the image is mapped on the fly, or for compressed images the
+            verification is skipped.
+        :param verify: Read back the written blocks and compare them against
+            the checksums in the block map.
+        :param compare: Read each block of the SD card first and write only
+            the blocks that differ from the image, i.e. when reflashing a
+            card that holds a previous build. Reads are faster than writes,
+            and wear the card less.
+        :exception SDCardInstallerError: On failure flashing or verifying.
+        """
+        
+        compressed = is_compressed_image(image)
+        bmap_file = bmap_file or uncompressed_name(image) + BMAP_EXTENSION
+        with utils.trace_span('flash', 'phase', device=self._sd.name,
+                              image=image) as span:
+            bmap = None
+            if not compressed or os.path.isfile(bmap_file):
+                bmap = self._read_bmap(image, bmap_file)
+            else:
+                self._l.warning('No block map %s, %s will not be verified' %
+                                (bmap_file, self._sd.name))
+            if not self.dryrun:
+                self._flash_checks(self._sd, bmap.image_size if bmap else 0)
+            if self._interactive:
+                self._flash_confirms(image)
+            # Without a block map file the image is written skipping its
+            # holes, which are the unmapped blocks of the generated map
+            bmap_arg = bmap_file if os.path.isfile(bmap_file) else ''
+            if compressed:
+                self._l.info('Flashing %s into %s (decompressing on the fly)'
+                             % (image, self._sd.name))
+                # The mapped blocks are written even if zeroed, so they
+                # verify; without a map all the zero blocks are skipped
+                ret = self._e.raw_write(self._sd.name, bmap_file=bmap_arg,
+                                        direct=True,
+                                        decompress=decompress_cmd(image),
+                                        skip_zeros=not bmap_arg,
+                                        compare=compare)
+            else:
+                self._l.info('Flashing %s into %s (%.1f MB mapped out of '
+                             '%.1f MB)' % (image, self._sd.name,
+                             bmap.mapped_size_b / float(1 << 20),
+                             bmap.image_size / float(1 << 20)))
+                ret = self._e.raw_write(self._sd.name, image,
+                                        sparse=not bmap_arg,
+                                        bmap_file=bmap_arg, direct=True,
+                                        compare=compare)
+            if ret != 0:
+                raise SDCardInstallerError('Failed writing %s into %s' %
+                                           (image, self._sd.name))
+            # Write the data to the card and drop it from the buffer cache,
+            # so the verification reads it back from the card
+            cmd = 'sudo blockdev --flushbufs %s' % self._sd.name
+            if self._e.check_call(cmd) != 0:
+                raise SDCardInstallerError('Failed flushing %s' %
+                                           self._sd.name)
+            if bmap:
+                span.args['bytes'] = bmap.mapped_size_b
+        if verify and bmap:
+            with utils.trace_span('verify', 'phase', device=self._sd.name):
+                self._l.info('Verifying %s' % self._sd.name)
+                for rng in bmap.ranges:
+                    offset, length = bmap.range_bytes(rng)
+                    self._verify_range(bmap, offset, length, rng.checksum)
+
+    def _duplicate_confirms(self, image, cards):
+        for sd in cards:
+            if sd.confirm_size_gb(WARN_DEVICE_SIZE_GB) is False:
+                raise SDCardInstallerError('User canceled')
+        msg = ('You are about to flash %s into %s (all their data will be '
+               'lost)' % (image, ', '.join(sd.name for sd in cards)))
+        confirmed = self._e.prompt_user(msg, WARN_COLOR)
+        if not confirmed:
+            raise SDCardInstallerError('User canceled')
+    
+    def duplicate(self, image, devices, bmap_file='',
+                  stall_timeout=DEFAULT_STALL_TIMEOUT):
+        """
+        Flashes an image into several SD cards at once (i.e. a production
+        batch) with the duplicator (see :mod:`openfd.utils.duplicator`): the
+        image is read once and written into all the cards in parallel. As
+        in :func:`flash`, only the blocks mapped in its block map are
+        written.
+        
+        A card that fails, or stalls for `stall_timeout` seconds, is dropped
+        without stopping the others; the throughput of each card is logged.
+        
+        :param image: Image file.
+        :param devices: Device names (i.e. ['/dev/sdb', '/dev/sdc']).
+        :param bmap_file: Block map of the image; by default the image name
+            plus `.bmap`. If the file doesn't exist the image is mapped
+            on the fly.
+        :param stall_timeout: Seconds a card can take to accept a buffer
+            before it is dropped.
+        :exception SDCardInstallerError: When a check fails before writing,
+            or when any of the cards failed.
+        """
+        
+        bmap_file = bmap_file or image + BMAP_EXTENSION
+        cards = []
+        for device in devices:
+            sd = SDCard(device)
+            sd.dryrun = self._dryrun
+            cards.append(sd)
+        with utils.trace_span('duplicate', 'phase', devices=len(cards),
+                              image=image) as span:
+            bmap = self._read_bmap(image, bmap_file)
+            if not self.dryrun:
+                for sd in cards:
+                    self._flash_checks(sd, bmap.image_size)
+            if self._interactive:
+                self._duplicate_confirms(image, cards)
+            self._l.info('Flashing %s into %s (%.1f MB mapped out of %.1f MB)'
+                         % (image, ', '.join(devices),
+                            bmap.mapped_size_b / float(1 << 20),
+                            bmap.image_size / float(1 << 20)))
+            bmap_arg = bmap_file if os.path.isfile(bmap_file) else ''
+            ret, results = self._e.duplicate(image, devices, bmap_arg,
+                                             stall_timeout)
+            span.args['bytes'] = bmap.mapped_size_b
+            failed = [device for device, size_b, secs, error in results
+                      if error] or devices
+            if ret != 0:
+                raise SDCardInstallerError('Failed writing %s into %s' %
+                                           (image, ', '.join(failed)))
 
 class LoopDeviceInstaller(object):
     """
@@ -224,20 +494,29 @@ class LoopDeviceInstaller(object):
         3. mount_partitions()
         4. install_components()
         5. release()
+        6. write_bmap() (optional)
+        7. report_image_usage() (optional)
     """
     
-    def __init__(self, board, dryrun=False):
+    def __init__(self, board, dryrun=False, rootless=False):
         """
         :param board: :class:`Board` instance.
         :param dryrun: Enable dryrun mode. Systems commands will be logged,
             but not executed.
         :type dryrun: boolean
+        :param rootless: Build the image without superuser access, using an
+            :class:`ImageDevice` instead of loop devices.
+        :type rootless: boolean
         """
         
         self._l = utils.logger.get_global_logger()
         self._e = utils.executer.get_global_executer()
+        self._e.rootless = rootless
         self._board = board
-        self._ld = LoopDevice()
+        if rootless:
+            self._ld = ImageDevice()
+        else:
+            self._ld = LoopDevice()
         self._dryrun = dryrun
         self._e.dryrun = dryrun
         self._ld.dryrun = dryrun
@@ -257,6 +536,29 @@ class LoopDeviceInstaller(object):
                      doc="""Enable dryrun mode. Systems commands will be
                      logged, but not executed.""")
     
+    def __set_partition_align_b(self, align_b):
+        self._ld.partition_align_b = align_b
+    
+    def __get_partition_align_b(self):
+        return self._ld.partition_align_b
+    
+    partition_align_b = property(__get_partition_align_b,
+                                 __set_partition_align_b,
+                                 doc="""Alignment of the partitions (bytes),
+                                 see :func:`Device.partition_align_b`.""")
+    
+    def __set_rootfs_dir(self, rootfs_dir):
+        self._ld.rootfs_dir = rootfs_dir
+    
+    def __get_rootfs_dir(self):
+        return self._ld.rootfs_dir
+    
+    rootfs_dir = property(__get_rootfs_dir, __set_rootfs_dir,
+                          doc="""Rootfs directory to create the rootfs
+                          partitions from at format time, instead of mounting
+                          them and copying the rootfs; see
+                          :func:`LoopDevice.rootfs_dir`.""")
+    
     def format(self, img_name, img_size_mb):
         """
         Creates and formats the partitions in the SD card.
@@ -265,13 +567,14 @@ class LoopDeviceInstaller(object):
         :exception DeviceException: On failure formatting the device. 
         """
         
-        if not self.dryrun:
-            self._ld.check_img_size(img_size_mb)
-        self._l.info('Formatting %s (this may take a while)' % self._ld.name)
-        self._ld.attach_device(img_name, img_size_mb)
-        self._ld.create_partitions()
-        self._ld.attach_partitions(img_name, img_size_mb)
-        self._ld.format_partitions()
+        with utils.trace_span('format', 'phase', device=img_name):
+            if not self.dryrun:
+                self._ld.check_img_size(img_size_mb)
+            self._l.info('Formatting %s (this may take a while)' % img_name)
+            self._ld.attach_device(img_name, img_size_mb)
+            self._ld.create_partitions()
+            self._ld.attach_partitions(img_name, img_size_mb)
+            self._ld.format_partitions()
     
     def mount_partitions(self, directory):
         """
@@ -280,7 +583,9 @@ class LoopDeviceInstaller(object):
         :exception DeviceException: When unable to mount.
         """
         
-        self._ld.mount(directory)
+        with utils.trace_span('mount_partitions', 'phase',
+                              device=self._ld.name):
+            self._ld.mount(directory)
 
     def install_components(self):
         """
@@ -289,10 +594,12 @@ class LoopDeviceInstaller(object):
         :exception LoopDeviceInstallerError: On failure installing the components.
         """
         
-        try:
-            self._board.ld_install_components(self._ld)
-        except BoardError as e:
-            raise LoopDeviceInstallerError(e)
+        with utils.trace_span('install_components', 'phase',
+                              device=self._ld.name):
+            try:
+                self._board.ld_install_components(self._ld)
+            except BoardError as e:
+                raise LoopDeviceInstallerError(e)
     
     def release(self):
         """
@@ -301,11 +608,83 @@ class LoopDeviceInstaller(object):
         :exception DeviceException: On failure releasing the device.
         """
         
-        self._ld.unmount()
-        self._ld.optimize_filesystems()
-        self._ld.check_filesystems()
-        self._ld.detach_partitions()
-        self._ld.detach_device()
+        with utils.trace_span('release', 'phase', device=self._ld.name):
+            self._ld.unmount()
+            self._ld.optimize_filesystems()
+            self._ld.check_filesystems()
+            self._ld.detach_partitions()
+            self._ld.detach_device()
+    
+    def write_bmap(self, img_name):
+        """
+        Writes the block map of the image next to it (the image name plus
+        `.bmap`), so it can be flashed writing only its mapped blocks.
+        
+        :param img_name: Image file.
+        :exception LoopDeviceInstallerError: When unable to map the image.
+        """
+        
+        bmap_file = img_name + BMAP_EXTENSION
+        self._l.info('Writing block map %s' % bmap_file)
+        if self._dryrun:
+            return
+        with utils.trace_span('bmap', 'phase', image=img_name):
+            try:
+                write_bmap(create_bmap(img_name), bmap_file)
+            except BmapError as e:
+                raise LoopDeviceInstallerError(e)
+    
+    def report_image_usage(self, img_name):
+        """
+        Logs the apparent size of the image against the disk space actually
+        allocated for it; both differ because the image is sparse.
+        
+        :param img_name: Image file.
+        """
+        
+        if self._dryrun:
+            return
+        try:
+            size_b, alloc_b = self._e.probe(utils.file_usage_b, img_name)
+        except utils.ProbeError as e:
+            self._l.warning(e)
+            return
+        self._l.info('Image %s: %.1f MB apparent size, %.1f MB allocated' %
+                     (img_name, size_b / float(1 << 20),
+                      alloc_b / float(1 << 20)))
+    
+    def compress_image(self, img_name, image_format):
+        """
+        Compresses the image in parallel chunks (see :mod:`compressor`),
+        writes the checksum of the compressed image next to it and removes
+        the raw image. Its block map, if any, is kept to flash the
+        compressed image.
+        
+        :param img_name: Image file.
+        :param image_format: Compression format, i.e. 'zstd'.
+        :returns: The compressed image file.
+        :exception LoopDeviceInstallerError: When unable to compress the
+            image.
+        """
+        
+        output = compressed_name(img_name, image_format)
+        self._l.info('Compressing %s into %s' % (img_name, output))
+        if self._dryrun:
+            return output
+        with utils.trace_span('compress', 'phase', image=img_name):
+            try:
+                compressor = ImageCompressor(img_name, image_format)
+                compressor.run()
+            except CompressorError as e:
+                raise LoopDeviceInstallerError(e)
+        os.remove(img_name)
+        ratio = compressor.bytes_in / float(max(compressor.bytes_out, 1))
+        self._l.info('Image %s: %.2f MB (%.0f:1) in %.1f s, %s chunks in '
+                     'holes; checksum in %s' %
+                     (output, compressor.bytes_out / float(1 << 20), ratio,
+                      compressor.elapsed, compressor.hole_chunks,
+                      compressor.checksum_file))
+        return output
     
     def read_partitions(self, filename):
         """
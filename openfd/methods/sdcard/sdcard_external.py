@@ -19,6 +19,7 @@
 # ==========================================================================
 
 import os
+import openfd.utils as utils
 from openfd.storage.partition import SDCardPartition
 from openfd.boards.board import BoardError
 from sdcard import SDCardInstaller
@@ -59,22 +60,17 @@ class SDCardExternalInstaller(SDCardInstaller):
                 uenv.write("%s\n" % env)
     
     def _install_files(self, files):
-        i = 1
         self._l.info("Copying files to SD card")
         for part in self._sd.partitions:
             for comp in part.components:
                 if comp == SDCardPartition.COMPONENT_BOOTLOADER:
-                    cmd = ('mount | grep %s | cut -f 3 -d " "' %
-                           self._sd.partition_name(i))
-                    output = self._e.check_output(cmd)[1]
-                    mnt_point = output.replace('\n', '')
+                    mnt_point = self._sd.mount_point(part)
                     for f in files:
                         cmd = "sudo cp %s %s" % (f, mnt_point)
                         ret = self._e.check_call(cmd)
                         if ret != 0:
                             raise SDCardInstallerError('Failed copying %s to %s'
                                                        % (f, mnt_point))
-            i += 1
     
     def _generate_script(self, mkimage, script, uboot_script):
         self._l.info("Installing uboot script")
@@ -100,8 +96,8 @@ class SDCardExternalInstaller(SDCardInstaller):
     
 class LoopDeviceExternalInstaller(LoopDeviceInstaller):
     
-    def __init__(self, board, dryrun=False):
-        LoopDeviceInstaller.__init__(self, board, dryrun)
+    def __init__(self, board, dryrun=False, rootless=False):
+        LoopDeviceInstaller.__init__(self, board, dryrun, rootless)
 
     def _install_uboot_env(self, uboot_env_file, uboot_script):
         self._l.info("Installing uboot environment")
@@ -118,9 +114,7 @@ class LoopDeviceExternalInstaller(LoopDeviceInstaller):
         for part in self._ld.partitions:
             for comp in part.components:
                 if comp == SDCardPartition.COMPONENT_BOOTLOADER:
-                    cmd = 'mount | grep %s | cut -f 3 -d " "' % part.device
-                    output = self._e.check_output(cmd)[1]
-                    mnt_point = output.replace('\n', '')
+                    mnt_point = self._ld.mount_point(part)
                     for f in files:
                         cmd = "sudo cp %s %s" % (f, mnt_point)
                         ret = self._e.check_call(cmd)
@@ -0,0 +1,386 @@
+#!/usr/bin/env python
+# ==========================================================================
+#
+# Copyright (C) 2013-2014 RidgeRun, LLC (http://www.ridgerun.com)
+#
+# Author: Jose Pablo Carballo <jose.carballo@ridgerun.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# Flashing station: flashes an image into every SD card plugged in.
+#
+# ==========================================================================
+
+"""
+The station module flashes an SD card image into every card plugged in,
+without operator interaction between cards:
+
+ * The block devices are scanned periodically (see `/sys/block`). Only the
+   devices that appear (or get media) after the station started are
+   considered; the ones already present are ignored.
+ * Each new device is checked against a :class:`StationRule` (device name,
+   size range, vendor/model, removable), so system disks are never touched.
+ * Accepted devices are flashed with :func:`SDCardInstaller.flash`, several
+   at a time. A status table is logged whenever a card changes state.
+ * Removing a card frees its place in the table; plugging it in again
+   flashes it again.
+"""
+
+# ==========================================================================
+# Imports
+# ==========================================================================
+
+import os
+import time
+import fnmatch
+import threading
+import openfd.utils as utils
+from openfd.storage.device import SDCard
+from openfd.storage.device import DeviceException
+from openfd.storage.bmap import BmapError
+from openfd.storage.bmap import create_bmap
+from openfd.storage.bmap import write_bmap
+from openfd.utils.tarball import is_compressed_image
+from openfd.utils.tarball import uncompressed_name
+from sdcard import SDCardInstaller
+from sdcard import SDCardInstallerError
+from sdcard import BMAP_EXTENSION
+from sdcard import WARN_DEVICE_SIZE_GB
+
+# ==========================================================================
+# Constants
+# ==========================================================================
+
+#: Seconds between scans of the block devices.
+SCAN_INTERVAL = 1.0
+
+#: Seconds between status tables while cards are being flashed.
+STATUS_INTERVAL = 10.0
+
+#: Cards flashed at a time by default.
+DEFAULT_JOBS = 4
+
+#: Device names accepted by default: SCSI/USB disks and MMC cards.
+DEFAULT_NAME_PATTERNS = ['sd*', 'mmcblk*']
+
+# Job states
+JOB_QUEUED = 'queued'
+JOB_FLASHING = 'flashing'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+JOB_REJECTED = 'rejected'
+
+# ==========================================================================
+# Public Classes
+# ==========================================================================
+
+class StationError(Exception):
+    """Exceptions for FlashStation"""
+
+class StationRule(object):
+    """
+    Allow-list rule for the devices flashed by the :class:`FlashStation`.
+    """
+
+    def __init__(self, name_patterns=None, min_size_gb=0,
+                 max_size_gb=WARN_DEVICE_SIZE_GB, vendor='', model='',
+                 removable_only=True):
+        """
+        :param name_patterns: Accepted device names, shell-style patterns
+            matched against the kernel name (i.e. 'sd*'); by default
+            :const:`DEFAULT_NAME_PATTERNS`.
+        :param min_size_gb: Minimum device size (gigabytes).
+        :param max_size_gb: Maximum device size (gigabytes).
+        :param vendor: Text the vendor of the device must contain (case
+            insensitive), i.e. 'Generic'.
+        :param model: Text the model of the device must contain (case
+            insensitive), i.e. 'SD/MMC'; the name, for MMC cards.
+        :param removable_only: Accept only removable devices.
+        """
+
+        self.name_patterns = name_patterns or DEFAULT_NAME_PATTERNS
+        self.min_size_gb = min_size_gb
+        self.max_size_gb = max_size_gb
+        self.vendor = vendor
+        self.model = model
+        self.removable_only = removable_only
+
+    def reject_reason(self, device, size_gb, removable, vendor, model):
+        """
+        Checks a device against the rule.
+
+        :param device: Device name (i.e. '/dev/sdb').
+        :param size_gb: Device size (gigabytes).
+        :param removable: True if the device is removable.
+        :param vendor: Vendor of the device.
+        :param model: Model of the device.
+        :returns: Why the device is rejected; empty if it's accepted.
+        """
+
+        name = device.split('/')[-1]
+        if not [p for p in self.name_patterns if fnmatch.fnmatch(name, p)]:
+            return 'name not in %s' % ', '.join(self.name_patterns)
+        if self.removable_only and not removable:
+            return 'not removable'
+        if size_gb < self.min_size_gb or size_gb > self.max_size_gb:
+            return ('%s GB out of %s-%s GB' % (size_gb, self.min_size_gb,
+                                               self.max_size_gb))
+        for field, value, text in [('vendor', vendor, self.vendor),
+                                   ('model', model, self.model)]:
+            if text and text.lower() not in value.lower():
+                return "%s '%s' doesn't match '%s'" % (field, value, text)
+        return ''
+
+class StationJob(object):
+    """A card handled by the :class:`FlashStation`."""
+
+    def __init__(self, device, size_b=0, vendor='', model=''):
+        self.device = device
+        self.size_b = size_b
+        self.vendor = vendor
+        self.model = model
+        self.state = JOB_QUEUED
+        self.message = ''
+        self.start_time = None
+        self.end_time = None
+
+    @property
+    def description(self):
+        """Vendor and model of the card, i.e. 'Generic SD/MMC'."""
+
+        return ' '.join(t for t in [self.vendor, self.model] if t)
+
+    @property
+    def elapsed(self):
+        """Seconds spent flashing the card."""
+
+        if self.start_time is None:
+            return 0
+        return (self.end_time or time.time()) - self.start_time
+
+class FlashStation(object):
+    """
+    Flashes an image into every SD card plugged in, see :mod:`station`.
+    Usage:
+    ::
+        station = FlashStation(board, 'sd.img', rule=StationRule())
+        station.run()
+    """
+
+    def __init__(self, board, image, bmap_file='', rule=None,
+                 jobs=DEFAULT_JOBS, verify=True, dryrun=False):
+        """
+        :param board: :class:`Board` instance.
+        :param image: Image file.
+        :param bmap_file: Block map of the image; by default the
+            (uncompressed) image name plus `.bmap`. If the file doesn't exist
+            it's created, except for compressed images.
+        :param rule: :class:`StationRule` for the devices to flash; by
+            default removable SD/MMC devices up to
+            :const:`WARN_DEVICE_SIZE_GB`.
+        :param jobs: Cards flashed at a time.
+        :param verify: Read back and verify each card after flashing it.
+        :param dryrun: Enable dryrun mode. Systems commands will be logged,
+            but not executed.
+        """
+
+        self._l = utils.logger.get_global_logger()
+        self._e = utils.executer.get_global_executer()
+        self._board = board
+        self._image = image
+        self._bmap_file = (bmap_file or uncompressed_name(image) +
+                           BMAP_EXTENSION)
+        self._rule = rule or StationRule()
+        self._jobs = jobs
+        self._verify = verify
+        self._dryrun = dryrun
+        self._table = {}
+        self._lock = threading.Lock()
+        self._changed = threading.Event()
+        self._flashed = 0
+
+    @property
+    def jobs(self):
+        """List of :class:`StationJob`, the cards currently plugged in."""
+
+        with self._lock:
+            return [self._table[d] for d in sorted(self._table)]
+
+    @property
+    def flashed(self):
+        """Number of cards flashed successfully."""
+
+        return self._flashed
+
+    def _media(self):
+        # Devices with media, the empty card readers have size 0
+        devices = []
+        for device in self._e.probe(utils.block_devices):
+            try:
+                if self._e.probe(utils.device_size_b, device) > 0:
+                    devices.append(device)
+            except utils.ProbeError:
+                continue
+        return devices
+
+    def _new_job(self, device):
+        sd = SDCard(device)
+        sd.dryrun = self._dryrun
+        job = StationJob(device)
+        if not sd.exists:
+            job.state = JOB_REJECTED
+            job.message = 'no media'
+            return job
+        job.vendor = self._e.probe(utils.device_vendor, device)
+        job.model = self._e.probe(utils.device_model, device)
+        try:
+            job.size_b = sd.size_b
+            reason = self._rule.reject_reason(device, sd.size_gb,
+                                              sd.info.removable, job.vendor,
+                                              job.model)
+        except DeviceException as e:
+            # I.e. the card was pulled out while probing it
+            reason = str(e)
+        if reason:
+            job.state = JOB_REJECTED
+            job.message = reason
+        return job
+
+    def _flash(self, job):
+        state, message = JOB_FAILED, ''
+        try:
+            installer = SDCardInstaller(board=self._board, device=job.device,
+                                        dryrun=self._dryrun,
+                                        interactive=False)
+            installer.flash(self._image, self._bmap_file, self._verify)
+            state = JOB_DONE
+        except (SDCardInstallerError, DeviceException) as e:
+            message = str(e)
+        except Exception as e:
+            # Any other failure fails this card only, not the station
+            message = 'Unexpected error: %s' % (str(e) or
+                                                 e.__class__.__name__)
+        finally:
+            # The jobs are shared with the scanning loop
+            with self._lock:
+                job.state = state
+                job.message = message
+                job.end_time = time.time()
+                if state == JOB_DONE:
+                    self._flashed += 1
+            self._changed.set()
+
+    def _running(self):
+        with self._lock:
+            return [j for j in self._table.values()
+                    if j.state == JOB_FLASHING]
+
+    def _start_jobs(self, count):
+        started = []
+        with self._lock:
+            running = len([j for j in self._table.values()
+                           if j.state == JOB_FLASHING])
+            free = self._jobs - running
+            if count:
+                free = min(free, count - self._flashed - running)
+            for device in sorted(self._table):
+                job = self._table[device]
+                if free <= 0:
+                    break
+                if job.state != JOB_QUEUED:
+                    continue
+                job.state = JOB_FLASHING
+                job.start_time = time.time()
+                started.append(job)
+                free -= 1
+        for job in started:
+            thread = threading.Thread(target=self._flash, args=(job,))
+            thread.daemon = True
+            thread.start()
+            self._changed.set()
+
+    def _scan(self, ignored):
+        media = self._media()
+        with self._lock:
+            for device in self._table.keys():
+                job = self._table[device]
+                if device not in media and job.state != JOB_FLASHING:
+                    # Removed, a card in the same slot is a new card
+                    del self._table[device]
+                    self._l.info('%s removed' % device)
+                    self._changed.set()
+        for device in media:
+            if device in ignored or device in self._table:
+                continue
+            job = self._new_job(device)
+            with self._lock:
+                self._table[device] = job
+            if job.state == JOB_REJECTED:
+                self._l.info('Ignoring %s: %s' % (device, job.message))
+            else:
+                self._l.info('%s plugged in (%s, %.1f GB)' %
+                             (device, job.description or 'unknown model',
+                              job.size_b / float(1 << 30)))
+            self._changed.set()
+        # Devices present at startup are ignored until removed
+        for device in list(ignored):
+            if device not in media:
+                ignored.remove(device)
+
+    def log_status(self):
+        """
+        Logs a table with the cards plugged in and their state.
+        """
+
+        with self._lock:
+            rows = [('%-14s %-24s %4.1f GB  %-9s %4d s  %s' %
+                     (job.device, job.description[:24], job.size_b / float(1 << 30),
+                      job.state, job.elapsed, job.message)).rstrip()
+                    for job in [self._table[d] for d in sorted(self._table)]]
+            flashed = self._flashed
+        self._l.info('%-14s %-24s %7s  %-9s %6s' %
+                     ('Device', 'Model', 'Size', 'State', 'Time'))
+        for row in rows:
+            self._l.info(row)
+        self._l.info('%s cards flashed' % flashed)
+
+    def _prepare_bmap(self):
+        # Mapped once here, instead of once per card by flash()
+        if (self._dryrun or os.path.isfile(self._bmap_file) or
+            is_compressed_image(self._image)):
+            return
+        self._l.info('Mapping %s into %s' % (self._image, self._bmap_file))
+        try:
+            write_bmap(create_bmap(self._image), self._bmap_file)
+        except BmapError as e:
+            raise StationError(e)
+
+    def run(self, count=0):
+        """
+        Flashes the cards plugged in until interrupted, or until `count`
+        cards are flashed.
+
+        :param count: Cards to flash; 0 to run until interrupted.
+        :exception StationError: When unable to map the image.
+        """
+
+        self._prepare_bmap()
+        ignored = set(self._media())
+        if ignored:
+            self._l.info('Ignoring the devices already present: %s' %
+                         ', '.join(sorted(ignored)))
+        self._l.info('Waiting for SD cards (%s at a time)' % self._jobs)
+        last_status = time.time()
+        while True:
+            self._scan(ignored)
+            self._start_jobs(count)
+            if (self._changed.is_set() or (self._running() and
+                time.time() - last_status > STATUS_INTERVAL)):
+                self._changed.clear()
+                self.log_status()
+                last_status = time.time()
+            if count and self._flashed >= count and not self._running():
+                break
+            self._changed.wait(SCAN_INTERVAL)
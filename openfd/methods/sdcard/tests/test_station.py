@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# ==========================================================================
+#
+# Copyright (C) 2013-2014 RidgeRun, LLC (http://www.ridgerun.com)
+#
+# Author: Jose Pablo Carballo <jose.carballo@ridgerun.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# Tests for the flashing station.
+#
+# ==========================================================================
+
+import os, sys
+import unittest
+
+sys.path.insert(1, os.path.abspath('..'))
+
+import openfd.utils as utils
+import openfd.methods.sdcard.station as station
+from openfd.methods.sdcard.station import StationRule
+from openfd.methods.sdcard.station import StationJob
+from openfd.methods.sdcard.station import FlashStation
+from openfd.storage.device import DeviceException
+
+class PulledCard(object):
+    """SD card removed while probing it."""
+
+    def __init__(self, device):
+        self.dryrun = False
+        self.exists = True
+
+    @property
+    def size_b(self):
+        raise DeviceException('Unable to obtain the size for /dev/sdb')
+
+class BrokenInstaller(object):
+    """Installer failing with an unexpected exception."""
+
+    def __init__(self, **kwargs):
+        pass
+
+    def flash(self, image, bmap_file, verify):
+        raise KeyError('bmap')
+
+class StationRuleTestCase(unittest.TestCase):
+
+    def test_default(self):
+        rule = StationRule()
+        self.assertEqual(rule.reject_reason('/dev/sdb', 8, True, 'Generic',
+                                            'SD/MMC'), '')
+        self.assertEqual(rule.reject_reason('/dev/mmcblk0', 16, True, '',
+                                            'SD16G'), '')
+        self.assertEqual(rule.reject_reason('/dev/sda', 256, False, 'ATA',
+                                            'SSD'), 'not removable')
+        self.assertEqual(rule.reject_reason('/dev/sdc', 1024, True, '', ''),
+                         '1024 GB out of 0-128 GB')
+        self.assertEqual(rule.reject_reason('/dev/loop0', 1, False, '', ''),
+                         'name not in sd*, mmcblk*')
+
+    def test_loop_stand_ins(self):
+        rule = StationRule(['loop*'], removable_only=False)
+        self.assertEqual(rule.reject_reason('/dev/loop3', 0, False, '', ''),
+                         '')
+        self.assertNotEqual(rule.reject_reason('/dev/sdb', 8, True, '', ''),
+                            '')
+
+    def test_model(self):
+        rule = StationRule(min_size_gb=4, max_size_gb=32, vendor='generic',
+                           model='sd/mmc')
+        self.assertEqual(rule.reject_reason('/dev/sdb', 8, True, 'Generic',
+                                            'STORAGE DEVICE SD/MMC'), '')
+        self.assertEqual(rule.reject_reason('/dev/sdb', 8, True, 'Kingston',
+                                            'SD/MMC'),
+                         "vendor 'Kingston' doesn't match 'generic'")
+        self.assertEqual(rule.reject_reason('/dev/sdb', 2, True, 'Generic',
+                                            'SD/MMC'),
+                         '2 GB out of 4-32 GB')
+
+    def test_vendor_and_model_fields(self):
+        # Each text is matched against its own field only
+        rule = StationRule(vendor='generic', model='sd/mmc')
+        self.assertEqual(rule.reject_reason('/dev/sdb', 8, True, 'SD/MMC',
+                                            'Generic'),
+                         "vendor 'SD/MMC' doesn't match 'generic'")
+        self.assertEqual(rule.reject_reason('/dev/sdb', 8, True, 'Generic',
+                                            'Generic'),
+                         "model 'Generic' doesn't match 'sd/mmc'")
+
+class FlashStationTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        utils.logger.init_global_logger('Station')
+        utils.executer.init_global_executer(enable_colors=False)
+
+    def setUp(self):
+        self.sdcard = station.SDCard
+        self.installer = station.SDCardInstaller
+        self.station = FlashStation(None, 'sd.img', rule=StationRule())
+
+    def tearDown(self):
+        station.SDCard = self.sdcard
+        station.SDCardInstaller = self.installer
+
+    def test_pulled_card(self):
+        station.SDCard = PulledCard
+        job = self.station._new_job('/dev/sdb')
+        self.assertEqual(job.state, station.JOB_REJECTED)
+        self.assertEqual(job.message,
+                         'Unable to obtain the size for /dev/sdb')
+
+    def test_unexpected_error(self):
+        station.SDCardInstaller = BrokenInstaller
+        job = StationJob('/dev/sdb')
+        job.state = station.JOB_FLASHING
+        self.station._flash(job)
+        self.assertEqual(job.state, station.JOB_FAILED)
+        self.assertEqual(job.message, "Unexpected error: 'bmap'")
+        self.assertNotEqual(job.end_time, None)
+        self.assertEqual(self.station.flashed, 0)
+
+if __name__ == '__main__':
+    unittest.main()
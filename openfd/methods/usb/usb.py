@@ -131,10 +131,8 @@ class USBInstaller(object):
         for part in self._usb.partitions:
             for comp in part.components:
                 if comp == USBPartition.COMPONENT_BOOTLOADER:
-                    cmd = ('mount | grep %s | cut -f 3 -d " "' %
-                           self._usb.partition_name(i))
-                    output = self._e.check_output(cmd)[1]
-                    mnt_point = output.replace('\n', '')
+                    mnt_point = self._e.probe(utils.device_mount_point,
+                                              self._usb.partition_name(i))
                     for f in files:
                         cmd = "sudo cp %s %s" % (f, mnt_point)
                         ret = self._e.check_call(cmd)
@@ -159,7 +157,9 @@ class USBInstaller(object):
         :exception DeviceException: When unable to mount.
         """
         
-        self._usb.mount(directory)
+        with utils.trace_span('mount_partitions', 'phase',
+                              device=self._usb.name):
+            self._usb.mount(directory)
 
     def _format_checks(self):
         if self._usb.exists is False:
@@ -195,13 +195,14 @@ class USBInstaller(object):
         :exception USBInstallerError: On failure executing this action. 
         """
         
-        if not self.dryrun:
-            self._format_checks()
-        if self._interactive:
-            self._format_confirms()
-        self._l.info('Formatting %s (this may take a while)' % self._usb.name)
-        self._usb.create_partitions()
-        self._usb.format_partitions()
+        with utils.trace_span('format', 'phase', device=self._usb.name):
+            if not self.dryrun:
+                self._format_checks()
+            if self._interactive:
+                self._format_confirms()
+            self._l.info('Formatting %s (this may take a while)' % self._usb.name)
+            self._usb.create_partitions()
+            self._usb.format_partitions()
 
     def release(self):
         """
@@ -225,11 +226,13 @@ class USBInstaller(object):
         self._usb.read_partitions(filename)
     
     def install_components(self, workdir, imgs, mkimage, script):
-        uboot_script = "%s.scr" % os.path.splitext(script)[0]
-        self._generate_script(mkimage, script, uboot_script)
-        uboot_env = "%s/uEnv.txt" % workdir
-        self._install_uboot_env(uboot_env, uboot_script)
-        files = []
-        files += imgs
-        files += [script, uboot_script, uboot_env]
-        self._install_files(files)
+        with utils.trace_span('install_components', 'phase',
+                              device=self._usb.name):
+            uboot_script = "%s.scr" % os.path.splitext(script)[0]
+            self._generate_script(mkimage, script, uboot_script)
+            uboot_env = "%s/uEnv.txt" % workdir
+            self._install_uboot_env(uboot_env, uboot_script)
+            files = []
+            files += imgs
+            files += [script, uboot_script, uboot_env]
+            self._install_files(files)
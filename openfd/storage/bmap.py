@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+# ==========================================================================
+#
+# Copyright (C) 2013-2014 RidgeRun, LLC (http://www.ridgerun.com)
+#
+# Author: Jose Pablo Carballo <jose.carballo@ridgerun.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# Block maps (bmap) of sparse images.
+#
+# ==========================================================================
+
+"""
+The bmap module creates and reads block maps of sparse images: the ranges of
+blocks that hold data, each one with its checksum. Flashing an image using its
+block map writes only the mapped ranges, skipping the (usually large) unused
+areas of the image.
+
+The files use the XML format of `bmaptool` (version 2.0), so both tools can
+consume each other's block maps:
+::
+    <?xml version="1.0" ?>
+    <bmap version="2.0">
+        <ImageSize> 268435456 </ImageSize>
+        <BlockSize> 4096 </BlockSize>
+        <BlocksCount> 65536 </BlocksCount>
+        <MappedBlocksCount> 1282 </MappedBlocksCount>
+        <ChecksumType> sha256 </ChecksumType>
+        <BmapFileChecksum> 4a1c...e03b </BmapFileChecksum>
+        <BlockMap>
+            <Range chksum="9f2e...77a0"> 0-261 </Range>
+            ...
+        </BlockMap>
+    </bmap>
+"""
+
+# ==========================================================================
+# Imports
+# ==========================================================================
+
+import os
+import hashlib
+import xml.etree.ElementTree as ElementTree
+import openfd.utils.fileutils as fileutils
+
+# ==========================================================================
+# Constants
+# ==========================================================================
+
+BMAP_VERSION = '2.0'
+
+#: Default block size (bytes).
+DEFAULT_BLOCK_SIZE = 4096
+
+#: Default checksum type.
+DEFAULT_CHECKSUM_TYPE = 'sha256'
+
+#: Checksum types and their command line tools.
+CHECKSUM_TOOLS = {'sha256': 'sha256sum', 'sha1': 'sha1sum'}
+
+# ==========================================================================
+# Public Classes
+# ==========================================================================
+
+class BmapError(Exception):
+    """Bmap exceptions."""
+
+class BmapRange(object):
+    """A range of mapped blocks, inclusive."""
+
+    def __init__(self, first, last, checksum=''):
+        """
+        :param first: First block of the range.
+        :param last: Last block of the range.
+        :param checksum: Checksum of the data in the range.
+        """
+
+        self.first = first
+        self.last = last
+        self.checksum = checksum
+
+    @property
+    def blocks(self):
+        """Number of blocks in the range."""
+
+        return self.last - self.first + 1
+
+class Bmap(object):
+    """Block map of an image."""
+
+    def __init__(self, image_size, block_size=DEFAULT_BLOCK_SIZE,
+                 checksum_type=DEFAULT_CHECKSUM_TYPE):
+        """
+        :param image_size: Image size (bytes).
+        :param block_size: Block size (bytes).
+        :param checksum_type: Checksum type of the ranges, i.e. 'sha256'.
+        """
+
+        self.image_size = image_size
+        self.block_size = block_size
+        self.checksum_type = checksum_type
+        self.ranges = []
+
+    @property
+    def blocks_count(self):
+        """Number of blocks in the image."""
+
+        return (self.image_size + self.block_size - 1) // self.block_size
+
+    @property
+    def mapped_blocks(self):
+        """Number of mapped blocks."""
+
+        return sum([r.blocks for r in self.ranges])
+
+    @property
+    def mapped_size_b(self):
+        """Size of the mapped data (bytes)."""
+
+        return sum([self.range_bytes(r)[1] for r in self.ranges])
+
+    def range_bytes(self, rng):
+        """
+        Returns the offset and length (bytes) of a range in the image; the last
+        range is clipped to the image size.
+
+        :param rng: :class:`BmapRange` instance.
+        """
+
+        offset = rng.first * self.block_size
+        end = min((rng.last + 1) * self.block_size, self.image_size)
+        return offset, end - offset
+
+# ==========================================================================
+# Functions
+# ==========================================================================
+
+def checksum(f, offset, length, checksum_type=DEFAULT_CHECKSUM_TYPE):
+    """
+    Returns the hex checksum of a region of a file.
+
+    :param f: File object, opened for reading in binary mode.
+    :param offset: Offset of the region.
+    :param length: Length of the region (bytes).
+    :param checksum_type: Checksum type, i.e. 'sha256'.
+    """
+
+    h = hashlib.new(checksum_type)
+    f.seek(offset)
+    while length > 0:
+        data = f.read(min(length, fileutils.COPY_CHUNK_SIZE))
+        if not data:
+            break
+        h.update(data)
+        length -= len(data)
+    return h.hexdigest()
+
+def create_bmap(image, block_size=DEFAULT_BLOCK_SIZE,
+                checksum_type=DEFAULT_CHECKSUM_TYPE):
+    """
+    Creates the block map of an image, mapping the blocks that hold data
+    according to the filesystem (holes are unmapped).
+
+    :param image: Image file.
+    :param block_size: Block size (bytes).
+    :param checksum_type: Checksum type, i.e. 'sha256'.
+    :returns: A :class:`Bmap` instance.
+    :exception BmapError: When unable to read the image.
+    """
+
+    try:
+        with open(image, 'rb') as f:
+            size_b = os.fstat(f.fileno()).st_size
+            bmap = Bmap(size_b, block_size, checksum_type)
+            for offset, length in fileutils.data_segments(f.fileno(), size_b):
+                first = offset // block_size
+                last = (offset + length - 1) // block_size
+                prev = bmap.ranges[-1] if bmap.ranges else None
+                if prev and first <= prev.last + 1:
+                    # Segments sharing or touching a block are merged
+                    prev.last = max(prev.last, last)
+                else:
+                    bmap.ranges.append(BmapRange(first, last))
+            for rng in bmap.ranges:
+                offset, length = bmap.range_bytes(rng)
+                rng.checksum = checksum(f, offset, length, checksum_type)
+    except (IOError, OSError) as e:
+        raise BmapError('Unable to map %s: %s' % (image, e))
+    return bmap
+
+def _bmap_xml(bmap, file_checksum):
+    lines = ['<?xml version="1.0" ?>',
+             '<!-- Block map of an image: the ranges of blocks that hold',
+             '     data, with their checksums. -->',
+             '<bmap version="%s">' % BMAP_VERSION,
+             '    <ImageSize> %d </ImageSize>' % bmap.image_size,
+             '    <BlockSize> %d </BlockSize>' % bmap.block_size,
+             '    <BlocksCount> %d </BlocksCount>' % bmap.blocks_count,
+             '    <MappedBlocksCount> %d </MappedBlocksCount>' %
+                 bmap.mapped_blocks,
+             '    <ChecksumType> %s </ChecksumType>' % bmap.checksum_type,
+             '    <BmapFileChecksum> %s </BmapFileChecksum>' % file_checksum,
+             '    <BlockMap>']
+    for rng in bmap.ranges:
+        if rng.first == rng.last:
+            blocks = '%d' % rng.first
+        else:
+            blocks = '%d-%d' % (rng.first, rng.last)
+        lines.append('        <Range chksum="%s"> %s </Range>' %
+                     (rng.checksum, blocks))
+    lines += ['    </BlockMap>', '</bmap>', '']
+    return '\n'.join(lines)
+
+def _zero_checksum(checksum_type):
+    return '0' * hashlib.new(checksum_type).digest_size * 2
+
+def write_bmap(bmap, filename):
+    """
+    Writes a block map to a file. The file checksum is computed, as
+    `bmaptool` does, with the checksum field filled with zeros.
+
+    :param bmap: :class:`Bmap` instance.
+    :param filename: Output file.
+    :exception BmapError: When unable to write the file.
+    """
+
+    data = _bmap_xml(bmap, _zero_checksum(bmap.checksum_type))
+    file_checksum = hashlib.new(bmap.checksum_type, data).hexdigest()
+    try:
+        with open(filename, 'w') as f:
+            f.write(_bmap_xml(bmap, file_checksum))
+    except IOError as e:
+        raise BmapError('Unable to write %s: %s' % (filename, e))
+
+def _text(root, tag, filename):
+    node = root.find(tag)
+    if node is None or node.text is None:
+        raise BmapError('Missing %s in %s' % (tag, filename))
+    return node.text.strip()
+
+def read_bmap(filename):
+    """
+    Reads a block map from a file, verifying the file checksum if present.
+
+    :param filename: Block map file.
+    :returns: A :class:`Bmap` instance.
+    :exception BmapError: When the file is unreadable, invalid or corrupt.
+    """
+
+    try:
+        with open(filename) as f:
+            data = f.read()
+        root = ElementTree.fromstring(data)
+    except (IOError, ElementTree.ParseError) as e:
+        raise BmapError('Unable to read %s: %s' % (filename, e))
+    version = root.get('version', '')
+    if root.tag != 'bmap' or version.split('.')[0] not in ['1', '2']:
+        raise BmapError('Unsupported block map version in %s' % filename)
+    # Version 1 block maps always use sha1
+    checksum_type = 'sha1'
+    if root.find('ChecksumType') is not None:
+        checksum_type = _text(root, 'ChecksumType', filename)
+    if checksum_type not in CHECKSUM_TOOLS:
+        raise BmapError('Unsupported checksum type %s in %s' %
+                        (checksum_type, filename))
+    try:
+        bmap = Bmap(int(_text(root, 'ImageSize', filename)),
+                    int(_text(root, 'BlockSize', filename)), checksum_type)
+        block_map = root.find('BlockMap')
+        if block_map is None:
+            raise BmapError('Missing BlockMap in %s' % filename)
+        for node in block_map:
+            blocks = node.text.strip().split('-')
+            first = int(blocks[0])
+            last = int(blocks[-1])
+            bmap.ranges.append(BmapRange(first, last, node.get('chksum', '')))
+    except (ValueError, AttributeError):
+        raise BmapError('Invalid block map in %s' % filename)
+    if root.find('BmapFileChecksum') is not None:
+        file_checksum = _text(root, 'BmapFileChecksum', filename)
+        zeroed = data.replace(file_checksum, _zero_checksum(checksum_type), 1)
+        if hashlib.new(checksum_type, zeroed).hexdigest() != file_checksum:
+            raise BmapError('Block map %s is corrupt (checksum mismatch)' %
+                            filename)
+    return bmap
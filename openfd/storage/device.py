@@ -19,7 +19,14 @@
 
 import os
 import math
+import shutil
+import tempfile
 import openfd.utils as utils
+import openfd.utils.fileutils as fileutils
+import mbr
+import fat
+import mkfs
+import layout
 from partition import SDCardPartition
 from partition import read_sdcard_partitions
 from partition import read_loopdevice_partitions
@@ -33,6 +40,24 @@ from partition import read_usb_partitions
 class DeviceException(Exception):
     pass
 
+class DeviceInfo(object):
+    """Size and sector sizes of a device, see :func:`Device.info`."""
+    
+    def __init__(self, size_b=0, logical_sector_size=512,
+                 physical_sector_size=512, removable=False):
+        """
+        :param size_b: Device size (bytes).
+        :param logical_sector_size: Logical sector size (bytes), the unit
+            used to address the device.
+        :param physical_sector_size: Physical sector size (bytes).
+        :param removable: True if the device has removable media.
+        """
+        
+        self.size_b = long(size_b)
+        self.logical_sector_size = int(logical_sector_size)
+        self.physical_sector_size = int(physical_sector_size)
+        self.removable = removable
+
 class SDCardGeometry(object):
     """Geometry for a given device."""
     
@@ -51,6 +76,15 @@ class SDCardGeometry(object):
     #: String used to represent the max available size of a given storage device.
     full_size = "-"
     
+    def set_sector_byte_size(self, sector_byte_size):
+        """
+        Sets the sector byte size (i.e. the logical sector size of the
+        device), which also scales the cylinder byte size.
+        """
+        
+        self.sector_byte_size = float(sector_byte_size)
+        self.cyl_byte_size = self.heads * self.sectors * self.sector_byte_size
+    
     def mb_to_cyl(self, size_mb):
         size_b = int(size_mb) << 20
         size_cyl = size_b / self.cyl_byte_size
@@ -74,6 +108,15 @@ class USBGeometry(object):
     #: String used to represent the max available size of a given storage device.
     full_size = "-"
     
+    def set_sector_byte_size(self, sector_byte_size):
+        """
+        Sets the sector byte size (i.e. the logical sector size of the
+        device), which also scales the cylinder byte size.
+        """
+        
+        self.sector_byte_size = float(sector_byte_size)
+        self.cyl_byte_size = self.heads * self.sectors * self.sector_byte_size
+    
     def mb_to_cyl(self, size_mb):
         size_b = int(size_mb) << 20
         size_cyl = size_b / self.cyl_byte_size
@@ -102,7 +145,11 @@ class Device(object):
         """
         
         self._device = device
-        self._size_b = 0
+        self._info = None
+        self._geometry = None
+        self._layout = None
+        self._wipe_method = utils.WIPE_AUTO
+        self._partition_align_b = layout.DEFAULT_ALIGNMENT_B
         self._l = utils.logger.get_global_logger()
         self._e = utils.executer.get_global_executer()
         self._e.dryrun = dryrun
@@ -138,10 +185,243 @@ class Device(object):
     geometry = property(__get_geometry, __set_geometry,
                       doc=""":class:`DeviceGeometry` instance.""")
 
+    def __set_wipe_method(self, method):
+        self._wipe_method = method
+        
+    def __get_wipe_method(self):
+        return self._wipe_method
+    
+    wipe_method = property(__get_wipe_method, __set_wipe_method,
+                      doc="""Method used to wipe raw data from the device,
+                      one of :const:`openfd.utils.rawwriter.WIPE_METHODS`;
+                      'auto' by default.""")
+
+    def __set_partition_align_b(self, align_b):
+        self._partition_align_b = align_b
+        
+    def __get_partition_align_b(self):
+        return self._partition_align_b
+    
+    partition_align_b = property(__get_partition_align_b,
+                      __set_partition_align_b,
+                      doc="""Alignment of the partitions (bytes), 4 MB by
+                      default; 0 for the legacy cylinder layout (see
+                      :mod:`layout`).""")
+
+    def _plan_layout(self, total_sectors):
+        planner = layout.LayoutPlanner(self.geometry, self._partition_align_b)
+        try:
+            plan = planner.plan(self._partitions, total_sectors)
+        except layout.LayoutError as e:
+            raise DeviceException('Unable to partition %s: %s' %
+                                  (self.name, e))
+        for part, (start, size) in zip(self._partitions, plan.partitions):
+            self._l.debug('  %s: start sector %s, %s sectors' %
+                          (part.name, start, size if size is not None else
+                           'rest of the device'))
+        if plan.alignment_b and plan.total_sectors:
+            self._l.info('Partitions aligned to %s KB, %.1f MB unused' %
+                         (plan.alignment_b >> 10,
+                          plan.unused_b / float(1 << 20)))
+        return plan
+
+    def _sfdisk_sectors_cmd(self, plan):
+        cmd = ('sudo ' + Device.SDK_SFDISK_PATH + ' -uS ' + self.name +
+               ' << EOF\n')
+        for part, (start, size) in zip(self._partitions, plan.partitions):
+            # No size takes the rest of the device
+            cmd += '%s,%s,%s' % (start, size if size is not None else '',
+                                 part.type)
+            if part.is_bootable: cmd += ',*'
+            cmd += '\n'
+        cmd += 'EOF'
+        return cmd
+
+    def _mkfs_profile(self, part):
+        try:
+            return mkfs.get_profile(part.mkfs_profile)
+        except mkfs.MkfsError as e:
+            raise DeviceException("Can't format partition %s: %s" %
+                                  (part.name, e))
+
+    def _mkfs_args(self, part, index, fat32=False, extended=None):
+        # Arguments of the partition's mkfs profile, tuned to the erase
+        # block (alignment) and size of the planned layout, if any
+        profile = self._mkfs_profile(part)
+        erase_block_b = 0
+        size_b = 0
+        if self._layout:
+            erase_block_b = self._layout.alignment_b
+            size = self._layout.partitions[index][1]
+            if size:
+                size_b = size * self._layout.sector_size
+        if part.filesystem == SDCardPartition.FILESYSTEM_VFAT:
+            return profile.vfat_args(size_b, fat32)
+        return profile.ext_args(part.filesystem, erase_block_b, extended)
+
+    def _stage(self, part, directory):
+        # Creates the staging directory where the files of the partition are
+        # installed, instead of mounting it
+        if self._dryrun:
+            staging = os.path.join(directory, '%s.XXXXXX' % part.name)
+        else:
+            try:
+                staging = tempfile.mkdtemp(prefix='%s.' % part.name,
+                                           dir=directory)
+            except OSError as e:
+                raise DeviceException('Failed to create a staging '
+                                      'directory in %s: %s' % (directory, e))
+        self._l.debug('Staging directory for %s: %s' % (part.name, staging))
+        self._staging[part.name] = staging
+
+    def _build_fat(self, part, staging, filename, size_b, start, fat32=None):
+        # Builds the FAT filesystem of the partition from its staging
+        # directory into the given file, see fat.FatBuilder
+        try:
+            builder = fat.FatBuilder(size_b, label=part.name, fat32=fat32,
+                            cluster_b=self._mkfs_profile(part).fat_cluster_b,
+                            hidden_sectors=start)
+            if staging:
+                builder.add_directory(staging)
+            builder.write(filename)
+        except (fat.FatError, IOError, OSError) as e:
+            raise DeviceException('Unable to format %s into %s: %s' %
+                                  (part.name, filename, e))
+
+    def _write_staged_fat(self, part, filename, fat32=None, compare=False):
+        # Builds the FAT filesystem of a staged partition into a sparse file
+        # next to its staging directory, and writes the regions in use into
+        # the partition with the raw writer (via sudo)
+        staging = self._staging.pop(part.name)
+        fat_file = '%s.fat' % staging
+        self._l.debug('Building FAT filesystem %s from %s' % (filename,
+                                                              staging))
+        try:
+            if not self._dryrun:
+                number = self._partitions.index(part) + 1
+                try:
+                    extents = self._e.probe(utils.partition_extents,
+                                            self._device)
+                except utils.ProbeError as e:
+                    raise DeviceException('Unable to format %s into %s: %s'
+                                          % (part.name, filename, e))
+                extent = [(start, size) for n, start, size in extents
+                          if n == number]
+                if not extent:
+                    raise DeviceException('Unable to format %s, %s not found'
+                                          % (part.name, filename))
+                start, size = extent[0]
+                size_b = size * utils.SYSFS_SECTOR_SIZE
+                try:
+                    fileutils.create_sparse_file(fat_file, size_b)
+                except IOError as e:
+                    raise DeviceException('Failed creating file for %s: %s' %
+                                          (part.name, e))
+                self._build_fat(part, staging, fat_file, size_b, start,
+                                fat32)
+            if self._e.raw_write(filename, fat_file, sparse=True,
+                                 compare=compare) != 0:
+                raise DeviceException('Unable to write %s into %s' %
+                                      (part.name, filename))
+        finally:
+            if not self._dryrun:
+                if os.path.exists(fat_file):
+                    os.remove(fat_file)
+                shutil.rmtree(staging, ignore_errors=True)
+
     def sync(self):
         if self._e.check_call('sync') != 0:
             raise DeviceException('Unable to sync')
 
+    def flush(self, partitions=None):
+        """
+        Flushes the buffered data of the device and the given partitions.
+        Unlike :func:`sync`, it doesn't wait for the writes to other devices
+        in the system.
+        
+        :param partitions: List of partition files, i.e. ['/dev/sdb1'].
+        :exception DeviceException: When unable to flush.
+        """
+        
+        files = [f for f in [self._device] + (partitions or []) if f]
+        if files and self._e.check_call('sudo sync %s' % ' '.join(files)) != 0:
+            raise DeviceException('Unable to flush %s' % ', '.join(files))
+
+    def _check_filesystems(self, filenames):
+        # The exit code returned by fsck is the sum of the following conditions
+        fsck_outputs = {0    : 'No errors',
+                        1    : 'Filesystem errors corrected',
+                        2    : 'System should be rebooted',
+                        4    : 'Filesystem errors left uncorrected',
+                        8    : 'Operational error',
+                        16   : 'Usage or syntax error',
+                        32   : 'fsck canceled by user request',
+                        128  : 'Shared-library error'}
+        
+        if not filenames:
+            return
+        self.flush(filenames)
+        # Each partition is checked independently, run them concurrently
+        retcodes = self._e.check_call_many(['sudo fsck -y %s' % filename
+                                            for filename in filenames])
+        errors = []
+        for filename, ret in zip(filenames, retcodes):
+            fs_ok = True
+            states = []
+            if ret == 0:
+                states.append(fsck_outputs[ret])
+            else:
+                for i in range(len(fsck_outputs)):
+                    key = 2 ** i
+                    if ret & key:
+                        try:
+                            states.append(fsck_outputs[key])
+                            if key != 1: # keys not counted as fatal errors
+                                fs_ok = False
+                        except KeyError:
+                            pass
+            states_str = ''.join("'%s', " % s for s in states).rstrip(', ')
+            msg = ("Filesystem check in %s: %s (see 'man fsck', exit code: %s)"
+                   % (filename, states_str, ret))
+            if fs_ok:
+                self._l.debug(msg)
+            else:
+                errors.append(msg)
+        if errors:
+            raise DeviceException('\n'.join(errors))
+
+    @property
+    def info(self):
+        """
+        :class:`DeviceInfo` of the device. It's probed once and cached until
+        the device is repartitioned; the logical sector size is also set in
+        the device :attr:`geometry`.
+        
+        :exception DeviceException: When unable to obtain the information.
+        """
+        
+        if self._info is not None:
+            return self._info
+        try:
+            info = self._e.probe(utils.device_info, self._device)
+        except utils.ProbeError:
+            if not self._dryrun:
+                raise DeviceException('Unable to obtain the size for %s' %
+                                      self._device)
+            return DeviceInfo()
+        self._info = DeviceInfo(info['size_b'], info['logical_sector_size'],
+                                info['physical_sector_size'],
+                                info['removable'])
+        self._l.debug('%s: %s bytes, %s/%s bytes logical/physical sectors%s' %
+                      (self._device, self._info.size_b,
+                       self._info.logical_sector_size,
+                       self._info.physical_sector_size,
+                       ', removable' if self._info.removable else ''))
+        if self._geometry is not None:
+            self._geometry.set_sector_byte_size(
+                self._info.logical_sector_size)
+        return self._info
+
     @property
     def size_b(self):
         """
@@ -150,18 +430,7 @@ class Device(object):
         :exception DeviceException: When unable to obtain the size. 
         """
         
-        if self._size_b != 0:
-            return self._size_b
-        cmd = ('sudo fdisk -l %s 2> /dev/null | grep %s | grep Disk | '
-               'cut -f 5 -d " "' % (self._device, self._device))
-        output = self._e.check_output(cmd)[1]
-        if not self._dryrun:
-            if not output:
-                raise DeviceException('Unable to obtain the size for %s' %
-                                      self._device)
-            else:
-                self._size_b = long(output)
-        return self._size_b
+        return self.info.size_b
 
     @property
     def size_gb(self):
@@ -181,7 +450,9 @@ class Device(object):
         :exception DeviceException: When unable to obtain the size.
         """
         
-        size_cyl = self.size_b / self.geometry.cyl_byte_size
+        # Reading the size first sets the sector size in the geometry
+        size_b = self.size_b
+        size_cyl = size_b / self.geometry.cyl_byte_size
         return long(math.floor(size_cyl))
     
     @property
@@ -191,35 +462,28 @@ class Device(object):
         false otherwise.
         """
         
-        is_mounted = False
-        cmd1 = 'grep --quiet %s /proc/mounts' % self._device
-        cmd2 = 'grep --quiet %s /proc/mdstat' % self._device
-        if self._e.check_call(cmd1) == 0: is_mounted = True
-        if self._e.check_call(cmd2) == 0: is_mounted = True
-        return is_mounted
+        return self._e.probe(utils.is_device_mounted, self._device)
 
     @property
     def mounted_partitions(self):
         """
-        Returns a list with the device's mounted partitions.
+        Returns a list with the mount points of the device's mounted
+        partitions.
         """
 
-        partitions = []
-        cmd = 'mount | grep %s | cut -f 3 -d " "' % self._device
-        output = self._e.check_output(cmd)[1]
-        if output:    
-            partitions = output.strip().split('\n')
-        return partitions
+        return self._e.probe(utils.device_mount_points, self._device,
+                             include_partitions=True)
 
     @property
     def exists(self):
         """
-        True if the device exists, false otherwise.
+        True if the device exists and has media, false otherwise.
         """
         
-        cmd = 'sudo fdisk -l %s' % self._device
-        output = self._e.check_output(cmd)[1]
-        return True if output else False
+        try:
+            return self.info.size_b > 0
+        except DeviceException:
+            return False
 
     def unmount(self):
         """
@@ -229,7 +493,6 @@ class Device(object):
         """
         
         for part in self.mounted_partitions:
-            self.sync()
             if self._e.check_call('sudo umount %s' % part) != 0:
                 raise DeviceException('Failed to unmount %s' % part)
     
@@ -285,6 +548,8 @@ class SDCard(Device):
         Device.__init__(self, device, dryrun)
         self._geometry = SDCardGeometry()
         self._partitions = []
+        self._staging = {}
+        self._synced = {}
         
     @property
     def partitions(self):
@@ -331,9 +596,7 @@ class SDCard(Device):
 		:exception DeviceException: When unable to erase the first 16M of raw data
         """        
         
-        cmd = ('sudo dd if=/dev/zero ' + 'of=' + self.name + ' bs=1M count=16')
-        
-        if self._e.check_call(cmd) != 0:
+        if self._e.wipe(self.name, 0, 16 << 20, self._wipe_method) != 0:
             raise DeviceException('Unable to erase the u-boot environment')
         
     def create_partitions(self):
@@ -343,35 +606,50 @@ class SDCard(Device):
         :exception DeviceException: When unable to partition.
         """
         
-        cmd = ('sudo ' + Device.SDK_SFDISK_PATH + ' -D' +
-              ' -C' + str(int(self.size_cyl)) +
-              ' -H' + str(int(self.geometry.heads)) +
-              ' -S' + str(int(self.geometry.sectors)) +
-              ' '   + self.name + ' << EOF\n')
-        for part in self._partitions:
-            cmd += str(part.start) + ','
-            cmd += str(part.size) + ','
-            cmd += str(part.type)
-            if part.is_bootable: cmd += ',*'
-            cmd += '\n'
-        cmd += 'EOF'
+        if self._partition_align_b:
+            # Reading the size first sets the sector size in the geometry
+            size_b = self.size_b
+            self._layout = self._plan_layout(size_b //
+                                     int(self.geometry.sector_byte_size))
+            cmd = self._sfdisk_sectors_cmd(self._layout)
+        else:
+            self._layout = None
+            cmd = ('sudo ' + Device.SDK_SFDISK_PATH + ' -D' +
+                  ' -C' + str(int(self.size_cyl)) +
+                  ' -H' + str(int(self.geometry.heads)) +
+                  ' -S' + str(int(self.geometry.sectors)) +
+                  ' '   + self.name + ' << EOF\n')
+            for part in self._partitions:
+                cmd += str(part.start) + ','
+                cmd += str(part.size) + ','
+                cmd += str(part.type)
+                if part.is_bootable: cmd += ',*'
+                cmd += '\n'
+            cmd += 'EOF'
         if self._e.check_call(cmd) != 0:
             raise DeviceException('Unable to partition device %s' % self.name)
+        # Probe the device again after the kernel re-reads the table
+        self._info = None
         
     def format_partitions(self):
         """
         Format the partitions in the given device, assuming these partitions
         were already created (see create_partitions()). To register partitions
-        use read_partitions().
+        use read_partitions(). The FAT partitions are built from their
+        staging directories on :func:`unmount`.
         
         :exception DeviceException: When unable to format.
         """
 
+        cmds = []
+        targets = []
         i = 1
         for part in self._partitions:
             filename = self.partition_name(i)
             if part.filesystem == SDCardPartition.FILESYSTEM_VFAT:
-                cmd = 'sudo mkfs.vfat -F 32 %s -n %s' % (filename, part.name)
+                # Built from its staging directory on unmount()
+                i += 1
+                continue
             elif part.filesystem == SDCardPartition.FILESYSTEM_EXT3:
                 cmd = 'sudo mkfs.ext3 %s -L %s'  % (filename, part.name)
             elif (part.filesystem == SDCardPartition.FILESYSTEM_EXT4 or
@@ -380,13 +658,29 @@ class SDCard(Device):
             else:
                 raise DeviceException("Can't format partition %s, unknown "
                               "filesystem: %s" % (part.name, part.filesystem))
-            if self._e.check_call(cmd) != 0:
-                raise DeviceException('Unable to format %s into %s' %
-                                (part.name, filename))
-            i += 1   
+            cmd += self._mkfs_args(part, i - 1, fat32=True)
+            cmds.append(cmd)
+            targets.append('%s into %s' % (part.name, filename))
+            i += 1
+        # The partitions are independent, format them concurrently
+        retcodes = self._e.check_call_many(cmds)
+        failed = [target for target, ret in zip(targets, retcodes) if ret != 0]
+        if failed:
+            raise DeviceException('Unable to format %s' % ', '.join(failed))
         if self._partitions:
             self.sync()
-        
+
+    def _fs_type(self, part):
+        # Map the partition's fs to a type that 'mount' and 'blkid' understand
+        if part.filesystem == SDCardPartition.FILESYSTEM_VFAT:
+            return 'vfat'
+        elif part.filesystem == SDCardPartition.FILESYSTEM_EXT3:
+            return 'ext3'
+        elif (part.filesystem == SDCardPartition.FILESYSTEM_EXT4 or
+              part.filesystem == SDCardPartition.FILESYSTEM_EXT4_WRITEBACK):
+            return 'ext4'
+        return None
+
     def mount(self, directory):
         """
         Mounts the partitions in the specified directory.
@@ -397,6 +691,13 @@ class SDCard(Device):
            - /media/boot
            - /media/rootfs
         
+        The FAT partitions are not mounted: they get a staging directory in
+        the given directory instead, i.e. "/media/boot.XXXXXX", and are built
+        from it on :func:`unmount` (see :func:`mount_point`). The other
+        partitions without a rootfs get a staging directory too, synced into
+        the mounted partition on :func:`unmount`; so the files of a previous
+        install that are no longer installed are removed.
+        
         :param directory: Directory where to mount the partitions.
         :exception DeviceException: When unable to mount.
         """
@@ -404,18 +705,14 @@ class SDCard(Device):
         i = 1
         for part in self._partitions:
             name = self.partition_name(i)
+            if part.filesystem == SDCardPartition.FILESYSTEM_VFAT:
+                self._stage(part, directory)
+                i += 1
+                continue
             mnt_dir = "%s/%s" % (directory.rstrip('/'), part.name)
             if self._e.check_call('mkdir -p %s' % mnt_dir) != 0:
                 raise DeviceException('Failed to create directory %s' % mnt_dir)
-            # Map the partition's fs to a type that the 'mount' understands
-            fs_type = None
-            if part.filesystem == SDCardPartition.FILESYSTEM_VFAT:
-                fs_type = 'vfat'
-            elif part.filesystem == SDCardPartition.FILESYSTEM_EXT3:
-                fs_type = 'ext3'
-            elif (part.filesystem == SDCardPartition.FILESYSTEM_EXT4 or 
-                  part.filesystem == SDCardPartition.FILESYSTEM_EXT4_WRITEBACK):
-                fs_type = 'ext4'
+            fs_type = self._fs_type(part)
             if fs_type:
                 cmd = 'sudo mount -t %s %s %s' % (fs_type, name, mnt_dir)
             else:
@@ -423,8 +720,58 @@ class SDCard(Device):
             if self._e.check_call(cmd) != 0:
                 raise DeviceException('Failed to mount %s in %s' % 
                                       (name, mnt_dir))
+            if SDCardPartition.COMPONENT_ROOTFS not in part.components:
+                self._stage(part, directory)
+                self._synced[part.name] = mnt_dir
             i += 1
 
+    def _sync_staged(self, part):
+        # Syncs the staging directory of the partition into its mount point,
+        # removing the files not in the staging directory
+        staging = self._staging.pop(part.name)
+        mnt_dir = self._synced.pop(part.name)
+        try:
+            if self._e.copy_tree(staging, mnt_dir, sync=True) != 0:
+                raise DeviceException('Failed to sync %s into %s' %
+                                      (part.name, mnt_dir))
+        finally:
+            if not self._dryrun:
+                shutil.rmtree(staging, ignore_errors=True)
+
+    def mount_point(self, part):
+        """
+        Returns the directory where the given partition is mounted, or its
+        staging directory (see :func:`mount`); an empty string if none.
+        
+        :param part: :class:`SDCardPartition` instance.
+        """
+        
+        if part.name in self._staging:
+            return self._staging[part.name]
+        return self._e.probe(utils.device_mount_point,
+                    self.partition_name(self._partitions.index(part) + 1))
+
+    def unmount(self):
+        """
+        Unmounts any mounted partitions, after syncing the staging directories
+        into them, and builds the FAT partitions from their staging
+        directories (see :func:`mount`). Only the blocks of the FAT
+        partitions that changed are written, so updating the boot files of a
+        card rewrites little more than them.
+        
+        :exception DeviceException: When unable to sync, unmount or build
+            a FAT partition.
+        """
+        
+        for part in self._partitions:
+            if part.name in self._synced:
+                self._sync_staged(part)
+        Device.unmount(self)
+        for i, part in enumerate(self._partitions):
+            if part.name in self._staging:
+                self._write_staged_fat(part, self.partition_name(i + 1),
+                                       fat32=True, compare=True)
+
     def optimize_filesystems(self):
         """
         Optimize the filesystems, if applies.
@@ -441,7 +788,9 @@ class SDCard(Device):
         i = 1
         for part in self._partitions:
             filename = self.partition_name(i)
-            if part.filesystem == SDCardPartition.FILESYSTEM_EXT4_WRITEBACK:
+            if (part.filesystem == SDCardPartition.FILESYSTEM_EXT4_WRITEBACK
+                and not self._mkfs_profile(part).is_journalless(
+                    part.filesystem)):
                 cmd = "sudo tune2fs -o journal_data_writeback %s" % filename
                 ret = self._e.check_call(cmd)
                 if ret != 0:
@@ -462,41 +811,8 @@ class SDCard(Device):
         :exception DeviceException: When a filesystem has an error.
         """
         
-        # The exit code returned by fsck is the sum of the following conditions
-        fsck_outputs = {0    : 'No errors',
-                        1    : 'Filesystem errors corrected',
-                        2    : 'System should be rebooted',
-                        4    : 'Filesystem errors left uncorrected',
-                        8    : 'Operational error',
-                        16   : 'Usage or syntax error',
-                        32   : 'fsck canceled by user request',
-                        128  : 'Shared-library error'}
-        
-        fs_ok = True
-        for i in range(1, len(self._partitions) + 1):
-            states = []
-            filename = self.partition_name(i)
-            self.sync()
-            ret = self._e.check_call("sudo fsck -y %s" % filename)
-            if ret == 0:
-                states.append(fsck_outputs[ret])
-            else:
-                for i in range(len(fsck_outputs)):
-                    key = 2 ** i
-                    if ret & key:
-                        try:
-                            states.append(fsck_outputs[key])
-                            if key != 1: # keys not counted as fatal errors
-                                fs_ok = False
-                        except KeyError:
-                            pass
-            states_str = ''.join("'%s', " % s for s in states).rstrip(', ')
-            msg = ("Filesystem check in %s: %s (see 'man fsck', exit code: %s)"
-                   % (filename, states_str, ret))
-            if fs_ok:
-                self._l.debug(msg)
-            else:
-                raise DeviceException(msg)
+        self._check_filesystems([self.partition_name(i) for i in
+                                 range(1, len(self._partitions) + 1)])
 
     def read_partitions(self, filename):
         """
@@ -507,21 +823,85 @@ class SDCard(Device):
         
         self._partitions[:] = []
         self._partitions = read_sdcard_partitions(filename)
+
+    def _expected_extents(self):
+        # Extents (start, size) in sysfs sectors that create_partitions()
+        # gives the partitions; no size for the one taking the rest
+        size_b = self.size_b
+        sector_size = int(self.geometry.sector_byte_size)
+        if self._partition_align_b:
+            extents = self._plan_layout(size_b // sector_size).partitions
+        else:
+            extents = mbr.cylinder_layout(
+                [part.start for part in self._partitions],
+                [part.size for part in self._partitions],
+                self.size_cyl, self.geometry)
+            extents = [(start, size if part.size != self.geometry.full_size
+                        else None) for part, (start, size) in
+                       zip(self._partitions, extents)]
+        scale = sector_size // utils.SYSFS_SECTOR_SIZE
+        return [(start * scale, size * scale if size is not None else None)
+                for start, size in extents]
+
+    def _current_filesystem(self, filename):
+        ret, output = self._e.check_output('sudo blkid -o value -s TYPE %s' %
+                                           filename)
+        return output.strip() if ret == 0 else ''
+
+    def partitions_match(self):
+        """
+        True if the partitions in the device already match the registered
+        partitions (see read_partitions()): same number of partitions,
+        extents and filesystems; false otherwise. Used to update the device
+        in place, without repartitioning and formatting it.
+        
+        :exception DeviceException: When unable to obtain the device size.
+        """
+        
+        try:
+            current = self._e.probe(utils.partition_extents, self._device)
+        except utils.ProbeError as e:
+            self._l.debug(str(e))
+            return False
+        expected = self._expected_extents()
+        if len(current) != len(expected):
+            self._l.info('%s has %s partitions, expected %s' %
+                         (self.name, len(current), len(expected)))
+            return False
+        i = 1
+        for part, (start, size), (number, cur_start, cur_size) in \
+                zip(self._partitions, expected, current):
+            if (number != i or start != cur_start or
+                (size is not None and size != cur_size)):
+                self._l.info('Partition %s of %s (%s) differs from the '
+                             'memory map' % (i, self.name, part.name))
+                return False
+            filename = self.partition_name(i)
+            filesystem = self._current_filesystem(filename)
+            if filesystem != self._fs_type(part):
+                self._l.info('%s has filesystem "%s", expected "%s"' %
+                             (filename, filesystem, self._fs_type(part)))
+                return False
+            i += 1
+        return True
     
 class LoopDevice(Device):
+    """
+    SD card image attached to a single loop device with partition scanning
+    (`losetup -P`): the kernel creates a device for each partition (i.e.
+    `/dev/loop0p1`), so no loop device is attached per partition. The loop
+    device is allocated and attached in one step, so concurrent builds
+    don't collide.
+    """
     
     def __init__(self, dryrun=False):
-        self._e = utils.executer.get_global_executer()
-        self._e.dryrun = dryrun
-        Device.__init__(self, self._get_free_device(), dryrun)
+        Device.__init__(self, '', dryrun)
         self._geometry = SDCardGeometry()
         self._partitions = []
-    
-    def _get_free_device(self):
-        ret, loop_device = self._e.check_output('sudo losetup -f')
-        if ret != 0:
-            raise DeviceException('Failed obtaining a free loop device')
-        return loop_device.strip()
+        self._img_size_mb = 0
+        self._layout = None
+        self._rootfs_dir = ''
+        self._staging = {}
     
     @property
     def partitions(self):
@@ -532,6 +912,34 @@ class LoopDevice(Device):
         
         return self._partitions
     
+    def __set_rootfs_dir(self, rootfs_dir):
+        self._rootfs_dir = rootfs_dir
+    
+    def __get_rootfs_dir(self):
+        return self._rootfs_dir
+    
+    rootfs_dir = property(__get_rootfs_dir, __set_rootfs_dir,
+                          doc="""Rootfs directory to create the rootfs
+                          partitions from, see :func:`is_populated`. Empty
+                          (the default) to mount every partition and install
+                          the rootfs in it.""")
+    
+    def is_populated(self, part):
+        """
+        Returns true if the given partition is populated with
+        :attr:`rootfs_dir` when its filesystem is created (`mke2fs -d`). Such
+        a partition is not mounted, nor checked afterwards; it applies to
+        ext partitions holding only the rootfs component.
+        
+        :param part: :class:`LoopDevicePartition` instance.
+        """
+        
+        return bool(self._rootfs_dir and
+                    part.components == [SDCardPartition.COMPONENT_ROOTFS] and
+                    part.filesystem in [SDCardPartition.FILESYSTEM_EXT3,
+                                    SDCardPartition.FILESYSTEM_EXT4,
+                                    SDCardPartition.FILESYSTEM_EXT4_WRITEBACK])
+    
     def min_cyl_size(self):
         """
         Sums all the partitions' sizes and returns the total. It is actually
@@ -566,65 +974,57 @@ class LoopDevice(Device):
     
     def attach_device(self, img_name, img_size_mb):
         """
-        Creates the image file with a valid format and associates the file
-        with the loop device. 
+        Creates the image file and associates the file with the first free
+        loop device, with partition scanning. The file is created sparse,
+        only the blocks written later on by the partitioning and formatting
+        are allocated.
         
         :exception DeviceException: Upon failure on associating the image
             file with the loop device.
         """
         
-        cmd = 'dd if=/dev/zero of=%s bs=1M count=%s' % (img_name, img_size_mb)
+        self._img_size_mb = int(img_size_mb)
+        cmd = 'truncate -s 0 %s' % img_name
         ret = self._e.check_call(cmd)
+        if ret == 0:
+            cmd = 'truncate -s %sM %s' % (img_size_mb, img_name)
+            ret = self._e.check_call(cmd)
         if ret != 0:
             raise DeviceException('Failed creating file for %s' % img_name)
         
-        cmd = 'sudo losetup %s %s' % (self.name, img_name)
-        ret = self._e.check_call(cmd)
+        # Finding a free device and attaching it is a single (atomic) step
+        ret, output = self._e.check_output('sudo losetup -f --show -P %s' %
+                                           img_name)
         if ret != 0:
-            raise DeviceException('Failed to associate image file %s to %s'
-                                  % (img_name, self.name))
-        
-        # If we want to reuse the code for creating and formatting partitions
-        # the image needs to have a valid format
-        cmd = 'sudo mkfs.ext4 %s -L tmp' % self.name
-        ret = self._e.check_call(cmd)
-        if ret != 0:
-            raise DeviceException('Failed to format a temporary filesystem on '
-                                  '%s' % img_name)
+            raise DeviceException('Failed to associate image file %s to a '
+                                  'loop device: %s' % (img_name,
+                                                       output.strip()))
+        self._device = output.strip()
+        if self._dryrun and not self._device:
+            self._device = '/dev/loopN'
+        self._info = None
     
     def attach_partitions(self, img_name, img_size_mb):
         """
-        Attaches partitions of the image file to an available loop device.
+        Assigns the partition devices created by the kernel when the
+        partition table was written (i.e. `/dev/loop0p1`) to the partitions.
         
-        :exception DeviceException: Upon failure on associating a partition
-            with a loop device.
+        :exception DeviceException: When the kernel didn't create the
+            partition devices.
         """
         
-        for part in self._partitions:
-            device = self._get_free_device()
-            if part.size == self.geometry.full_size:
-                part_size_cyl = self.geometry.mb_to_cyl(img_size_mb) - \
-                    int(part.start)
-                size_b = part_size_cyl * int(self.geometry.cyl_byte_size)
-            else:
-                size_b = int(part.size) * int(self.geometry.cyl_byte_size)
-            if int(part.start) == 0:
-                # DOS compatibility: We use sfdisk with the -D option, if the
-                # partition starts at offset 0, some space have to be wasted.
-                # See the corresponding documentation.
-                track_offset = int(1 * self.geometry.sectors *
-                                        self.geometry.sector_byte_size)
-                offset = track_offset
-                size_b -= track_offset
-            else:
-                offset = int(part.start) * int(self.geometry.cyl_byte_size)
-            cmd = ('sudo losetup -o %s --sizelimit %s %s %s' %
-                                        (offset, size_b, device, img_name))
-            ret = self._e.check_call(cmd)
-            if ret != 0:
-                raise DeviceException('Failed associating image %s to %s' %
-                                      (img_name, device))
-            part.device = device
+        if not self._dryrun:
+            # Let udev finish creating the device nodes
+            self._e.check_call('udevadm settle')
+            devices = self._e.probe(utils.device_partitions, self.name)
+            if len(devices) < len(self._partitions):
+                raise DeviceException('Found %s partitions in %s, expected '
+                                      '%s (does the kernel support '
+                                      'partitioned loop devices?)' %
+                                      (len(devices), self.name,
+                                       len(self._partitions)))
+        for i, part in enumerate(self._partitions):
+            part.device = '%sp%s' % (self.name, i + 1)
     
     def create_partitions(self):
         """
@@ -634,34 +1034,48 @@ class LoopDevice(Device):
         """
         
         self._l.info("Creating partitions")
-        cmd = ('sudo ' + Device.SDK_SFDISK_PATH + ' -D' +
-              ' -C' + str(int(self.size_cyl)) +
-              ' -H' + str(int(self.geometry.heads)) +
-              ' -S' + str(int(self.geometry.sectors)) +
-              ' '   + self.name + ' << EOF\n')
-        for part in self._partitions:
-            cmd += str(part.start) + ','
-            cmd += str(part.size) + ','
-            cmd += str(part.type)
-            if part.is_bootable: cmd += ',*'
-            cmd += '\n'
-        cmd += 'EOF'
+        if self._partition_align_b:
+            sector_size = int(self.geometry.sector_byte_size)
+            self._layout = self._plan_layout((long(self._img_size_mb) << 20)
+                                             // sector_size)
+            cmd = self._sfdisk_sectors_cmd(self._layout)
+        else:
+            self._layout = None
+            cmd = ('sudo ' + Device.SDK_SFDISK_PATH + ' -D' +
+                  ' -C' + str(int(self.size_cyl)) +
+                  ' -H' + str(int(self.geometry.heads)) +
+                  ' -S' + str(int(self.geometry.sectors)) +
+                  ' '   + self.name + ' << EOF\n')
+            for part in self._partitions:
+                cmd += str(part.start) + ','
+                cmd += str(part.size) + ','
+                cmd += str(part.type)
+                if part.is_bootable: cmd += ',*'
+                cmd += '\n'
+            cmd += 'EOF'
         if self._e.check_call(cmd) != 0:
             raise DeviceException('Unable to partition device %s' % self.name)
+        # Probe the device again after the kernel re-reads the table
+        self._info = None
     
     def format_partitions(self):
         """
         Format the partitions in the given device, assuming these partitions
         were already created (see create_partitions()). To register partitions
-        use read_partitions().
+        use read_partitions(). The FAT partitions are built from their
+        staging directories on :func:`unmount`.
         
         :exception DeviceException: When unable to format.
         """
 
+        cmds = []
+        targets = []
         i = 1
         for part in self._partitions:
             if part.filesystem == SDCardPartition.FILESYSTEM_VFAT:
-                cmd = 'sudo mkfs.vfat %s -n %s' % (part.device, part.name)
+                # Built from its staging directory on unmount()
+                i += 1
+                continue
             elif part.filesystem == SDCardPartition.FILESYSTEM_EXT3:
                 cmd = 'sudo mkfs.ext3 %s -L %s'  % (part.device, part.name)
             elif (part.filesystem == SDCardPartition.FILESYSTEM_EXT4 or
@@ -670,10 +1084,17 @@ class LoopDevice(Device):
             else:
                 raise DeviceException("Can't format partition %s, unknown "
                               "filesystem: %s" % (part.name, part.filesystem))
-            if self._e.check_call(cmd) != 0:
-                raise DeviceException('Unable to format %s into %s' %
-                                (part.name, part.device))
-            i += 1   
+            cmd += self._mkfs_args(part, i - 1)
+            if self.is_populated(part):
+                cmd += ' -d %s' % self._rootfs_dir
+            cmds.append(cmd)
+            targets.append('%s into %s' % (part.name, part.device))
+            i += 1
+        # The partitions are independent, format them concurrently
+        retcodes = self._e.check_call_many(cmds)
+        failed = [target for target, ret in zip(targets, retcodes) if ret != 0]
+        if failed:
+            raise DeviceException('Unable to format %s' % ', '.join(failed))
         if self._partitions:
             self.sync()
     
@@ -687,12 +1108,24 @@ class LoopDevice(Device):
            - /media/boot
            - /media/rootfs
         
+        The populated partitions (see :func:`is_populated`) are not mounted.
+        Neither are the FAT partitions: they get a staging directory in the
+        given directory instead, i.e. "/media/boot.XXXXXX", and are built
+        from it on :func:`unmount` (see :func:`mount_point`).
+        
         :param directory: Directory where to mount the partitions.
         :exception DeviceException: When unable to mount.
         """
         
         i = 1
         for part in self._partitions:
+            if self.is_populated(part):
+                self._l.debug('Not mounting %s, created from %s' %
+                              (part.name, self._rootfs_dir))
+                continue
+            if part.filesystem == SDCardPartition.FILESYSTEM_VFAT:
+                self._stage(part, directory)
+                continue
             mnt_dir = "%s/%s" % (directory.rstrip('/'), part.name)
             if self._e.check_call('mkdir -p %s' % mnt_dir) != 0:
                 raise DeviceException('Failed to create directory %s' % mnt_dir)
@@ -714,14 +1147,29 @@ class LoopDevice(Device):
                                       (part.device, mnt_dir))
             i += 1
     
+    def mount_point(self, part):
+        """
+        Returns the directory where the given partition is mounted, or its
+        staging directory (see :func:`mount`); an empty string if none.
+        
+        :param part: :class:`LoopDevicePartition` instance.
+        """
+        
+        if part.name in self._staging:
+            return self._staging[part.name]
+        return self._e.probe(utils.device_mount_point, part.device)
+    
     def unmount(self):
         for part in self._partitions:
-            if part.device:
-                self.sync()
+            if (part.device and not self.is_populated(part) and
+                part.name not in self._staging):
                 ret = self._e.check_call('sudo umount %s' % part.device)
                 if ret != 0:
                     raise DeviceException('Failed to unmount %s' % part.device)
         Device.unmount(self)
+        for part in self._partitions:
+            if part.name in self._staging:
+                self._write_staged_fat(part, part.device)
     
     def optimize_filesystems(self):
         """
@@ -737,7 +1185,9 @@ class LoopDevice(Device):
         """
         
         for part in self._partitions:
-            if part.filesystem == SDCardPartition.FILESYSTEM_EXT4_WRITEBACK:
+            if (part.filesystem == SDCardPartition.FILESYSTEM_EXT4_WRITEBACK
+                and not self._mkfs_profile(part).is_journalless(
+                    part.filesystem)):
                 cmd = "sudo tune2fs -o journal_data_writeback %s" % part.device
                 ret = self._e.check_call(cmd)
                 if ret != 0:
@@ -757,53 +1207,18 @@ class LoopDevice(Device):
         :exception DeviceException: When a fileystem has an error.
         """
         
-        # The exit code returned by fsck is the sum of the following conditions
-        fsck_outputs = {0    : 'No errors',
-                        1    : 'Filesystem errors corrected',
-                        2    : 'System should be rebooted',
-                        4    : 'Filesystem errors left uncorrected',
-                        8    : 'Operational error',
-                        16   : 'Usage or syntax error',
-                        32   : 'fsck canceled by user request',
-                        128  : 'Shared-library error'}
-        
-        fs_ok = True
-        for part in self._partitions:
-            states = []
-            self.sync()
-            ret = self._e.check_call("sudo fsck -y %s" % part.device)
-            if ret == 0:
-                states.append(fsck_outputs[ret])
-            else:
-                for i in range(len(fsck_outputs)):
-                    key = 2 ** i
-                    if ret & key:
-                        try:
-                            states.append(fsck_outputs[key])
-                            if key != 1: # keys not counted as fatal errors
-                                fs_ok = False
-                        except KeyError:
-                            pass
-            states_str = ''.join("'%s', " % s for s in states).rstrip(', ')
-            msg = ("Filesystem check in %s: %s (see 'man fsck', exit code: %s)"
-                   % (part.device, states_str, ret))
-            if fs_ok:
-                self._l.debug(msg)
-            else:
-                raise DeviceException(msg)
-    
+        self._check_filesystems([part.device for part in self._partitions
+                                 if not self.is_populated(part)])
+
     def detach_device(self):
         ret = self._e.check_call('sudo losetup -d %s' % self.name)
         if ret != 0:
             raise DeviceException('Failed detaching %s' % self.name)
     
     def detach_partitions(self):
+        # The partition devices go away with the loop device
         for part in self._partitions:
-            if part.device:
-                ret = self._e.check_call('sudo losetup -d %s' % part.device)
-                if ret != 0:
-                    raise DeviceException('Failed detaching %s' % part.device)
-                part.device = None
+            part.device = None
     
     def read_partitions(self, filename):
         """
@@ -815,6 +1230,283 @@ class LoopDevice(Device):
         self._partitions[:] = []
         self._partitions = read_loopdevice_partitions(filename)
 
+class ImageDevice(LoopDevice):
+    """
+    SD card image built without superuser access: no loop devices, no
+    `sfdisk` and no `mount`.
+    
+    Each partition is built as a separate file next to the image. Instead of
+    being mounted, each partition gets a staging directory where the
+    components are installed (see :func:`mount_point`); the filesystems are
+    created from the staging directories on :func:`unmount` (`mkfs.ext4 -d`,
+    or :mod:`fat` for FAT partitions). The partition table is written
+    by :mod:`mbr`, and the partition files are stitched into the sparse image
+    on :func:`detach_partitions`, copying only their allocated regions.
+    
+    The files in ext partitions that belong to the user building the image
+    are owned by root, other owners are kept, as if they were installed with
+    `sudo cpio -pdum`.
+    """
+    
+    def __init__(self, dryrun=False):
+        Device.__init__(self, '', dryrun)
+        self._geometry = SDCardGeometry()
+        self._partitions = []
+        self._img_size_mb = 0
+        self._layout = None
+        self._rootfs_dir = ''
+        self._staging = {}
+    
+    @property
+    def size_b(self):
+        """
+        Image size (bytes).
+        """
+        
+        return long(self._img_size_mb) << 20
+    
+    def attach_device(self, img_name, img_size_mb):
+        """
+        Creates the image file, sparse.
+        
+        :exception DeviceException: When unable to create the image file.
+        """
+        
+        self._device = img_name
+        self._img_size_mb = int(img_size_mb)
+        self._l.debug('Creating sparse image %s (%s MB)' %
+                      (img_name, img_size_mb))
+        if not self._dryrun:
+            try:
+                fileutils.create_sparse_file(img_name, self.size_b)
+            except IOError as e:
+                raise DeviceException('Failed creating file for %s: %s' %
+                                      (img_name, e))
+    
+    def create_partitions(self):
+        """
+        Writes the partition table into the image.
+        
+        :exception DeviceException: When unable to partition.
+        """
+        
+        self._l.info("Creating partitions")
+        plan = self._plan_layout(self.size_b //
+                                 int(self.geometry.sector_byte_size))
+        try:
+            entries = [mbr.MBRPartition(start, size, part.type,
+                                        part.is_bootable)
+                       for part, (start, size) in zip(self._partitions,
+                                                      plan.partitions)]
+            table = mbr.partition_table(entries, self.geometry.heads,
+                                        self.geometry.sectors)
+        except (ValueError, mbr.MBRError) as e:
+            raise DeviceException('Unable to partition %s: %s' %
+                                  (self.name, e))
+        self._layout = plan
+        if not self._dryrun:
+            try:
+                mbr.write_table(self.name, table)
+            except IOError as e:
+                raise DeviceException('Unable to partition %s: %s' %
+                                      (self.name, e))
+    
+    def attach_partitions(self, img_name, img_size_mb):
+        """
+        Creates a file for each partition, sparse.
+        
+        :exception DeviceException: When unable to create a file.
+        """
+        
+        sector_size = int(self.geometry.sector_byte_size)
+        for part, (start, size) in zip(self._partitions,
+                                       self._layout.partitions):
+            part.device = '%s.%s' % (img_name, part.name)
+            if not self._dryrun:
+                try:
+                    fileutils.create_sparse_file(part.device,
+                                                 size * sector_size)
+                except IOError as e:
+                    raise DeviceException('Failed creating file for %s: %s' %
+                                          (part.name, e))
+    
+    def format_partitions(self):
+        """
+        Checks the filesystems of the partitions. The filesystems are created
+        from their staging directories on :func:`unmount`.
+        
+        :exception DeviceException: On an unknown filesystem.
+        """
+        
+        for part in self._partitions:
+            if part.filesystem not in [SDCardPartition.FILESYSTEM_VFAT,
+                                    SDCardPartition.FILESYSTEM_EXT3,
+                                    SDCardPartition.FILESYSTEM_EXT4,
+                                    SDCardPartition.FILESYSTEM_EXT4_WRITEBACK]:
+                raise DeviceException("Can't format partition %s, unknown "
+                              "filesystem: %s" % (part.name, part.filesystem))
+    
+    def mount(self, directory):
+        """
+        Creates a staging directory for each partition in the specified
+        directory, i.e. "/tmp/boot.XXXXXX" for the partition "boot". The
+        populated partitions (see :func:`is_populated`) are built straight
+        from the rootfs directory and get none.
+        
+        :param directory: Directory where to create the staging directories.
+        :exception DeviceException: When unable to create a directory.
+        """
+        
+        for part in self._partitions:
+            if not self.is_populated(part):
+                self._stage(part, directory)
+    
+    def mount_point(self, part):
+        """
+        Returns the staging directory of the given partition.
+        
+        :param part: :class:`LoopDevicePartition` instance.
+        """
+        
+        return self._staging.get(part.name, '')
+    
+    def _source_dir(self, part):
+        if self.is_populated(part):
+            return self._rootfs_dir
+        return self._staging.get(part.name)
+    
+    def _squash_owner(self, part, staging):
+        # Same ownership as a 'sudo cpio' install: the files of the user
+        # building the image are owned by root, other owners are kept
+        uid, gid = os.getuid(), os.getgid()
+        if uid == 0 and gid == 0:
+            return
+        cmds = []
+        for root, dirs, files in os.walk(staging):
+            for name in dirs + files:
+                path = os.path.join(root, name)
+                st = os.lstat(path)
+                path = path[len(staging):]
+                if st.st_uid != uid and st.st_gid != gid:
+                    continue
+                if '"' in path or '\n' in path:
+                    raise DeviceException("Can't set the owner of %r in %s: "
+                                          "debugfs doesn't take quotes or "
+                                          "newlines in paths" %
+                                          (path, part.name))
+                if st.st_uid == uid:
+                    cmds.append('sif "%s" uid 0' % path)
+                if st.st_gid == gid:
+                    cmds.append('sif "%s" gid 0' % path)
+        if not cmds:
+            return
+        fd, script = tempfile.mkstemp(prefix='%s.' % part.name,
+                                      suffix='.debugfs')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write('\n'.join(cmds) + '\n')
+            cmd = 'debugfs -w -f %s %s' % (script, part.device)
+            ret, output = self._e.check_output(cmd)
+        finally:
+            os.remove(script)
+        # debugfs exits 0 even if its commands fail: besides its banner and
+        # the echo of each command, anything it prints is an error
+        echoes = set('debugfs: %s' % c for c in cmds)
+        errors = [l for l in output.splitlines() if l.strip() and
+                  not l.startswith('debugfs ') and l.rstrip() not in echoes]
+        if ret != 0 or errors:
+            raise DeviceException('Failed setting the files owner in %s: %s'
+                                  % (part.name, '; '.join(errors[:3]) or
+                                     output.strip()))
+    
+    def _build_ext_cmd(self, part, staging):
+        if part.filesystem == SDCardPartition.FILESYSTEM_EXT3:
+            mkfs_bin = 'mkfs.ext3'
+        else:
+            mkfs_bin = 'mkfs.ext4'
+        cmd = '%s -F -q -L %s' % (mkfs_bin, part.name)
+        cmd += self._mkfs_args(part, self._partitions.index(part),
+                               extended=['root_owner=0:0'])
+        if staging:
+            cmd += ' -d %s' % staging
+        cmd += ' %s' % part.device
+        return cmd
+    
+    def _build_vfat(self, part, staging):
+        start, size = self._layout.partitions[self._partitions.index(part)]
+        self._l.debug('Building FAT filesystem %s from %s' %
+                      (part.device, staging))
+        if not self._dryrun:
+            self._build_fat(part, staging, part.device,
+                            size * int(self.geometry.sector_byte_size), start)
+    
+    def unmount(self):
+        """
+        Creates the filesystems from the staging directories.
+        
+        :exception DeviceException: When unable to create a filesystem.
+        """
+        
+        self._l.info('Building the partitions')
+        ext_parts = []
+        for part in self._partitions:
+            if not part.device:
+                continue
+            staging = self._staging.get(part.name)
+            if part.filesystem == SDCardPartition.FILESYSTEM_VFAT:
+                self._build_vfat(part, staging)
+            else:
+                ext_parts.append(part)
+        # Each partition is a separate file, build them concurrently
+        cmds = [self._build_ext_cmd(part, self._source_dir(part))
+                for part in ext_parts]
+        retcodes = self._e.check_call_many(cmds)
+        failed = ['%s into %s' % (part.name, part.device)
+                  for part, ret in zip(ext_parts, retcodes) if ret != 0]
+        if failed:
+            raise DeviceException('Unable to format %s' % ', '.join(failed))
+        for part in ext_parts:
+            source = self._source_dir(part)
+            if source and not self._dryrun and os.listdir(source):
+                self._squash_owner(part, source)
+    
+    def detach_partitions(self):
+        """
+        Copies the partition files into the image, and removes them together
+        with the staging directories.
+        
+        :exception DeviceException: When unable to copy a partition.
+        """
+        
+        sector_size = int(self.geometry.sector_byte_size)
+        for part, (start, size) in zip(self._partitions,
+                                       self._layout.partitions):
+            if not part.device:
+                continue
+            offset = start * sector_size
+            self._l.debug('Copying %s into %s at offset %s' %
+                          (part.device, self.name, offset))
+            if not self._dryrun:
+                try:
+                    copied = fileutils.copy_sparse(part.device, self.name,
+                                                   offset)
+                except OSError as e:
+                    raise DeviceException('Failed copying %s into %s: %s' %
+                                          (part.name, self.name, e))
+                self._l.debug('  %s bytes copied' % copied)
+                os.remove(part.device)
+                staging = self._staging.pop(part.name, None)
+                if staging:
+                    shutil.rmtree(staging, ignore_errors=True)
+            part.device = None
+    
+    def detach_device(self):
+        """
+        Nothing to detach: the image is a regular file.
+        """
+        
+        pass
+
 class USB(Device):
 
     def __init__(self, device, dryrun=False):
@@ -885,6 +1577,8 @@ class USB(Device):
         cmd += 'EOF'
         if self._e.check_call(cmd) != 0:
             raise DeviceException('Unable to partition device %s' % self.name)
+        # Probe the device again after the kernel re-reads the table
+        self._info = None
         
     def format_partitions(self):
         """
@@ -895,6 +1589,8 @@ class USB(Device):
         :exception DeviceException: When unable to format.
         """
 
+        cmds = []
+        targets = []
         i = 1
         for part in self._partitions:
             filename = self.partition_name(i)
@@ -908,10 +1604,14 @@ class USB(Device):
             else:
                 raise DeviceException("Can't format partition %s, unknown "
                               "filesystem: %s" % (part.name, part.filesystem))
-            if self._e.check_call(cmd) != 0:
-                raise DeviceException('Unable to format %s into %s' %
-                                (part.name, filename))
-            i += 1   
+            cmds.append(cmd)
+            targets.append('%s into %s' % (part.name, filename))
+            i += 1
+        # The partitions are independent, format them concurrently
+        retcodes = self._e.check_call_many(cmds)
+        failed = [target for target, ret in zip(targets, retcodes) if ret != 0]
+        if failed:
+            raise DeviceException('Unable to format %s' % ', '.join(failed))
         if self._partitions:
             self.sync()
         
@@ -990,41 +1690,8 @@ class USB(Device):
         :exception DeviceException: When a filesystem has an error.
         """
         
-        # The exit code returned by fsck is the sum of the following conditions
-        fsck_outputs = {0    : 'No errors',
-                        1    : 'Filesystem errors corrected',
-                        2    : 'System should be rebooted',
-                        4    : 'Filesystem errors left uncorrected',
-                        8    : 'Operational error',
-                        16   : 'Usage or syntax error',
-                        32   : 'fsck canceled by user request',
-                        128  : 'Shared-library error'}
-        
-        fs_ok = True
-        for i in range(1, len(self._partitions) + 1):
-            states = []
-            filename = self.partition_name(i)
-            self.sync()
-            ret = self._e.check_call("sudo fsck -y %s" % filename)
-            if ret == 0:
-                states.append(fsck_outputs[ret])
-            else:
-                for i in range(len(fsck_outputs)):
-                    key = 2 ** i
-                    if ret & key:
-                        try:
-                            states.append(fsck_outputs[key])
-                            if key != 1: # keys not counted as fatal errors
-                                fs_ok = False
-                        except KeyError:
-                            pass
-            states_str = ''.join("'%s', " % s for s in states).rstrip(', ')
-            msg = ("Filesystem check in %s: %s (see 'man fsck', exit code: %s)"
-                   % (filename, states_str, ret))
-            if fs_ok:
-                self._l.debug(msg)
-            else:
-                raise DeviceException(msg)
+        self._check_filesystems([self.partition_name(i) for i in
+                                 range(1, len(self._partitions) + 1)])
 
     def read_partitions(self, filename):
         """
@@ -0,0 +1,522 @@
+#!/usr/bin/env python
+# ==========================================================================
+#
+# Copyright (C) 2013-2014 RidgeRun, LLC (http://www.ridgerun.com)
+#
+# Author: Jose Pablo Carballo <jose.carballo@ridgerun.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# FAT16/FAT32 filesystem writer.
+#
+# ==========================================================================
+
+"""
+The fat module builds a FAT16 or FAT32 filesystem, together with its
+contents, from a directory; without `mkfs.vfat`, mounting or copying the
+files one by one.
+
+Boot partitions only hold a handful of files, so the whole filesystem is
+planned in memory and then written in one pass: boot sector, both FATs, the
+directories and the files, each one in consecutive clusters. The files in
+:const:`FIRST_FILES` (MLO) come first in the root directory and in the data
+area, as required by the TI boot ROMs.
+
+Typical use:
+::
+    builder = FatBuilder(64 << 20, label='boot')
+    builder.add_directory('/tmp/boot')
+    builder.write('/tmp/sd.img.boot')
+"""
+
+# ==========================================================================
+# Imports
+# ==========================================================================
+
+import os
+import sys
+import time
+import array
+import struct
+
+# ==========================================================================
+# Constants
+# ==========================================================================
+
+SECTOR_SIZE = 512
+
+#: Cluster count limits of each FAT type.
+FAT16_MIN_CLUSTERS = 4085
+FAT16_MAX_CLUSTERS = 65524
+FAT32_MIN_CLUSTERS = 65525
+FAT32_MAX_CLUSTERS = 0x0ffffff5
+
+#: Filesystems of this size (bytes) or more are FAT32 by default.
+FAT32_MIN_SIZE_B = 512 << 20
+
+#: Default and maximum cluster size (bytes).
+DEFAULT_CLUSTER_B = 4096
+MAX_CLUSTER_B = 32768
+
+#: Entries of the FAT16 root directory.
+ROOT_ENTRIES = 512
+
+#: Files placed first in the root directory and in the data area.
+FIRST_FILES = ['MLO']
+
+ATTR_VOLUME_ID = 0x08
+ATTR_DIRECTORY = 0x10
+ATTR_ARCHIVE = 0x20
+ATTR_LONG_NAME = 0x0f
+
+DIR_ENTRY_SIZE = 32
+LFN_CHARS = 13
+
+MEDIA_DESCRIPTOR = 0xf8
+OEM_NAME = 'MSWIN4.1'
+HEADS = 255
+SECTORS_PER_TRACK = 63
+
+# Characters allowed in short names, besides letters and digits
+_SHORT_NAME_CHARS = "$%'-_@~`!(){}^#&"
+
+_COPY_CHUNK_B = 1 << 20
+
+# ==========================================================================
+# Public Classes
+# ==========================================================================
+
+class FatError(Exception):
+    """FAT exceptions."""
+
+class _Node(object):
+
+    def __init__(self, name, path, is_dir, size=0, mtime=0):
+        self.name = name
+        self.path = path
+        self.is_dir = is_dir
+        self.size = size
+        self.mtime = mtime
+        self.children = []
+        self.short_name = ''
+        self.long_name = False
+        self.cluster = 0
+        self.clusters = 0
+
+class FatBuilder(object):
+    """Builds a FAT filesystem from the contents of a directory."""
+
+    def __init__(self, size_b, label='', fat32=None, cluster_b=0,
+                 hidden_sectors=0, volume_id=None):
+        """
+        :param size_b: Filesystem size (bytes).
+        :param label: Volume label, up to 11 characters.
+        :param fat32: True for FAT32, false for FAT16; by default FAT32 for
+            filesystems of :const:`FAT32_MIN_SIZE_B` or more.
+        :param cluster_b: Cluster size (bytes); 0 for the default. It is
+            halved or doubled as needed to get a valid cluster count.
+        :param hidden_sectors: Sectors before the filesystem, i.e. the start
+            sector of its partition.
+        :param volume_id: Volume serial number; by default derived from the
+            current time.
+        :exception FatError: When no valid FAT fits in the given size.
+        """
+
+        if fat32 is None:
+            fat32 = size_b >= FAT32_MIN_SIZE_B
+        self._fat32 = fat32
+        self._label = label
+        self._hidden_sectors = hidden_sectors
+        if volume_id is None:
+            volume_id = int(time.time() * 1000)
+        self._volume_id = volume_id & 0xffffffff
+        self._total_sectors = size_b // SECTOR_SIZE
+        if self._total_sectors > 0xffffffff:
+            raise FatError('Filesystem of %s bytes too large for FAT' % size_b)
+        self._plan_geometry(cluster_b or DEFAULT_CLUSTER_B)
+        self._root = _Node('', '', True)
+
+    def _geometry(self, cluster_b):
+        spc = cluster_b // SECTOR_SIZE
+        if self._fat32:
+            reserved, root_sectors, entry_b = 32, 0, 4
+        else:
+            reserved, entry_b = 1, 2
+            root_sectors = ROOT_ENTRIES * DIR_ENTRY_SIZE // SECTOR_SIZE
+        # FAT size, from the Microsoft FAT specification
+        tmp1 = self._total_sectors - reserved - root_sectors
+        tmp2 = 256 * spc + 2
+        if self._fat32:
+            tmp2 //= 2
+        fat_sectors = max((tmp1 + tmp2 - 1) // tmp2, 1)
+        # Align the data area to the cluster size
+        data_start = reserved + 2 * fat_sectors + root_sectors
+        reserved += -data_start % spc
+        data_start = reserved + 2 * fat_sectors + root_sectors
+        clusters = max(self._total_sectors - data_start, 0) // spc
+        # The FAT must address all the clusters
+        clusters = min(clusters, fat_sectors * SECTOR_SIZE // entry_b - 2)
+        return spc, reserved, fat_sectors, root_sectors, clusters
+
+    def _plan_geometry(self, cluster_b):
+        if self._fat32:
+            min_clusters, max_clusters = FAT32_MIN_CLUSTERS, FAT32_MAX_CLUSTERS
+        else:
+            min_clusters, max_clusters = FAT16_MIN_CLUSTERS, FAT16_MAX_CLUSTERS
+        cluster_b = min(max(cluster_b, SECTOR_SIZE), MAX_CLUSTER_B)
+        while True:
+            geometry = self._geometry(cluster_b)
+            clusters = geometry[4]
+            if clusters < min_clusters and cluster_b > SECTOR_SIZE:
+                cluster_b //= 2
+            elif clusters > max_clusters and cluster_b < MAX_CLUSTER_B:
+                cluster_b *= 2
+            else:
+                break
+        if not min_clusters <= clusters <= max_clusters:
+            raise FatError('No valid FAT%s fits in %s bytes' %
+                           (32 if self._fat32 else 16,
+                            self._total_sectors * SECTOR_SIZE))
+        self._cluster_b = cluster_b
+        (self._spc, self._reserved, self._fat_sectors, self._root_sectors,
+         self._clusters) = geometry
+
+    @property
+    def fat_bits(self):
+        """FAT type: 16 or 32."""
+
+        return 32 if self._fat32 else 16
+
+    @property
+    def cluster_b(self):
+        """Cluster size (bytes)."""
+
+        return self._cluster_b
+
+    @property
+    def clusters(self):
+        """Number of clusters of the data area."""
+
+        return self._clusters
+
+    def _scan(self, node, first):
+        try:
+            names = sorted(os.listdir(node.path))
+        except OSError as e:
+            raise FatError('Unable to read %s: %s' % (node.path, e))
+        for name in reversed(first):
+            if name in names:
+                names.remove(name)
+                names.insert(0, name)
+        used = set()
+        for name in names:
+            path = os.path.join(node.path, name)
+            st = os.stat(path)
+            if os.path.isdir(path):
+                child = _Node(name, path, True, mtime=st.st_mtime)
+                self._scan(child, [])
+            elif os.path.isfile(path):
+                child = _Node(name, path, False, st.st_size, st.st_mtime)
+            else:
+                raise FatError('Unsupported file type: %s' % path)
+            if child.size > 0xffffffff:
+                raise FatError('File too large for FAT: %s' % path)
+            child.short_name, child.long_name = _short_name(name, used)
+            used.add(child.short_name)
+            node.children.append(child)
+
+    def add_directory(self, directory, first=FIRST_FILES):
+        """
+        Adds the contents of the given directory (recursively) to the root
+        of the filesystem.
+
+        :param directory: Source directory.
+        :param first: Files to place first in the root directory and in the
+            data area, if present.
+        :exception FatError: On an unsupported or unreadable file.
+        """
+
+        self._root.path = directory
+        self._root.children = []
+        self._scan(self._root, first)
+
+    def _dir_entries(self, node):
+        entries = 0
+        if node is self._root:
+            if self._label:
+                entries += 1
+        else:
+            entries += 2 # '.' and '..'
+        for child in node.children:
+            entries += 1
+            if child.long_name:
+                entries += _lfn_count(child.name)
+        return entries
+
+    def _allocate(self, node, next_cluster):
+        # Children first, so the first files follow their directory
+        for child in node.children:
+            if child.is_dir:
+                size_b = max(self._dir_entries(child) * DIR_ENTRY_SIZE, 1)
+            else:
+                size_b = child.size
+            child.clusters = (size_b + self._cluster_b - 1) // self._cluster_b
+            if child.clusters:
+                child.cluster = next_cluster
+                next_cluster += child.clusters
+        for child in node.children:
+            if child.is_dir:
+                next_cluster = self._allocate(child, next_cluster)
+        return next_cluster
+
+    def _plan(self):
+        root_b = self._dir_entries(self._root) * DIR_ENTRY_SIZE
+        next_cluster = 2
+        if self._fat32:
+            self._root.clusters = max((root_b + self._cluster_b - 1) //
+                                      self._cluster_b, 1)
+            self._root.cluster = next_cluster
+            next_cluster += self._root.clusters
+        elif root_b > self._root_sectors * SECTOR_SIZE:
+            raise FatError('Too many files in the root directory (up to %s '
+                           'entries)' % ROOT_ENTRIES)
+        next_cluster = self._allocate(self._root, next_cluster)
+        if next_cluster - 2 > self._clusters:
+            raise FatError('The files take %s bytes, more than the %s bytes '
+                           'available' %
+                           ((next_cluster - 2) * self._cluster_b,
+                            self._clusters * self._cluster_b))
+        return next_cluster
+
+    def _boot_sector(self):
+        total16 = self._total_sectors
+        total32 = 0
+        if self._fat32 or total16 > 0xffff:
+            total16, total32 = 0, self._total_sectors
+        label = _pad(self._label.encode('ascii', 'replace'), 11)
+        bpb = struct.pack('<HBHBHHBHHHII', SECTOR_SIZE, self._spc,
+                          self._reserved, 2,
+                          0 if self._fat32 else ROOT_ENTRIES, total16,
+                          MEDIA_DESCRIPTOR,
+                          0 if self._fat32 else self._fat_sectors,
+                          SECTORS_PER_TRACK, HEADS, self._hidden_sectors,
+                          total32)
+        if self._fat32:
+            sector = '\xeb\x58\x90' + OEM_NAME + bpb
+            sector += struct.pack('<IHHIHH12sBBBI11s8s', self._fat_sectors, 0,
+                                  0, self._root.cluster, 1, 6, '', 0x80, 0,
+                                  0x29, self._volume_id, label, 'FAT32   ')
+        else:
+            sector = '\xeb\x3c\x90' + OEM_NAME + bpb
+            sector += struct.pack('<BBBI11s8s', 0x80, 0, 0x29,
+                                  self._volume_id, label, 'FAT16   ')
+        # Not bootable: boot code to try the next device
+        sector += '\xcd\x18'
+        return _pad(sector, SECTOR_SIZE - 2, '\x00') + '\x55\xaa'
+
+    def _fsinfo_sector(self, next_cluster):
+        sector = struct.pack('<I', 0x41615252) + '\x00' * 480
+        sector += struct.pack('<III', 0x61417272,
+                              self._clusters - (next_cluster - 2),
+                              next_cluster)
+        sector += '\x00' * 12 + struct.pack('<I', 0xaa550000)
+        return sector
+
+    def _fat(self):
+        if self._fat32:
+            fat = array.array('I', [0]) * (self._fat_sectors * SECTOR_SIZE // 4)
+            fat[0], fat[1], eoc = 0x0ffffff8, 0x0fffffff, 0x0fffffff
+        else:
+            fat = array.array('H', [0]) * (self._fat_sectors * SECTOR_SIZE // 2)
+            fat[0], fat[1], eoc = 0xfff8, 0xffff, 0xffff
+        nodes = [self._root]
+        while nodes:
+            node = nodes.pop()
+            for cluster in range(node.cluster, node.cluster + node.clusters):
+                fat[cluster] = cluster + 1
+            if node.clusters:
+                fat[node.cluster + node.clusters - 1] = eoc
+            nodes.extend(node.children)
+        if sys.byteorder != 'little':
+            fat.byteswap()
+        return fat.tostring()
+
+    def _entry(self, short_name, attr, cluster, size, mtime):
+        date, tm = _fat_datetime(mtime)
+        return struct.pack('<11sBBBHHHHHHHI', short_name, attr, 0, 0, tm,
+                           date, date, cluster >> 16, tm, date,
+                           cluster & 0xffff, size)
+
+    def _directory(self, node, parent):
+        data = ''
+        if node is self._root:
+            if self._label:
+                data += self._entry(_pad(self._label.encode('ascii',
+                                    'replace'), 11), ATTR_VOLUME_ID, 0, 0,
+                                    time.time())
+        else:
+            data += self._entry('.'.ljust(11), ATTR_DIRECTORY, node.cluster,
+                                0, node.mtime)
+            # '..' points to cluster 0 for the root directory
+            parent_cluster = 0 if parent is self._root else parent.cluster
+            data += self._entry('..'.ljust(11), ATTR_DIRECTORY,
+                                parent_cluster, 0, node.mtime)
+        for child in node.children:
+            if child.long_name:
+                data += _lfn_entries(child.name, child.short_name)
+            attr = ATTR_DIRECTORY if child.is_dir else ATTR_ARCHIVE
+            data += self._entry(child.short_name, attr, child.cluster,
+                                0 if child.is_dir else child.size,
+                                child.mtime)
+        return data
+
+    def _cluster_offset(self, cluster):
+        data_start = (self._reserved + 2 * self._fat_sectors +
+                      self._root_sectors)
+        return (data_start * SECTOR_SIZE +
+                (cluster - 2) * self._cluster_b)
+
+    def _write_files(self, f, offset, node, parent):
+        data = self._directory(node, parent)
+        if node is self._root and not self._fat32:
+            f.seek(offset + (self._reserved + 2 * self._fat_sectors) *
+                   SECTOR_SIZE)
+            f.write(_pad(data, self._root_sectors * SECTOR_SIZE, '\x00'))
+        else:
+            f.seek(offset + self._cluster_offset(node.cluster))
+            f.write(_pad(data, node.clusters * self._cluster_b, '\x00'))
+        for child in node.children:
+            if child.is_dir:
+                self._write_files(f, offset, child, node)
+            elif child.size:
+                f.seek(offset + self._cluster_offset(child.cluster))
+                _copy_file(child.path, child.size, f)
+
+    def write(self, filename, offset=0):
+        """
+        Writes the filesystem into the given file or device, which must
+        exist. Only the metadata and the clusters in use are written.
+
+        :param filename: Image file, partition file or device.
+        :param offset: Offset of the filesystem in the file (bytes).
+        :exception FatError: When the files don't fit in the filesystem.
+        :exception IOError: When unable to write.
+        """
+
+        next_cluster = self._plan()
+        boot = self._boot_sector()
+        with open(filename, 'r+b') as f:
+            f.seek(offset)
+            reserved = boot
+            if self._fat32:
+                # FSInfo in sector 1, backups of both in sectors 6 and 7
+                fsinfo = self._fsinfo_sector(next_cluster)
+                reserved = _pad(boot + fsinfo, 6 * SECTOR_SIZE, '\x00')
+                reserved += boot + fsinfo
+            f.write(_pad(reserved, self._reserved * SECTOR_SIZE, '\x00'))
+            fat = self._fat()
+            f.write(fat)
+            f.write(fat)
+            self._write_files(f, offset, self._root, None)
+
+# ==========================================================================
+# Functions
+# ==========================================================================
+
+def _pad(data, size, fill=' '):
+    return data[:size] + fill * (size - len(data[:size]))
+
+def _fat_datetime(mtime):
+    tm = time.localtime(mtime)
+    if tm.tm_year < 1980:
+        return (1 << 5) | 1, 0
+    date = ((tm.tm_year - 1980) << 9) | (tm.tm_mon << 5) | tm.tm_mday
+    return date, (tm.tm_hour << 11) | (tm.tm_min << 5) | (tm.tm_sec // 2)
+
+def _unicode_name(name):
+    if isinstance(name, unicode):
+        return name
+    return name.decode(sys.getfilesystemencoding() or 'utf-8', 'replace')
+
+def _short_part(part):
+    lossy = False
+    result = ''
+    for char in part.upper():
+        if char.isalnum() and ord(char) < 128 or char in _SHORT_NAME_CHARS:
+            result += str(char)
+        elif char in u' .':
+            lossy = True
+        else:
+            result += '_'
+            lossy = True
+    return result, lossy
+
+def _short_name(name, used):
+    """
+    Returns the 8.3 name (11 characters, padded) for the given file name,
+    unique among the `used` ones, and true if a long name entry is needed.
+    """
+
+    uname = _unicode_name(name)
+    stripped = uname.lstrip(u'.')
+    if u'.' in stripped:
+        base, ext = stripped.rsplit(u'.', 1)
+    else:
+        base, ext = stripped, u''
+    base, lossy_base = _short_part(base)
+    ext, lossy_ext = _short_part(ext)
+    lossy = (lossy_base or lossy_ext or stripped != uname or
+             len(base) > 8 or len(ext) > 3 or not base)
+    ext = ext[:3]
+    if not lossy:
+        short = _pad(base, 8) + _pad(ext, 3)
+        if short not in used:
+            dotted = base + ('.' + ext if ext else '')
+            return short, dotted != uname
+    for i in range(1, 1000000):
+        tail = '~%d' % i
+        short = _pad((base or '_')[:8 - len(tail)] + tail, 8) + _pad(ext, 3)
+        if short not in used:
+            return short, True
+    raise FatError('Too many similar names: %s' % name)
+
+def _lfn_count(name):
+    return (len(_unicode_name(name)) + LFN_CHARS - 1) // LFN_CHARS
+
+def _lfn_checksum(short_name):
+    checksum = 0
+    for char in short_name:
+        checksum = (((checksum & 1) << 7) + (checksum >> 1) + ord(char)) & 0xff
+    return checksum
+
+def _lfn_entries(name, short_name):
+    uname = _unicode_name(name)
+    if len(uname) > 255:
+        raise FatError('File name too long: %s' % name)
+    chars = uname.encode('utf-16-le')
+    if len(uname) % LFN_CHARS:
+        chars += '\x00\x00'
+        chars += '\xff' * (-len(chars) % (LFN_CHARS * 2))
+    checksum = _lfn_checksum(short_name)
+    count = len(chars) // (LFN_CHARS * 2)
+    entries = ''
+    for seq in range(count, 0, -1):
+        part = chars[(seq - 1) * LFN_CHARS * 2:seq * LFN_CHARS * 2]
+        order = seq | 0x40 if seq == count else seq
+        entries += struct.pack('<B10sBBB12sH4s', order, part[:10],
+                               ATTR_LONG_NAME, 0, checksum, part[10:22], 0,
+                               part[22:26])
+    return entries
+
+def _copy_file(path, size, f):
+    with open(path, 'rb') as src:
+        remaining = size
+        while remaining:
+            data = src.read(min(remaining, _COPY_CHUNK_B))
+            if not data:
+                raise FatError('%s changed while building the filesystem' %
+                               path)
+            f.write(data)
+            remaining -= len(data)
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# ==========================================================================
+#
+# Copyright (C) 2013-2014 RidgeRun, LLC (http://www.ridgerun.com)
+#
+# Author: Jose Pablo Carballo <jose.carballo@ridgerun.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# Partition layout planner.
+#
+# ==========================================================================
+
+"""
+The layout module turns the partitions of a memory map file, expressed in
+cylinders, into sector exact partition starts and sizes.
+
+SD cards and eMMC devices erase (and remap) data in erase blocks of a few
+megabytes; a partition not aligned to them turns filesystem writes into
+read-modify-write cycles of two erase blocks. :class:`LayoutPlanner` places
+each partition at the first aligned offset at or after the requested one,
+and rounds its size up to the alignment, so both the start and the end of
+every partition fall on an erase block boundary.
+
+With an alignment of 0 the planner returns the legacy cylinder layout, as
+created by `sfdisk -D` (see :func:`mbr.cylinder_layout`).
+"""
+
+# ==========================================================================
+# Imports
+# ==========================================================================
+
+import mbr
+
+# ==========================================================================
+# Constants
+# ==========================================================================
+
+#: Default alignment of the partitions (bytes), a common SD erase block size.
+DEFAULT_ALIGNMENT_B = 4 << 20
+
+# ==========================================================================
+# Public Classes
+# ==========================================================================
+
+class LayoutError(Exception):
+    """Layout exceptions."""
+
+class Layout(object):
+    """A planned partition layout."""
+
+    def __init__(self, partitions, total_sectors, sector_size, alignment_b):
+        """
+        :param partitions: List of (start, size) tuples, in sectors; the size
+            is None for a partition taking the rest of a device of unknown
+            size.
+        :param total_sectors: Size of the device (sectors), 0 if unknown.
+        :param sector_size: Sector size (bytes).
+        :param alignment_b: Alignment of the partitions (bytes), 0 for the
+            cylinder layout.
+        """
+
+        self.partitions = partitions
+        self.total_sectors = total_sectors
+        self.sector_size = sector_size
+        self.alignment_b = alignment_b
+
+    @property
+    def unused_b(self):
+        """
+        Space of the device outside of the partitions and the MBR (bytes):
+        the alignment gaps and any unpartitioned space at the end.
+        """
+
+        if not self.total_sectors:
+            return 0
+        used = 1 + sum([size or 0 for start, size in self.partitions])
+        return max(self.total_sectors - used, 0) * self.sector_size
+
+class LayoutPlanner(object):
+    """Plans erase block aligned partition layouts."""
+
+    def __init__(self, geometry, alignment_b=DEFAULT_ALIGNMENT_B):
+        """
+        :param geometry: Device geometry (i.e. :class:`SDCardGeometry`), used
+            to convert the cylinders of the memory map into sectors.
+        :param alignment_b: Alignment of the partitions (bytes), must be a
+            multiple of the sector size; 0 for the cylinder layout.
+        """
+
+        self._geometry = geometry
+        self._alignment_b = alignment_b
+
+    @property
+    def alignment_b(self):
+        """Alignment of the partitions (bytes), 0 for the cylinder layout."""
+
+        return self._alignment_b
+
+    def _align_up(self, sector, align):
+        return ((sector + align - 1) // align) * align
+
+    def plan(self, partitions, total_sectors):
+        """
+        Plans the layout of the given partitions.
+
+        :param partitions: List of partitions with `start` and `size` in
+            cylinders (i.e. :class:`SDCardPartition`); the size can be
+            `geometry.full_size` to take the rest of the device.
+        :param total_sectors: Size of the device (sectors), 0 if unknown
+            (i.e. in dryrun mode).
+        :returns: A :class:`Layout` instance.
+        :exception LayoutError: When the partitions don't fit in the device,
+            or on an invalid alignment.
+        """
+
+        sector_size = int(self._geometry.sector_byte_size)
+        cyl_sectors = int(self._geometry.heads * self._geometry.sectors)
+        if not self._alignment_b:
+            total_cyl = total_sectors // cyl_sectors
+            layout = mbr.cylinder_layout([p.start for p in partitions],
+                                         [p.size for p in partitions],
+                                         total_cyl, self._geometry)
+            return Layout(layout, total_sectors, sector_size, 0)
+        if self._alignment_b % sector_size:
+            raise LayoutError('The alignment (%s bytes) is not a multiple of '
+                              'the sector size (%s bytes)' %
+                              (self._alignment_b, sector_size))
+        align = self._alignment_b // sector_size
+        end_sector = (total_sectors // align) * align
+        layout = []
+        # The first sector holds the MBR
+        prev_end = 1
+        for part in partitions:
+            start = self._align_up(max(int(part.start) * cyl_sectors,
+                                       prev_end), align)
+            if part.size == self._geometry.full_size:
+                size = end_sector - start if total_sectors else None
+            else:
+                size = self._align_up(int(part.size) * cyl_sectors, align)
+            if size is not None:
+                if size <= 0 or (total_sectors and
+                                 start + size > total_sectors):
+                    raise LayoutError("Partition %s doesn't fit in the device "
+                                      "when aligned to %s KB" %
+                                      (part.name, self._alignment_b >> 10))
+                prev_end = start + size
+            layout.append((start, size))
+        return Layout(layout, total_sectors, sector_size, self._alignment_b)
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# ==========================================================================
+#
+# Copyright (C) 2013-2014 RidgeRun, LLC (http://www.ridgerun.com)
+#
+# Author: Jose Pablo Carballo <jose.carballo@ridgerun.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# Master Boot Record (MBR) partition table writer.
+#
+# ==========================================================================
+
+"""
+The mbr module writes a DOS/MBR partition table without external tools, so
+that images can be partitioned without superuser access.
+
+Partition entries are expressed in sectors. :func:`cylinder_layout` converts
+the cylinder based partitions used by the memory map files into sectors,
+matching the layout that `sfdisk -D` (DOS compatible mode) creates: a
+partition starting at cylinder 0 actually starts at the second track.
+"""
+
+# ==========================================================================
+# Imports
+# ==========================================================================
+
+import struct
+
+# ==========================================================================
+# Constants
+# ==========================================================================
+
+#: Offset of the partition table in the MBR.
+PARTITION_TABLE_OFFSET = 446
+
+#: Number of primary partitions.
+MAX_PARTITIONS = 4
+
+#: Boot signature.
+BOOT_SIGNATURE = '\x55\xaa'
+
+#: Partition types, as accepted by sfdisk.
+PARTITION_TYPES = {'L': 0x83, 'S': 0x82, 'E': 0x05, 'X': 0x85}
+
+# ==========================================================================
+# Public Classes
+# ==========================================================================
+
+class MBRError(Exception):
+    """MBR exceptions."""
+
+class MBRPartition(object):
+    """A primary partition entry."""
+
+    def __init__(self, start, size, part_type, bootable=False):
+        """
+        :param start: First sector of the partition.
+        :param size: Size of the partition (sectors).
+        :param part_type: Partition type, either an integer or a string as
+            accepted by sfdisk (i.e. 'L', '0xc').
+        :param bootable: Marks the partition as bootable.
+        """
+
+        self.start = int(start)
+        self.size = int(size)
+        self.type = type_id(part_type)
+        self.bootable = bootable
+
+    @property
+    def end(self):
+        """Sector following the last sector of the partition."""
+
+        return self.start + self.size
+
+# ==========================================================================
+# Functions
+# ==========================================================================
+
+def type_id(part_type):
+    """
+    Returns the numeric partition type.
+
+    :param part_type: Partition type, either an integer or a string as
+        accepted by sfdisk (i.e. 'L', '0xc', '83').
+    :exception MBRError: On an invalid type.
+    """
+
+    if isinstance(part_type, (int, long)):
+        type_num = part_type
+    elif str(part_type).upper() in PARTITION_TYPES:
+        type_num = PARTITION_TYPES[str(part_type).upper()]
+    else:
+        try:
+            # sfdisk takes the type in hex, with or without the 0x prefix
+            type_num = int(str(part_type), 16)
+        except ValueError:
+            raise MBRError('Invalid partition type: %s' % part_type)
+    if not 0 < type_num <= 0xff:
+        raise MBRError('Invalid partition type: %s' % part_type)
+    return type_num
+
+def _chs(lba, heads, sectors):
+    cyl = lba // int(heads * sectors)
+    if cyl > 1023:
+        # Doesn't fit CHS addressing, use the conventional maximum
+        return '\xfe\xff\xff'
+    head = (lba // int(sectors)) % int(heads)
+    sector = (lba % int(sectors)) + 1
+    return struct.pack('<BBB', head, sector | ((cyl >> 2) & 0xc0),
+                       cyl & 0xff)
+
+def partition_table(partitions, heads=255, sectors=63):
+    """
+    Returns the partition table and boot signature (the last 66 bytes of the
+    MBR).
+
+    :param partitions: List of :class:`MBRPartition`, up to 4.
+    :param heads: Heads used for the CHS addresses.
+    :param sectors: Sectors per track used for the CHS addresses.
+    :exception MBRError: On an invalid layout.
+    """
+
+    if len(partitions) > MAX_PARTITIONS:
+        raise MBRError('Only %d primary partitions are supported' %
+                       MAX_PARTITIONS)
+    table = ''
+    prev_end = 1
+    for part in partitions:
+        if part.size <= 0:
+            raise MBRError('Invalid partition size: %s sectors' % part.size)
+        if part.start < prev_end:
+            raise MBRError('Partition at sector %s overlaps the previous one '
+                           'or the MBR' % part.start)
+        if part.end > 0xffffffff:
+            raise MBRError('Partition exceeds the MBR addressing limit')
+        table += struct.pack('<B', 0x80 if part.bootable else 0x00)
+        table += _chs(part.start, heads, sectors)
+        table += struct.pack('<B', part.type)
+        table += _chs(part.end - 1, heads, sectors)
+        table += struct.pack('<II', part.start, part.size)
+        prev_end = part.end
+    table += '\x00' * (16 * (MAX_PARTITIONS - len(partitions)))
+    return table + BOOT_SIGNATURE
+
+def write_partition_table(filename, partitions, heads=255, sectors=63):
+    """
+    Writes the partition table into the MBR of the given file or device. The
+    boot code area (first 446 bytes) is preserved.
+
+    :param filename: Image file or device.
+    :param partitions: List of :class:`MBRPartition`, up to 4.
+    :param heads: Heads used for the CHS addresses.
+    :param sectors: Sectors per track used for the CHS addresses.
+    :exception MBRError: On an invalid layout.
+    :exception IOError: When unable to write.
+    """
+
+    write_table(filename, partition_table(partitions, heads, sectors))
+
+def write_table(filename, table):
+    """
+    Writes a partition table built by :func:`partition_table` into the MBR
+    of the given file or device. The boot code area is preserved.
+
+    :param filename: Image file or device.
+    :param table: Partition table and boot signature (66 bytes).
+    :exception IOError: When unable to write.
+    """
+
+    with open(filename, 'r+b') as f:
+        f.seek(PARTITION_TABLE_OFFSET)
+        f.write(table)
+
+def cylinder_layout(starts, sizes, total_cyl, geometry):
+    """
+    Converts partitions expressed in cylinders into (start, size) tuples in
+    sectors, as created by `sfdisk -D`.
+
+    :param starts: Start cylinder of each partition.
+    :param sizes: Size in cylinders of each partition; `geometry.full_size`
+        for a partition that takes the rest of the device.
+    :param total_cyl: Size of the device (cylinders).
+    :param geometry: Device geometry (i.e. :class:`SDCardGeometry`).
+    :returns: A list of (start, size) tuples, in sectors.
+    """
+
+    track = int(geometry.sectors)
+    cyl_sectors = int(geometry.heads * geometry.sectors)
+    layout = []
+    for start, size in zip(starts, sizes):
+        start = int(start)
+        if size == geometry.full_size:
+            size = total_cyl - start
+        start_sector = start * cyl_sectors
+        size_sectors = int(size) * cyl_sectors
+        if start == 0:
+            # DOS compatibility: the first track is reserved for the MBR
+            start_sector += track
+            size_sectors -= track
+        layout.append((start_sector, size_sectors))
+    return layout
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# ==========================================================================
+#
+# Copyright (C) 2013-2014 RidgeRun, LLC (http://www.ridgerun.com)
+#
+# Author: Jose Pablo Carballo <jose.carballo@ridgerun.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# Filesystem creation profiles.
+#
+# ==========================================================================
+
+"""
+The mkfs module holds the profiles that tune the filesystems created on each
+partition. A partition selects its profile in the memory map file:
+::
+    [rootfs]
+    name = rootfs
+    ...
+    filesystem = ext4-writeback
+    mkfs_profile = flash
+
+Profiles:
+
+ * `default`: Plain `mkfs.ext*` and `mkfs.vfat`, as always. The
+   `ext4-writeback` filesystems get their journal removed afterwards with
+   `tune2fs`.
+ * `flash`: Tuned for SD/eMMC media. The ext filesystems get a stride and
+   stripe width of one erase block (the partition alignment, see
+   :mod:`layout`), so the allocator groups writes in whole erase blocks;
+   the inode tables are initialized by `mkfs` instead of by the kernel in
+   the background on the first boot; and `ext4-writeback` filesystems are
+   created without a journal, in the same `mkfs` call. FAT partitions use
+   32 KB clusters, or the largest that still gives a valid FAT32.
+"""
+
+# ==========================================================================
+# Imports
+# ==========================================================================
+
+from partition import SDCardPartition
+
+# ==========================================================================
+# Constants
+# ==========================================================================
+
+PROFILE_DEFAULT = 'default'
+PROFILE_FLASH = 'flash'
+
+#: Block size of the ext filesystems of tuned profiles (bytes).
+EXT_BLOCK_SIZE = 4096
+
+#: Sector size used by `mkfs.vfat` (bytes).
+FAT_SECTOR_SIZE = 512
+
+#: Minimum number of clusters of a FAT32 filesystem.
+FAT32_MIN_CLUSTERS = 65525
+
+# ==========================================================================
+# Public Classes
+# ==========================================================================
+
+class MkfsError(Exception):
+    """Mkfs exceptions."""
+
+class MkfsProfile(object):
+    """Options used to create the filesystems of a partition."""
+
+    def __init__(self, name, erase_block_stride=False, lazy_itable_init=None,
+                 writeback_without_journal=False, fat_cluster_b=0):
+        """
+        :param name: Profile name.
+        :param erase_block_stride: Sets the ext stride and stripe width to
+            the erase block size.
+        :param lazy_itable_init: Value of the ext `lazy_itable_init` option;
+            none to use the `mke2fs` default.
+        :param writeback_without_journal: Creates the `ext4-writeback`
+            filesystems without a journal.
+        :param fat_cluster_b: FAT cluster size (bytes); 0 to use the
+            `mkfs.vfat` default.
+        """
+
+        self.name = name
+        self.erase_block_stride = erase_block_stride
+        self.lazy_itable_init = lazy_itable_init
+        self.writeback_without_journal = writeback_without_journal
+        self.fat_cluster_b = fat_cluster_b
+
+    def is_journalless(self, filesystem):
+        """
+        True if the given filesystem is created without a journal.
+
+        :param filesystem: Partition filesystem, i.e. 'ext4-writeback'.
+        """
+
+        return (self.writeback_without_journal and
+                filesystem == SDCardPartition.FILESYSTEM_EXT4_WRITEBACK)
+
+    def ext_args(self, filesystem, erase_block_b=0, extended=None):
+        """
+        Returns the arguments for `mkfs.ext*`, to append to the command
+        (with a leading space), or an empty string.
+
+        :param filesystem: Partition filesystem, i.e. 'ext4'.
+        :param erase_block_b: Erase block size (bytes); 0 if unknown.
+        :param extended: List of extended options (`-E`) required by the
+            caller, merged with the ones of the profile (`mke2fs` only takes
+            the last `-E`).
+        """
+
+        args = []
+        ext = list(extended or [])
+        if self.erase_block_stride and erase_block_b >= EXT_BLOCK_SIZE:
+            stride = erase_block_b // EXT_BLOCK_SIZE
+            args.append('-b %d' % EXT_BLOCK_SIZE)
+            ext += ['stride=%d' % stride, 'stripe_width=%d' % stride]
+        if self.lazy_itable_init is not None:
+            ext.append('lazy_itable_init=%d' % int(self.lazy_itable_init))
+        if self.is_journalless(filesystem):
+            args.append('-O ^has_journal')
+        if ext:
+            args.append('-E %s' % ','.join(ext))
+        return ''.join(' %s' % arg for arg in args)
+
+    def vfat_args(self, size_b=0, fat32=False):
+        """
+        Returns the arguments for `mkfs.vfat`, to append to the command
+        (with a leading space), or an empty string.
+
+        :param size_b: Partition size (bytes); 0 if unknown.
+        :param fat32: True if the filesystem is forced to FAT32.
+        """
+
+        cluster_b = self.fat_cluster_b
+        if not cluster_b:
+            return ''
+        if fat32:
+            if not size_b:
+                return ''
+            # Fewer clusters than the minimum are not a valid FAT32
+            while (cluster_b > FAT_SECTOR_SIZE and
+                   size_b // cluster_b < FAT32_MIN_CLUSTERS):
+                cluster_b //= 2
+        return ' -s %d' % (cluster_b // FAT_SECTOR_SIZE)
+
+# ==========================================================================
+# Globals
+# ==========================================================================
+
+#: Available profiles, by name.
+PROFILES = {
+    PROFILE_DEFAULT: MkfsProfile(PROFILE_DEFAULT),
+    PROFILE_FLASH: MkfsProfile(PROFILE_FLASH, erase_block_stride=True,
+                               lazy_itable_init=False,
+                               writeback_without_journal=True,
+                               fat_cluster_b=32 << 10),
+}
+
+# ==========================================================================
+# Functions
+# ==========================================================================
+
+def get_profile(name):
+    """
+    Returns the profile with the given name.
+
+    :param name: Profile name, i.e. 'flash'; empty for the default profile.
+    :exception MkfsError: On an unknown profile.
+    """
+
+    try:
+        return PROFILES[name or PROFILE_DEFAULT]
+    except KeyError:
+        raise MkfsError('Unknown mkfs profile: %s (available: %s)' %
+                        (name, ', '.join(sorted(PROFILES))))
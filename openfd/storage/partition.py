@@ -82,6 +82,8 @@ def read_sdcard_partitions(filename):
                 part.type = config.get(section, 'type')
             if config.has_option(section, 'filesystem'):
                 part.filesystem = config.get(section, 'filesystem')
+            if config.has_option(section, 'mkfs_profile'):
+                part.mkfs_profile = config.get(section, 'mkfs_profile')
             if config.has_option(section, 'components'):
                 components = config.get(section, 'components')
                 components = components.strip(', ')
@@ -115,6 +117,8 @@ def read_loopdevice_partitions(filename):
                 part.type = config.get(section, 'type')
             if config.has_option(section, 'filesystem'):
                 part.filesystem = config.get(section, 'filesystem')
+            if config.has_option(section, 'mkfs_profile'):
+                part.mkfs_profile = config.get(section, 'mkfs_profile')
             if config.has_option(section, 'components'):
                 components = config.get(section, 'components')
                 components = components.strip(', ')
@@ -300,6 +304,7 @@ class SDCardPartition(Partition):
         self._type = part_type
         self._filesystem = filesystem
         self._components = components
+        self._mkfs_profile = ''
     
     @classmethod
     def decode_partition_type(cls, partition_type):
@@ -371,6 +376,17 @@ class SDCardPartition(Partition):
                           :const:`FILESYSTEM_EXT4_WRITEBACK`,
                           :const:`FILESYSTEM_UNKNOWN`.""")
     
+    def __set_mkfs_profile(self, profile):
+        self._mkfs_profile = profile
+        
+    def __get_mkfs_profile(self):
+        return self._mkfs_profile
+    
+    mkfs_profile = property(__get_mkfs_profile, __set_mkfs_profile,
+                            doc="""Name of the profile used to create the
+                            filesystem, see :mod:`mkfs`; empty for the
+                            default profile.""")
+    
     def __set_bootable(self, bootable):
         self._bootable = bootable
         
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# ==========================================================================
+#
+# Copyright (C) 2013-2014 RidgeRun, LLC (http://www.ridgerun.com)
+#
+# Author: Jose Pablo Carballo <jose.carballo@ridgerun.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# Tests for the FAT filesystem writer.
+#
+# ==========================================================================
+
+import os, sys
+import shutil
+import struct
+import tempfile
+import unittest
+
+sys.path.insert(1, os.path.abspath('..'))
+
+import fat
+from fat import FatBuilder
+from fat import FatError
+
+FILES = {'MLO': 'M' * 5000,
+         'u-boot.img': 'U' * 70000,
+         'uEnv.txt': 'uenvcmd=boot\n',
+         'empty': '',
+         'dtbs/imx6q-sabresd.dtb': 'D' * 100}
+
+class FatReader(object):
+    """Minimal reader, to check the written filesystems."""
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            self.data = f.read()
+        (self.spc, self.reserved, fats, root_entries, total16, fat16_size,
+         total32, fat32_size, self.root_cluster) = \
+            struct.unpack('<xxxxxxxxxxxxxBHBHHxHxxxxxxxxIIxxxxI',
+                          self.data[:48])
+        self.fat32 = fat16_size == 0
+        self.fat_size = fat32_size if self.fat32 else fat16_size
+        self.fat_start = self.reserved * 512
+        self.root_start = self.fat_start + fats * self.fat_size * 512
+        self.data_start = self.root_start + root_entries * 32
+
+    def next_cluster(self, cluster):
+        if self.fat32:
+            return struct.unpack_from('<I', self.data,
+                                      self.fat_start + cluster * 4)[0]
+        return struct.unpack_from('<H', self.data,
+                                  self.fat_start + cluster * 2)[0]
+
+    def read_chain(self, cluster, size=None):
+        data = ''
+        cluster_b = self.spc * 512
+        while 2 <= cluster < 0xfff8 or (self.fat32 and
+                                        2 <= cluster < 0x0ffffff8):
+            offset = self.data_start + (cluster - 2) * cluster_b
+            data += self.data[offset:offset + cluster_b]
+            cluster = self.next_cluster(cluster)
+        return data if size is None else data[:size]
+
+    def entries(self, dir_data):
+        """Returns (long name, short name, attr, cluster, size) tuples."""
+
+        result = []
+        lfn = ''
+        for i in range(0, len(dir_data), 32):
+            entry = dir_data[i:i + 32]
+            if entry[0] == '\x00':
+                break
+            if ord(entry[11]) == fat.ATTR_LONG_NAME:
+                chars = entry[1:11] + entry[14:26] + entry[28:32]
+                lfn = chars.decode('utf-16-le').split(u'\x00')[0] + lfn
+                continue
+            hi, lo, size = struct.unpack('<HxxxxHI', entry[20:32])
+            result.append((lfn or None, entry[:11], ord(entry[11]),
+                           (hi << 16) | lo, size))
+            lfn = ''
+        return result
+
+    def root(self):
+        if self.fat32:
+            return self.entries(self.read_chain(self.root_cluster))
+        return self.entries(self.data[self.root_start:self.data_start])
+
+class FatBuilderTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        for name, content in FILES.items():
+            path = os.path.join(self.dir, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as f:
+                f.write(content)
+        fd, self.image = tempfile.mkstemp(suffix='.img')
+        os.close(fd)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        os.remove(self.image)
+
+    def build(self, size_b, **kwargs):
+        with open(self.image, 'wb') as f:
+            f.truncate(size_b)
+        builder = FatBuilder(size_b, label='boot', **kwargs)
+        builder.add_directory(self.dir)
+        builder.write(self.image)
+        return builder
+
+    def check_contents(self, reader):
+        root = reader.root()
+        self.assertEqual(root[0][1:3], ('boot'.ljust(11), fat.ATTR_VOLUME_ID))
+        # MLO first, in the first cluster of the data area
+        first = root[1]
+        self.assertEqual(first[1], 'MLO'.ljust(11))
+        self.assertEqual(first[3], reader.root_cluster + 1 if reader.fat32
+                         else 2)
+        files = {}
+        for lfn, short, attr, cluster, size in root[1:]:
+            files[lfn or short.strip()] = (attr, cluster, size)
+        for name in ['u-boot.img', 'uEnv.txt', 'empty']:
+            attr, cluster, size = files[name]
+            self.assertEqual(reader.read_chain(cluster, size), FILES[name])
+        attr, cluster, size = files['dtbs']
+        self.assertEqual(attr, fat.ATTR_DIRECTORY)
+        subdir = reader.entries(reader.read_chain(cluster))
+        self.assertEqual([e[1] for e in subdir[:2]], ['.'.ljust(11),
+                                                       '..'.ljust(11)])
+        lfn, short, attr, cluster, size = subdir[2]
+        self.assertEqual(lfn, 'imx6q-sabresd.dtb')
+        self.assertEqual(short, 'IMX6Q-~1DTB')
+        self.assertEqual(reader.read_chain(cluster, size),
+                         FILES['dtbs/imx6q-sabresd.dtb'])
+
+    def test_fat16(self):
+        builder = self.build(64 << 20)
+        self.assertEqual(builder.fat_bits, 16)
+        reader = FatReader(self.image)
+        self.assertFalse(reader.fat32)
+        self.check_contents(reader)
+
+    def test_fat32(self):
+        builder = self.build(600 << 20, cluster_b=32768)
+        self.assertEqual(builder.fat_bits, 32)
+        # Halved to keep the minimum FAT32 cluster count
+        self.assertEqual(builder.cluster_b, 8192)
+        reader = FatReader(self.image)
+        self.assertTrue(reader.fat32)
+        self.check_contents(reader)
+
+    def test_short_names(self):
+        used = set()
+        self.assertEqual(fat._short_name('MLO', used), ('MLO'.ljust(11),
+                                                        False))
+        self.assertEqual(fat._short_name('uImage', used), ('UIMAGE'.ljust(11),
+                                                           True))
+        used.add('UIMAGE'.ljust(11))
+        self.assertEqual(fat._short_name('UIMAGE', used),
+                         ('UIMAGE~1'.ljust(11), True))
+
+    def test_errors(self):
+        self.assertRaises(FatError, FatBuilder, 1 << 20)
+        with open(os.path.join(self.dir, 'big'), 'wb') as f:
+            f.write('B' * (4 << 20))
+        self.assertRaises(FatError, self.build, 4 << 20)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# ==========================================================================
+#
+# Copyright (C) 2013-2014 RidgeRun, LLC (http://www.ridgerun.com)
+#
+# Author: Jose Pablo Carballo <jose.carballo@ridgerun.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# Tests for the layout module.
+#
+# ==========================================================================
+
+import os, sys
+import unittest
+
+sys.path.insert(1, os.path.abspath('..'))
+
+from layout import LayoutPlanner
+from layout import LayoutError
+
+class Geometry(object):
+    heads = 255
+    sectors = 63
+    sector_byte_size = 512
+    full_size = '-'
+
+class Partition(object):
+    def __init__(self, name, start, size):
+        self.name = name
+        self.start = start
+        self.size = size
+
+# 256 MB device
+TOTAL_SECTORS = 524288
+
+PARTITIONS = [Partition('boot', '0', '8'), Partition('rootfs', '10', '-')]
+
+class LayoutTestCase(unittest.TestCase):
+
+    def test_aligned(self):
+        plan = LayoutPlanner(Geometry()).plan(PARTITIONS, TOTAL_SECTORS)
+        self.assertEqual(plan.partitions, [(8192, 131072), (163840, 360448)])
+        for start, size in plan.partitions:
+            self.assertEqual(start % 8192, 0)
+            self.assertEqual(size % 8192, 0)
+        # Before the first partition and between both partitions
+        self.assertEqual(plan.unused_b, (8191 + 24576) * 512)
+
+    def test_cylinder_layout(self):
+        plan = LayoutPlanner(Geometry(), 0).plan(PARTITIONS, TOTAL_SECTORS)
+        self.assertEqual(plan.partitions, [(63, 128457), (160650, 353430)])
+
+    def test_unknown_size(self):
+        plan = LayoutPlanner(Geometry()).plan(PARTITIONS, 0)
+        self.assertEqual(plan.partitions, [(8192, 131072), (163840, None)])
+        self.assertEqual(plan.unused_b, 0)
+
+    def test_overlap_moves_partition(self):
+        parts = [Partition('boot', '0', '1'), Partition('rootfs', '1', '1')]
+        plan = LayoutPlanner(Geometry(), 1 << 20).plan(parts, TOTAL_SECTORS)
+        self.assertEqual(plan.partitions, [(2048, 16384), (18432, 16384)])
+
+    def test_invalid(self):
+        parts = [Partition('boot', '0', '40')]
+        self.assertRaises(LayoutError, LayoutPlanner(Geometry()).plan, parts,
+                          TOTAL_SECTORS)
+        self.assertRaises(LayoutError, LayoutPlanner(Geometry(), 1000).plan,
+                          PARTITIONS, TOTAL_SECTORS)
+
+if __name__ == '__main__':
+    unittest.main()
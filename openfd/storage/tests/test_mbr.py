@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# ==========================================================================
+#
+# Copyright (C) 2013-2014 RidgeRun, LLC (http://www.ridgerun.com)
+#
+# Author: Jose Pablo Carballo <jose.carballo@ridgerun.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# Tests for the mbr module.
+#
+# ==========================================================================
+
+import os, sys
+import struct
+import tempfile
+import unittest
+
+sys.path.insert(1, os.path.abspath('..'))
+
+import mbr
+from mbr import MBRPartition
+from mbr import MBRError
+
+class Geometry(object):
+    heads = 255
+    sectors = 63
+    full_size = '-'
+
+class MBRTestCase(unittest.TestCase):
+
+    def test_partition_table(self):
+        parts = [MBRPartition(63, 128457, '0xc', bootable=True),
+                 MBRPartition(160650, 257040, 'L')]
+        table = mbr.partition_table(parts)
+        self.assertEqual(len(table), 66)
+        self.assertEqual(table[-2:], mbr.BOOT_SIGNATURE)
+        boot, ptype = struct.unpack('<B3xB', table[0:5])
+        self.assertEqual((boot, ptype), (0x80, 0x0c))
+        self.assertEqual(struct.unpack('<II', table[8:16]), (63, 128457))
+        self.assertEqual(struct.unpack('<B', table[20])[0], 0x83)
+        self.assertEqual(table[32:64], '\x00' * 32)
+
+    def test_invalid_layouts(self):
+        self.assertRaises(MBRError, mbr.partition_table,
+                          [MBRPartition(0, 10, 'L')])
+        self.assertRaises(MBRError, mbr.partition_table,
+                          [MBRPartition(63, 100, 'L'),
+                           MBRPartition(100, 100, 'L')])
+        self.assertRaises(MBRError, mbr.type_id, 'Z')
+
+    def test_cylinder_layout(self):
+        layout = mbr.cylinder_layout(['0', '10'], ['8', '-'], 26, Geometry())
+        self.assertEqual(layout, [(63, 128457), (160650, 257040)])
+
+    def test_write_preserves_boot_code(self):
+        fd, filename = tempfile.mkstemp()
+        os.write(fd, '\xab' * 1024)
+        os.close(fd)
+        try:
+            mbr.write_partition_table(filename, [MBRPartition(63, 100, 'L')])
+            with open(filename, 'rb') as f:
+                data = f.read()
+            self.assertEqual(data[:446], '\xab' * 446)
+            self.assertEqual(data[510:512], mbr.BOOT_SIGNATURE)
+            self.assertEqual(data[512:], '\xab' * 512)
+        finally:
+            os.remove(filename)
+
+if __name__ == '__main__':
+    unittest.main()
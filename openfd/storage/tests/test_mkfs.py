@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# ==========================================================================
+#
+# Copyright (C) 2013-2014 RidgeRun, LLC (http://www.ridgerun.com)
+#
+# Author: Jose Pablo Carballo <jose.carballo@ridgerun.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# Tests for the mkfs profiles.
+#
+# ==========================================================================
+
+import os, sys
+import unittest
+
+sys.path.insert(1, os.path.abspath('..'))
+
+import mkfs
+from mkfs import MkfsError
+
+class MkfsProfileTestCase(unittest.TestCase):
+
+    def test_default(self):
+        profile = mkfs.get_profile('')
+        self.assertEqual(profile.ext_args('ext4-writeback', 4 << 20), '')
+        self.assertEqual(profile.ext_args('ext3', 4 << 20,
+                                          ['root_owner=0:0']),
+                         ' -E root_owner=0:0')
+        self.assertEqual(profile.vfat_args(64 << 20, fat32=True), '')
+        self.assertFalse(profile.is_journalless('ext4-writeback'))
+
+    def test_flash_ext(self):
+        profile = mkfs.get_profile('flash')
+        self.assertEqual(profile.ext_args('ext4-writeback', 4 << 20,
+                                          ['root_owner=0:0']),
+                         ' -b 4096 -O ^has_journal -E root_owner=0:0,'
+                         'stride=1024,stripe_width=1024,lazy_itable_init=0')
+        self.assertEqual(profile.ext_args('ext4'),
+                         ' -E lazy_itable_init=0')
+        self.assertTrue(profile.is_journalless('ext4-writeback'))
+        self.assertFalse(profile.is_journalless('ext4'))
+
+    def test_flash_vfat(self):
+        profile = mkfs.get_profile('flash')
+        self.assertEqual(profile.vfat_args(64 << 20), ' -s 64')
+        self.assertEqual(profile.vfat_args(4 << 30, fat32=True), ' -s 64')
+        # 64 MB only hold a valid FAT32 with 1 KB clusters
+        self.assertEqual(profile.vfat_args(64 << 20, fat32=True), ' -s 2')
+        self.assertEqual(profile.vfat_args(0, fat32=True), '')
+
+    def test_unknown(self):
+        self.assertRaises(MkfsError, mkfs.get_profile, 'none')
+
+if __name__ == '__main__':
+    unittest.main()
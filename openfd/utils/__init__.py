@@ -1,4 +1,10 @@
 from executer import *
 from logger import *
 from hexutils import *
-from args import *
\ No newline at end of file
+from args import *
+from sudoworker import *
+from probe import *
+from tracer import *
+from session import *
+from rawwriter import *
+from treecopy import *
\ No newline at end of file
@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+# ==========================================================================
+#
+# Copyright (C) 2013-2014 RidgeRun, LLC (http://www.ridgerun.com)
+#
+# Author: Jose Pablo Carballo <jose.carballo@ridgerun.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# Compresses SD card images in parallel chunks.
+#
+# ==========================================================================
+
+"""
+The compressor module compresses an SD card image (i.e. 'sd.img' into
+'sd.img.zst') for publishing it:
+
+ * The image is split in chunks of :const:`CHUNK_SIZE` bytes, compressed
+   by several workers at once, each one running a single threaded
+   compressor. The compressed chunks are concatenated in order; zstd, xz
+   and gzip all decompress concatenated frames (streams, members) as one,
+   so the result is a regular compressed image, see
+   :func:`tarball.decompress_cmd`.
+ * The chunks that fall completely in a hole of the (sparse) image are not
+   read: the compressed zeros are reused from the first hole chunk.
+ * The sha256 checksum of the compressed image is written next to it (the
+   compressed name plus `.sha256`), in the format of `sha256sum`, so it can
+   be checked with `sha256sum -c`.
+"""
+
+# ==========================================================================
+# Imports
+# ==========================================================================
+
+import os
+import io
+import time
+import errno
+import Queue
+import hashlib
+import threading
+import subprocess
+import multiprocessing
+import fileutils
+
+# ==========================================================================
+# Constants
+# ==========================================================================
+
+# Image formats
+IMAGE_FORMAT_RAW = 'raw'
+IMAGE_FORMAT_ZSTD = 'zstd'
+IMAGE_FORMAT_XZ = 'xz'
+IMAGE_FORMAT_GZ = 'gz'
+
+#: Supported image formats, the first one leaves the image uncompressed.
+IMAGE_FORMATS = [IMAGE_FORMAT_RAW, IMAGE_FORMAT_ZSTD, IMAGE_FORMAT_XZ,
+                 IMAGE_FORMAT_GZ]
+
+#: Extension of the compressed images, appended to the image name.
+IMAGE_EXTENSIONS = {
+    IMAGE_FORMAT_ZSTD: '.zst',
+    IMAGE_FORMAT_XZ: '.xz',
+    IMAGE_FORMAT_GZ: '.gz',
+}
+
+#: Single threaded compressor of each chunk: the chunks are compressed in
+#: parallel. Each one reads the chunk from stdin and writes into stdout.
+COMPRESSORS = {
+    IMAGE_FORMAT_ZSTD: ['zstd', '-q', '-c', '-T1'],
+    IMAGE_FORMAT_XZ: ['xz', '-q', '-c', '-T1'],
+    IMAGE_FORMAT_GZ: ['gzip', '-n', '-c'],
+}
+
+#: Size of the chunks compressed by each worker.
+CHUNK_SIZE = 32 << 20
+
+#: Extension of the checksum file, appended to the compressed image name.
+CHECKSUM_EXTENSION = '.sha256'
+
+# ==========================================================================
+# Public Classes
+# ==========================================================================
+
+class CompressorError(Exception):
+    """Compressor exceptions."""
+
+class ImageCompressor(object):
+    """
+    Compresses an image in parallel chunks, see :mod:`compressor`.
+    Usage:
+    ::
+        compressor = ImageCompressor('sd.img', IMAGE_FORMAT_ZSTD)
+        compressor.run()
+    """
+
+    def __init__(self, image, image_format, workers=0,
+                 chunk_size=CHUNK_SIZE):
+        """
+        :param image: Image file.
+        :param image_format: One of :const:`IMAGE_FORMATS`, except
+            :const:`IMAGE_FORMAT_RAW`.
+        :param workers: Chunks compressed at a time; by default one per CPU.
+        :param chunk_size: Size of the chunks (bytes).
+        :exception CompressorError: On an unknown image format.
+        """
+
+        if image_format not in COMPRESSORS:
+            raise CompressorError('Unknown image format: %s' % image_format)
+        self._image = image
+        self._format = image_format
+        self._workers = workers or multiprocessing.cpu_count()
+        self._chunk_size = chunk_size
+        self._output = compressed_name(image, image_format)
+        self._bytes_in = 0
+        self._bytes_out = 0
+        self._hole_chunks = 0
+        self._elapsed = 0.0
+        self._zeros = {}
+        self._zeros_lock = threading.Lock()
+
+    @property
+    def output(self):
+        """Compressed image file."""
+
+        return self._output
+
+    @property
+    def checksum_file(self):
+        """Checksum file of the compressed image."""
+
+        return self._output + CHECKSUM_EXTENSION
+
+    @property
+    def bytes_in(self):
+        """Bytes of the image compressed."""
+
+        return self._bytes_in
+
+    @property
+    def bytes_out(self):
+        """Bytes of the compressed image."""
+
+        return self._bytes_out
+
+    @property
+    def hole_chunks(self):
+        """Chunks that fell in holes of the image, and were not read."""
+
+        return self._hole_chunks
+
+    @property
+    def elapsed(self):
+        """Seconds spent compressing the image."""
+
+        return self._elapsed
+
+    def _chunks(self, fd, size_b):
+        # (offset, length, has data) of each chunk
+        segments = fileutils.data_segments(fd, size_b)
+        chunks = []
+        for offset in xrange(0, size_b, self._chunk_size):
+            length = min(self._chunk_size, size_b - offset)
+            data = [s for s in segments if s[0] < offset + length and
+                    s[0] + s[1] > offset]
+            chunks.append((offset, length, bool(data)))
+        return chunks
+
+    def _compress(self, data):
+        try:
+            proc = subprocess.Popen(COMPRESSORS[self._format],
+                                    stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                raise CompressorError('%s is not installed' %
+                                      COMPRESSORS[self._format][0])
+            raise CompressorError(e)
+        output, error = proc.communicate(data)
+        if proc.returncode != 0:
+            raise CompressorError('%s failed: %s' %
+                                  (COMPRESSORS[self._format][0],
+                                   error.strip()))
+        return output
+
+    def _compress_zeros(self, length):
+        # The hole chunks have the same length (but the last one), their
+        # compressed data is the same too
+        with self._zeros_lock:
+            if length not in self._zeros:
+                self._zeros[length] = self._compress('\0' * length)
+            return self._zeros[length]
+
+    def _work(self, tasks, results):
+        src = io.open(self._image, 'rb')
+        try:
+            while True:
+                task = tasks.get()
+                if task is None:
+                    break
+                index, (offset, length, has_data) = task
+                try:
+                    if has_data:
+                        src.seek(offset)
+                        data = src.read(length)
+                        if len(data) != length:
+                            raise CompressorError('Unexpected end of %s at '
+                                                  '%s' % (self._image,
+                                                          offset + len(data)))
+                        results[index] = self._compress(data)
+                    else:
+                        results[index] = self._compress_zeros(length)
+                except (CompressorError, IOError) as e:
+                    results[index] = e
+        finally:
+            src.close()
+
+    def _wait(self, results, index):
+        while index not in results:
+            # Event-less polling keeps the main thread interruptible
+            time.sleep(0.01)
+        result = results.pop(index)
+        if isinstance(result, Exception):
+            raise CompressorError(result)
+        return result
+
+    def _write_checksum(self, digest):
+        try:
+            with open(self.checksum_file, 'w') as f:
+                f.write('%s  %s\n' % (digest, os.path.basename(self._output)))
+        except IOError as e:
+            raise CompressorError('Unable to write %s: %s' %
+                                  (self.checksum_file, e.strerror))
+
+    def run(self):
+        """
+        Compresses the image into :attr:`output`, and writes its checksum
+        into :attr:`checksum_file`. The image is left untouched.
+
+        :exception CompressorError: On failure compressing the image.
+        """
+
+        start = time.time()
+        try:
+            fd = os.open(self._image, os.O_RDONLY)
+        except OSError as e:
+            raise CompressorError('Unable to open %s: %s' % (self._image,
+                                                             e.strerror))
+        try:
+            size_b = os.fstat(fd).st_size
+            chunks = self._chunks(fd, size_b)
+        finally:
+            os.close(fd)
+        tasks = Queue.Queue()
+        results = {}
+        threads = []
+        for i in range(min(self._workers, len(chunks)) or 1):
+            thread = threading.Thread(target=self._work,
+                                      args=(tasks, results))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        partial = self._output + '.part'
+        digest = hashlib.sha256()
+        try:
+            with open(partial, 'wb') as out:
+                # Keep a bounded window of chunks in flight, so the memory
+                # used is bounded too
+                window = 2 * len(threads)
+                queued = 0
+                for index in range(len(chunks)):
+                    while queued < len(chunks) and queued < index + window:
+                        tasks.put((queued, chunks[queued]))
+                        queued += 1
+                    data = self._wait(results, index)
+                    out.write(data)
+                    digest.update(data)
+                    self._bytes_in += chunks[index][1]
+                    self._bytes_out += len(data)
+                    if not chunks[index][2]:
+                        self._hole_chunks += 1
+            os.rename(partial, self._output)
+        except (IOError, OSError) as e:
+            raise CompressorError('Failed writing %s: %s' % (self._output, e))
+        finally:
+            for thread in threads:
+                tasks.put(None)
+            for thread in threads:
+                # join() without a timeout can't be interrupted in Python 2
+                while thread.is_alive():
+                    thread.join(1)
+            if os.path.exists(partial):
+                os.remove(partial)
+        self._write_checksum(digest.hexdigest())
+        self._elapsed = time.time() - start
+
+# ==========================================================================
+# Functions
+# ==========================================================================
+
+def compressed_name(image, image_format):
+    """
+    Returns the name of the image compressed in the given format, i.e.
+    'sd.img.zst' for 'sd.img' and :const:`IMAGE_FORMAT_ZSTD`; the same name
+    for :const:`IMAGE_FORMAT_RAW`.
+
+    :param image: Image file.
+    :param image_format: One of :const:`IMAGE_FORMATS`.
+    """
+
+    return image + IMAGE_EXTENSIONS.get(image_format, '')
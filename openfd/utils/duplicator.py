@@ -0,0 +1,436 @@
+#!/usr/bin/env python
+# ==========================================================================
+#
+# Copyright (C) 2013-2014 RidgeRun, LLC (http://www.ridgerun.com)
+#
+# Author: Jose Pablo Carballo <jose.carballo@ridgerun.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# Writes an image into several devices at once.
+#
+# ==========================================================================
+
+"""
+The duplicator module writes an image into several devices at once (i.e. a
+batch of SD cards), reading the image only once:
+
+ * A reader thread reads the image (only the regions mapped in its block
+   map, or the regions with data) into buffers that are shared by all the
+   devices.
+ * Each device has a writer thread (see :class:`rawwriter.RawWriter`) and a
+   bounded queue of pending buffers, so the memory used is bounded too.
+ * A device that fails is dropped, and so is a device that doesn't take a
+   buffer for :const:`DEFAULT_STALL_TIMEOUT` seconds (i.e. a stuck card) or
+   that, after :const:`SLOW_WINDOW` seconds, writes below
+   :const:`SLOW_FRACTION` of the median speed of the devices (i.e. a
+   faulty card that would hold up the others); the other devices go on.
+   The speed of a device is measured while it writes, so the time it waits
+   for the slower ones doesn't count.
+
+Writing into devices needs superuser access, so the duplicator is also a
+standalone program, executed through `sudo` (see :func:`duplicate_cmd`). It
+prints its progress periodically and a report per device:
+::
+    sudo python duplicator.py --image sd.img --bmap sd.img.bmap \\
+        --device /dev/sdb --device /dev/sdc
+    duplicator: progress 104857600 of 419430400 bytes in 1.000 s
+    duplicator: /dev/sdb 419430400 bytes in 21.318 s
+    duplicator: /dev/sdc failed after 8388608 bytes in 1.722 s: ...
+
+Only the standard library (and :mod:`rawwriter`, a sibling module) can be
+used here.
+"""
+
+# ==========================================================================
+# Imports
+# ==========================================================================
+
+import os
+import io
+import sys
+import time
+import Queue
+import argparse
+import threading
+import fileutils
+import rawwriter
+
+# ==========================================================================
+# Constants
+# ==========================================================================
+
+#: Size of the buffers read from the image.
+BUFFER_SIZE = rawwriter.BUFFER_SIZE
+
+#: Buffers queued per device.
+QUEUE_BUFFERS = 16
+
+#: Seconds a device can take to accept a buffer before it is dropped.
+DEFAULT_STALL_TIMEOUT = 60
+
+#: Seconds the reader waits at a time for a device with a full queue.
+QUEUE_WAIT = 0.1
+
+#: Seconds the devices write before their speeds are compared.
+SLOW_WINDOW = 10.0
+
+#: A device writing below this fraction of the median speed is dropped.
+SLOW_FRACTION = 0.5
+
+#: Seconds between progress reports.
+PROGRESS_INTERVAL = 1.0
+
+#: Prefix of the report lines.
+REPORT_PREFIX = 'duplicator:'
+
+# ==========================================================================
+# Public Classes
+# ==========================================================================
+
+class DuplicatorError(Exception):
+    """Duplicator exceptions."""
+
+class DuplicatorTarget(object):
+    """State of a device written by the :class:`Duplicator`."""
+
+    def __init__(self, device):
+        self.device = device
+        self.bytes_written = 0
+        self.elapsed = 0.0
+        self.error = ''
+        self._writer = None
+        self._pending = Queue.Queue(QUEUE_BUFFERS)
+        self._thread = None
+        self._write_secs = 0.0
+        self._write_start = None
+
+    @property
+    def ok(self):
+        """True if the image was written into the device."""
+
+        return not self.error
+
+    @property
+    def speed(self):
+        """
+        Bytes per second written by the device, counting only the time
+        spent writing (including the write in progress); none before the
+        first write.
+        """
+
+        secs = self._write_secs
+        start = self._write_start
+        if start is not None:
+            secs += time.time() - start
+        if secs <= 0:
+            return None
+        return self.bytes_written / secs
+
+class Duplicator(object):
+    """Writes an image into several devices at once, see :mod:`duplicator`."""
+
+    def __init__(self, image, devices, ranges=None, direct=True,
+                 stall_timeout=DEFAULT_STALL_TIMEOUT):
+        """
+        :param image: Image file.
+        :param devices: Devices (or files) to write into.
+        :param ranges: Regions of the image to write, as (offset, length)
+            tuples (bytes); by default the regions with data (`SEEK_DATA`).
+        :param direct: Write bypassing the page cache (`O_DIRECT`).
+        :param stall_timeout: Seconds a device can take to accept a buffer
+            before it is dropped.
+        """
+
+        self._image = image
+        self._targets = [DuplicatorTarget(device) for device in devices]
+        self._ranges = ranges
+        self._direct = direct
+        self._stall_timeout = stall_timeout
+        self._bytes_read = 0
+        self._total = 0
+        self._start_time = None
+
+    @property
+    def targets(self):
+        """List of :class:`DuplicatorTarget`, one per device."""
+
+        return self._targets
+
+    @property
+    def bytes_read(self):
+        """Bytes of the image read (and queued for the devices)."""
+
+        return self._bytes_read
+
+    @property
+    def bytes_total(self):
+        """Bytes of the image to write into each device."""
+
+        return self._total
+
+    @property
+    def elapsed(self):
+        """Seconds since the duplication started."""
+
+        if self._start_time is None:
+            return 0.0
+        return time.time() - self._start_time
+
+    def _write_target(self, target):
+        while True:
+            item = target._pending.get()
+            if item is None or target.error:
+                # Done, or dropped by the reader
+                break
+            offset, data = item
+            target._write_start = time.time()
+            try:
+                target._writer.write_data(data, offset)
+                target.bytes_written += len(data)
+                target._write_secs += time.time() - target._write_start
+                target._write_start = None
+            except rawwriter.RawWriterError as e:
+                # The reader stops queueing buffers for this device
+                target.error = str(e)
+                target.elapsed = self.elapsed
+                return
+        if not target.error:
+            try:
+                target._writer.close()
+            except rawwriter.RawWriterError as e:
+                target.error = str(e)
+            target.elapsed = self.elapsed
+
+    def _live(self):
+        return [t for t in self._targets if not t.error]
+
+    def _too_slow(self, target):
+        # True if the device writes far below the median speed
+        if self.elapsed < SLOW_WINDOW:
+            return False
+        speeds = sorted(t.speed for t in self._live()
+                        if t.speed is not None)
+        speed = target.speed
+        if len(speeds) < 2 or speed is None:
+            return False
+        median = speeds[len(speeds) // 2]
+        return speed < SLOW_FRACTION * median
+
+    def _drop(self, target, reason):
+        target.elapsed = self.elapsed
+        target.error = reason
+
+    def _queue(self, target, item, slow_check=True):
+        # Waits in short steps, so a device that fails meanwhile, or holds
+        # up the others, is dropped without blocking the reader any longer
+        start = time.time()
+        while not target.error:
+            try:
+                target._pending.put(item, timeout=QUEUE_WAIT)
+                return
+            except Queue.Full:
+                pass
+            if time.time() - start >= self._stall_timeout:
+                self._drop(target, 'stalled for %s s, dropped' %
+                           self._stall_timeout)
+            elif slow_check and self._too_slow(target):
+                self._drop(target, '%.1f MB/s, slower than the other devices, '
+                           'dropped' % (target.speed / float(1 << 20)))
+
+    def _read(self, src):
+        for offset, length in self._ranges:
+            end = offset + length
+            while offset < end and self._live():
+                src.seek(offset)
+                data = src.read(min(BUFFER_SIZE, end - offset))
+                if not data:
+                    raise DuplicatorError('Unexpected end of %s at %s' %
+                                          (self._image, offset))
+                # The same buffer is queued for every device
+                for target in self._live():
+                    self._queue(target, (offset, data))
+                offset += len(data)
+                self._bytes_read += len(data)
+
+    def run(self):
+        """
+        Writes the image into the devices. The errors on single devices
+        don't stop the others, see :attr:`targets`.
+
+        :exception DuplicatorError: When unable to read the image.
+        """
+
+        self._start_time = time.time()
+        try:
+            src = io.open(self._image, 'rb')
+        except IOError as e:
+            raise DuplicatorError('Unable to open %s: %s' % (self._image,
+                                                             e.strerror))
+        try:
+            if self._ranges is None:
+                size_b = os.fstat(src.fileno()).st_size
+                self._ranges = list(fileutils.data_segments(src.fileno(),
+                                                            size_b))
+            self._total = sum(length for offset, length in self._ranges)
+            for target in self._targets:
+                try:
+                    target._writer = rawwriter.RawWriter(target.device,
+                                                         direct=self._direct)
+                except rawwriter.RawWriterError as e:
+                    target.error = str(e)
+                    continue
+                target._thread = threading.Thread(target=self._write_target,
+                                                  args=(target,))
+                target._thread.daemon = True
+                target._thread.start()
+            try:
+                self._read(src)
+            except (IOError, OSError) as e:
+                raise DuplicatorError('Failed reading %s: %s' %
+                                      (self._image, e))
+            finally:
+                # The reader is done, the slow devices hold up no one now
+                for target in self._live():
+                    self._queue(target, None, slow_check=False)
+                for target in self._targets:
+                    # Failed and dropped devices are not waited for
+                    while (target._thread and target._thread.is_alive() and
+                           not target.error):
+                        # join() without a timeout can't be interrupted
+                        target._thread.join(1)
+        finally:
+            src.close()
+
+# ==========================================================================
+# Functions
+# ==========================================================================
+
+def duplicate_cmd(image, devices, bmap_file='', direct=True,
+                  stall_timeout=DEFAULT_STALL_TIMEOUT):
+    """
+    Returns the command that runs this module as a program, through `sudo`,
+    to write the image into the given devices.
+
+    :param image: Image file.
+    :param devices: Devices to write into.
+    :param bmap_file: Write only the regions mapped in this block map; by
+        default the regions of the image with data.
+    :param direct: Write bypassing the page cache (`O_DIRECT`).
+    :param stall_timeout: Seconds a device can take to accept a buffer
+        before it is dropped.
+    """
+
+    program = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+    cmd = 'sudo %s %s --image %s' % (sys.executable, program, image)
+    for device in devices:
+        cmd += ' --device %s' % device
+    if bmap_file:
+        cmd += ' --bmap %s' % bmap_file
+    if direct:
+        cmd += ' --direct'
+    cmd += ' --stall-timeout %s' % stall_timeout
+    return cmd
+
+def parse_progress(line):
+    """
+    Parses a progress line printed by the duplicator program.
+
+    :param line: Output line of the program.
+    :returns: A tuple with the bytes read, the bytes to write and the
+        seconds elapsed, or none if the line is not a progress report.
+    """
+
+    fields = line.split()
+    if (len(fields) >= 8 and fields[0] == REPORT_PREFIX and
+        fields[1] == 'progress'):
+        try:
+            return long(fields[2]), long(fields[4]), float(fields[7])
+        except (ValueError, IndexError):
+            return None
+    return None
+
+def parse_report(output):
+    """
+    Parses the report printed by the duplicator program.
+
+    :param output: Output of the program.
+    :returns: A list of (device, bytes written, seconds, error) tuples, one
+        per device; the error is empty if the device was written.
+    """
+
+    results = []
+    for line in output.splitlines():
+        fields = line.split(None, 2)
+        if (len(fields) < 3 or fields[0] != REPORT_PREFIX or
+            fields[1] == 'progress'):
+            continue
+        device, rest = fields[1], fields[2]
+        error = ''
+        if rest.startswith('failed after '):
+            rest, error = rest[len('failed after '):].split(': ', 1)
+        words = rest.split()
+        try:
+            results.append((device, long(words[0]), float(words[3]), error))
+        except (ValueError, IndexError):
+            continue
+    return results
+
+def _report_progress(duplicator):
+    sys.stdout.write('%s progress %s of %s bytes in %.3f s\n' %
+                     (REPORT_PREFIX, duplicator.bytes_read,
+                      duplicator.bytes_total, duplicator.elapsed))
+    sys.stdout.flush()
+
+def _main():
+    parser = argparse.ArgumentParser(description='Image duplicator')
+    parser.add_argument('--image', required=True, help='Image file')
+    parser.add_argument('--device', required=True, action='append',
+                        dest='devices', help='Device to write into (can be '
+                        'given several times)')
+    parser.add_argument('--bmap',
+                        help='Write only the regions mapped in this block map')
+    parser.add_argument('--direct', action='store_true',
+                        help='Write bypassing the page cache (O_DIRECT)')
+    parser.add_argument('--stall-timeout', type=float,
+                        default=DEFAULT_STALL_TIMEOUT,
+                        help='Seconds a device can take to accept a buffer '
+                        'before it is dropped')
+    args = parser.parse_args()
+    try:
+        ranges = rawwriter.bmap_ranges(args.bmap) if args.bmap else None
+    except rawwriter.RawWriterError as e:
+        sys.stderr.write('%s %s\n' % (REPORT_PREFIX, e))
+        return 1
+    duplicator = Duplicator(args.image, args.devices, ranges, args.direct,
+                            args.stall_timeout)
+    done = threading.Event()
+    def progress():
+        while not done.wait(PROGRESS_INTERVAL):
+            _report_progress(duplicator)
+    reporter = threading.Thread(target=progress)
+    reporter.daemon = True
+    reporter.start()
+    try:
+        duplicator.run()
+    except DuplicatorError as e:
+        sys.stderr.write('%s %s\n' % (REPORT_PREFIX, e))
+        return 1
+    finally:
+        done.set()
+        reporter.join()
+    for target in duplicator.targets:
+        if target.ok:
+            line = '%s bytes in %.3f s' % (target.bytes_written,
+                                           target.elapsed)
+        else:
+            line = 'failed after %s bytes in %.3f s: %s' % (
+                target.bytes_written, target.elapsed, target.error)
+        sys.stdout.write('%s %s %s\n' % (REPORT_PREFIX, target.device, line))
+    sys.stdout.flush()
+    return 0 if all(target.ok for target in duplicator.targets) else 1
+
+if __name__ == '__main__':
+    sys.exit(_main())
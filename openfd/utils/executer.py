@@ -18,9 +18,28 @@
 # ==========================================================================
 
 import os
+import re
+import time
+import Queue
+import threading
 import subprocess
 import termcolor
 import openfd.utils.logger
+import sudoworker
+import tracer
+import session
+import probe
+import rawwriter
+import treecopy
+import duplicator
+
+# ==========================================================================
+# Constants
+# ==========================================================================
+
+#: Maximum number of commands executed concurrently by
+#: :func:`Executer.check_call_many`.
+MAX_WORKERS = 4
 
 # ==========================================================================
 # Globals
@@ -68,6 +87,18 @@ class Executer(object):
     * Colors - colored output for warning messages (based on `termcolor`).
     * Uniform user prompt - when confirmation from the user is needed.
     * Dryrun mode - system commands will be logged, but not executed.
+    * Sudo worker - optionally, commands prefixed with `sudo` are executed
+      by a single persistent privileged process (see
+      :func:`start_sudo_worker`).
+    * Rootless mode - the `sudo` prefix is removed from the commands (see
+      :attr:`rootless`).
+    * Tracing - each command is recorded as a span in the global tracer
+      (see :mod:`openfd.utils.tracer`).
+    * Record/replay - commands and system probes can be recorded into a
+      session file, and later replayed without touching the system (see
+      :func:`record_session` and :func:`replay_session`).
+    * Raw writes - data is written into devices with large aligned buffers
+      instead of `dd` (see :func:`raw_write`).
     """
     
     def __init__(self, dryrun=False, enable_colors=True,
@@ -87,6 +118,10 @@ class Executer(object):
         self._dryrun = dryrun
         self._enable_colors = enable_colors
         self._verbose = verbose
+        self._worker = None
+        self._recorder = None
+        self._player = None
+        self._rootless = False
     
     def __set_verbose(self, verbose):
         self._verbose = verbose
@@ -116,13 +151,345 @@ class Executer(object):
     
     enable_colors = property(__get_enable_colors, __set_enable_colors,
                              doc="""Enable colored messages.""")
+    
+    def __set_rootless(self, rootless):
+        self._rootless = rootless
+        
+    def __get_rootless(self):
+        return self._rootless
+    
+    rootless = property(__get_rootless, __set_rootless,
+                        doc="""Enable rootless mode. The `sudo` prefix is
+                        removed from the commands, which are executed as the
+                        current user.""")
 
     def _log(self, msg):
         if self._l:
             self._l.info(msg) if self._verbose else self._l.debug(msg)
 
+    def _strip_sudo(self, cmd):
+        # Also in the commands of a list or pipeline: 'cd x ; sudo cp a b'
+        return re.sub(r'(^|[;|&]\s*)sudo\s+', r'\1', cmd)
+
     def _log_cmd(self, cmd):
         self._log("  System <= '%s'" % cmd)
+
+    def _trace_span(self, cmd, method):
+        name = cmd if len(cmd) <= 64 else cmd[:61] + '...'
+        return tracer.trace_span(name, 'cmd', cmd=cmd, method=method,
+                                 dryrun=self._dryrun)
+
+    def _record_cmd(self, method, cmd, retcode, output, start_time):
+        if self._recorder and not self._dryrun:
+            self._recorder.add_cmd(method, cmd, retcode, output,
+                                   time.time() - start_time)
+
+    def _worker_cmd(self, cmd):
+        # Commands that need superuser access are sent to the sudo worker,
+        # without the 'sudo' prefix
+        if self._worker and cmd.startswith('sudo '):
+            return cmd[len('sudo '):]
+        return None
+
+    def start_sudo_worker(self):
+        """
+        Starts the sudo worker: a privileged process that receives the commands
+        prefixed with `sudo` and executes them, avoiding a `sudo` invocation
+        per command. Call it after :func:`prompt_sudo`. Dryrun and logging
+        behave the same with or without the worker. 
+        
+        :exception SudoWorkerError: When the worker can't be started.
+        """
+        
+        if self._worker or self._dryrun or self._player:
+            return
+        worker = sudoworker.SudoWorker()
+        worker.start()
+        self._worker = worker
+        if self._l:
+            self._l.debug('Sudo worker started')
+    
+    def stop_sudo_worker(self):
+        """
+        Stops the sudo worker, if running.
+        """
+        
+        if self._worker:
+            self._worker.stop()
+            self._worker = None
+    
+    def end_session(self):
+        """
+        Stops recording or replaying the session. Save a recorded session
+        with :func:`save_session` before.
+        """
+        
+        self._recorder = None
+        self._player = None
+    
+    def record_session(self):
+        """
+        Starts recording the executed commands and the system probes (see
+        :func:`probe`). Save them with :func:`save_session`.
+        """
+        
+        self._recorder = session.SessionRecorder()
+    
+    def save_session(self, filename):
+        """
+        Writes the recorded session to a file.
+        
+        :param filename: Session file.
+        :exception IOError: When unable to write the file.
+        """
+        
+        if self._recorder:
+            self._recorder.write(filename)
+    
+    def replay_session(self, filename, time_scale=1.0):
+        """
+        Replays a recorded session: from now on the results of the commands
+        and system probes are served from the session file instead of the
+        system. Logging and dryrun behave the same as when executing.
+        
+        :param filename: Session file.
+        :param time_scale: Factor applied to the recorded durations; 0
+            replays without waiting.
+        :exception SessionError: When unable to read the session file.
+        """
+        
+        self._player = session.SessionPlayer(filename, time_scale)
+    
+    def probe(self, func, *args, **kwargs):
+        """
+        Calls a system probe from :mod:`openfd.utils.probe`, i.e.
+        `self._e.probe(utils.device_size_b, '/dev/sdb')`. Probes are
+        recorded and replayed the same as commands.
+        
+        :param func: Probe function.
+        :returns: The value returned by the probe.
+        :exception ProbeError: When the probe fails.
+        :exception SessionError: When replaying and the probe is not in the
+            session.
+        """
+        
+        name = func.__name__
+        if self._player:
+            result, error = self._player.probe(name, args, kwargs)
+            if error is not None:
+                raise probe.ProbeError(error)
+            return result
+        start_time = time.time()
+        try:
+            result = func(*args, **kwargs)
+        except probe.ProbeError as e:
+            if self._recorder:
+                self._recorder.add_probe(name, args, kwargs, None, str(e),
+                                         time.time() - start_time)
+            raise
+        if self._recorder:
+            self._recorder.add_probe(name, args, kwargs, result, None,
+                                     time.time() - start_time)
+        return result
+    
+    def raw_write(self, target, filename='', offset=0, skip=0, length=None,
+                  zeros=False, sparse=False, bmap_file='', direct=False,
+                  decompress='', skip_zeros=False, compare=False):
+        """
+        Writes raw data into a device or image file using the raw writer
+        (see :mod:`openfd.utils.rawwriter`), executed via sudo, and logs the
+        achieved throughput. Replaces `dd` with small block sizes.
+        
+        :param target: Device or image file.
+        :param filename: Source file.
+        :param offset: Offset in the target (bytes).
+        :param skip: Offset in the source file (bytes).
+        :param length: Bytes to write; by default the whole file.
+        :param zeros: Write zeros instead of a file, `length` is required.
+        :param sparse: Write only the regions of the source file with data.
+        :param bmap_file: Write only the regions mapped in this block map.
+        :param direct: Write bypassing the page cache (`O_DIRECT`).
+        :param decompress: Write the output of this command (i.e. 'xz -dc
+            sd.img.xz') instead of a file; the decompression and write
+            throughputs are logged separately.
+        :param skip_zeros: Don't write the zero blocks of the `decompress`
+            output.
+        :param compare: Read the target first and write only the blocks
+            that differ; the bytes skipped and the speedup are logged.
+        :returns: The return code of the writer; 0 on success.
+        """
+        
+        cmd = rawwriter.raw_write_cmd(target, filename, offset, skip, length,
+                                      zeros, sparse, bmap_file, direct,
+                                      decompress=decompress,
+                                      skip_zeros=skip_zeros, compare=compare)
+        return self._raw_writer(cmd, target, file=filename)
+    
+    def wipe(self, target, offset, length, method=rawwriter.WIPE_AUTO):
+        """
+        Wipes a region of a device or image file, so it reads as zeros,
+        using the raw writer (see :func:`rawwriter.RawWriter.wipe`) executed
+        via sudo.
+        
+        :param target: Device or image file.
+        :param offset: Offset in the target (bytes).
+        :param length: Bytes to wipe.
+        :param method: Wipe method, one of :const:`rawwriter.WIPE_METHODS`;
+            by default the fastest method supported by the target.
+        :returns: The return code of the writer; 0 on success.
+        """
+        
+        cmd = rawwriter.raw_write_cmd(target, offset=offset, length=length,
+                                      wipe=method)
+        return self._raw_writer(cmd, target, method=method)
+    
+    def copy_tree(self, src, dst, workers=treecopy.DEFAULT_WORKERS,
+                  sync=False):
+        """
+        Copies a directory tree (i.e. a rootfs) into another directory using
+        the copy engine (see :mod:`openfd.utils.treecopy`), executed via
+        sudo. Replaces `find . | sudo cpio -pdum`. The progress is logged
+        while copying, and the achieved throughput at the end.
+        
+        :param src: Source directory.
+        :param dst: Destination directory.
+        :param workers: Threads copying files.
+        :param sync: Only write the entries that changed, removing the ones
+            not in the source (see :class:`treecopy.TreeCopier`).
+        :returns: The return code of the copy engine; 0 on success.
+        """
+        
+        def log_progress(line):
+            progress = treecopy.parse_progress(line)
+            if progress and self._l:
+                files, size_b, secs = progress
+                self._l.info('  %s files, %.1f MB copied (%.1f MB/s, '
+                             '%d files/s)' % (files, size_b / float(1 << 20),
+                             size_b / float(1 << 20) / secs, files / secs))
+        
+        cmd = treecopy.copy_tree_cmd(src, dst, workers, sync)
+        with tracer.trace_span('copy %s' % src, 'io', dst=dst) as span:
+            ret, output = self.check_output(cmd, line_callback=log_progress)
+            report = treecopy.parse_report(output)
+            if report:
+                files, size_b, secs = report
+                span.args['bytes'] = size_b
+                span.args['files'] = files
+                rate = size_b / float(1 << 20) / secs if secs > 0 else 0
+                self._log('  Copied %s files (%s bytes) into %s in %.2f s '
+                          '(%.1f MB/s)' % (files, size_b, dst, secs, rate))
+            sync_report = treecopy.parse_sync_report(output)
+            if sync_report:
+                unchanged, removed = sync_report
+                span.args['unchanged'] = unchanged
+                self._log('  %s entries unchanged, %s removed' %
+                          (unchanged, removed))
+            if ret != 0 and self._l:
+                self._l.debug(output.strip())
+        return ret
+    
+    def duplicate(self, image, devices, bmap_file='',
+                  stall_timeout=duplicator.DEFAULT_STALL_TIMEOUT):
+        """
+        Writes an image into several devices at once using the duplicator
+        (see :mod:`openfd.utils.duplicator`), executed via sudo. The image
+        is read once; a device that fails or stalls is dropped without
+        stopping the others. The progress is logged while writing, and the
+        achieved throughput of each device at the end.
+        
+        :param image: Image file.
+        :param devices: Devices to write into.
+        :param bmap_file: Write only the regions mapped in this block map; by
+            default the regions of the image with data.
+        :param stall_timeout: Seconds a device can take to accept a buffer
+            before it is dropped.
+        :returns: A tuple with the return code of the duplicator (0 if all
+            the devices were written) and a list of (device, bytes written,
+            seconds, error) tuples, see :func:`duplicator.parse_report`.
+        """
+        
+        def log_progress(line):
+            progress = duplicator.parse_progress(line)
+            if progress and self._l:
+                size_b, total_b, secs = progress
+                self._l.info('  %.1f of %.1f MB read (%.1f MB/s)' %
+                             (size_b / float(1 << 20),
+                              total_b / float(1 << 20),
+                              size_b / float(1 << 20) / secs))
+        
+        cmd = duplicator.duplicate_cmd(image, devices, bmap_file, direct=True,
+                                       stall_timeout=stall_timeout)
+        with tracer.trace_span('duplicate %s' % image, 'io',
+                               devices=len(devices)) as span:
+            ret, output = self.check_output(cmd, line_callback=log_progress)
+            results = duplicator.parse_report(output)
+            for device, size_b, secs, error in results:
+                rate = size_b / float(1 << 20) / secs if secs > 0 else 0
+                if error:
+                    self._log('  Dropped %s after %s bytes in %.2f s: %s' %
+                              (device, size_b, secs, error))
+                else:
+                    self._log('  Wrote %s bytes into %s in %.2f s '
+                              '(%.1f MB/s)' % (size_b, device, secs, rate))
+            span.args['failed'] = len([r for r in results if r[3]])
+            if ret != 0 and not results and self._l:
+                self._l.debug(output.strip())
+        return ret, results
+    
+    def _log_stream(self, span, written_b, size_b, read_secs, write_secs,
+                    skipped_b):
+        mb = lambda b: b / float(1 << 20)
+        span.args['stream_bytes'] = size_b
+        msg = ('  Decompressed %.1f MB in %.2f s (%.1f MB/s), wrote %.1f MB '
+               'in %.2f s (%.1f MB/s)' %
+               (mb(size_b), read_secs,
+                mb(size_b) / read_secs if read_secs > 0 else 0,
+                mb(written_b), write_secs,
+                mb(written_b) / write_secs if write_secs > 0 else 0))
+        if skipped_b:
+            msg += ', skipped %.1f MB of zeros' % mb(skipped_b)
+        self._log(msg)
+    
+    def _log_compare(self, span, written_b, compared_b, read_secs,
+                     identical_b, write_secs):
+        mb = lambda b: b / float(1 << 20)
+        span.args['identical_bytes'] = identical_b
+        msg = ('  Compared %.1f MB in %.2f s (%.1f MB/s), %.1f MB identical '
+               'were skipped' %
+               (mb(compared_b), read_secs,
+                mb(compared_b) / read_secs if read_secs > 0 else 0,
+                mb(identical_b)))
+        if written_b and write_secs > 0:
+            # Time to write all the compared bytes at the measured rate,
+            # against the time taken reading and writing only the changes
+            full_secs = write_secs * compared_b / float(written_b)
+            msg += (', %.1fx faster than writing everything' %
+                    (full_secs / (read_secs + write_secs)))
+        self._log(msg)
+    
+    def _raw_writer(self, cmd, target, **args):
+        with tracer.trace_span('raw write %s' % target, 'io', **args) as span:
+            ret, output = self.check_output(cmd)
+            report = rawwriter.parse_report(output)
+            if report:
+                size_b, secs, method = report
+                span.args['bytes'] = size_b
+                rate = size_b / float(1 << 20) / secs if secs > 0 else 0
+                msg = ('  Wrote %s bytes into %s in %.2f s (%.1f MB/s)' %
+                       (size_b, target, secs, rate))
+                if method:
+                    span.args['method'] = method
+                    msg += ', wiped with %s' % method
+                self._log(msg)
+                stream = rawwriter.parse_stream_report(output)
+                if stream:
+                    self._log_stream(span, size_b, *stream)
+                compare = rawwriter.parse_compare_report(output)
+                if compare:
+                    self._log_compare(span, size_b, *compare)
+            elif ret != 0 and self._l:
+                self._l.debug(output.strip())
+        return ret
     
     def prompt_sudo(self):
         """
@@ -164,7 +531,16 @@ class Executer(object):
             pass
         return confirmation.strip().upper() == 'Y'
 
-    def check_output(self, cmd, logoutput=False):
+    def _stream_output(self, cmd, line_callback):
+        proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+        output = ''
+        for line in iter(proc.stdout.readline, ''):
+            output += line
+            line_callback(line)
+        return proc.wait(), output
+    
+    def check_output(self, cmd, logoutput=False, line_callback=None):
         """
         Executes a system command, with the ability to return both the
         output and the return code of the command execution. The output
@@ -176,6 +552,9 @@ class Executer(object):
         :param logoutput: Enables logging of both the return code and the
             output of the command.
         :type logoutput: boolean
+        :param line_callback: Function called with each line of the output
+            while the command runs (only when executed directly, not through
+            the sudo worker or a replayed session).
         :returns: Returns a tuple with two items. The first item is the 
             return code after the command execution. For most commands,
             a return code of 0 represents success. The second item is the
@@ -186,14 +565,29 @@ class Executer(object):
        
         retcode = 0
         output  = ""
+        if self._rootless:
+            cmd = self._strip_sudo(cmd)
         self._log_cmd(cmd)
-        if not self._dryrun:
-            try:
-                output = subprocess.check_output(cmd, shell=True,
-                                                 stderr=subprocess.STDOUT)
-            except subprocess.CalledProcessError as e:
-                retcode = e.returncode
-                output += e.output
+        with self._trace_span(cmd, 'check_output') as span:
+            start_time = time.time()
+            worker_cmd = self._worker_cmd(cmd)
+            if not self._dryrun and self._player:
+                retcode, output = self._player.cmd(cmd)
+            elif not self._dryrun and worker_cmd:
+                retcode, output = self._worker.run(worker_cmd,
+                                                   sudoworker.MODE_OUTPUT)
+            elif not self._dryrun and line_callback:
+                retcode, output = self._stream_output(cmd, line_callback)
+            elif not self._dryrun:
+                try:
+                    output = subprocess.check_output(
+                                        cmd, shell=True,
+                                        stderr=subprocess.STDOUT)
+                except subprocess.CalledProcessError as e:
+                    retcode = e.returncode
+                    output += e.output
+            self._record_cmd('check_output', cmd, retcode, output, start_time)
+            span.args['retcode'] = retcode
         if logoutput and not self._dryrun:
             self._log(output)
         return retcode, output
@@ -209,12 +603,24 @@ class Executer(object):
         """
         
         retcode = 0
+        if self._rootless:
+            cmd = self._strip_sudo(cmd)
         self._log_cmd(cmd)
-        if not self._dryrun:
-            try:
-                retcode = subprocess.check_call(cmd, shell=True)
-            except subprocess.CalledProcessError as e:
-                retcode = e.returncode
+        with self._trace_span(cmd, 'call') as span:
+            start_time = time.time()
+            worker_cmd = self._worker_cmd(cmd)
+            if not self._dryrun and self._player:
+                retcode = self._player.cmd(cmd)[0]
+            elif not self._dryrun and worker_cmd:
+                retcode = self._worker.run(worker_cmd,
+                                           sudoworker.MODE_CALL)[0]
+            elif not self._dryrun:
+                try:
+                    retcode = subprocess.check_call(cmd, shell=True)
+                except subprocess.CalledProcessError as e:
+                    retcode = e.returncode
+            self._record_cmd('call', cmd, retcode, '', start_time)
+            span.args['retcode'] = retcode
         return retcode
     
     def check_call(self, cmd):
@@ -228,13 +634,79 @@ class Executer(object):
             commands, a return code of 0 represents success. 
         """
        
-        retcode = 0
+        if self._rootless:
+            cmd = self._strip_sudo(cmd)
         self._log_cmd(cmd)
-        if not self._dryrun:
-            try:
-                retcode = subprocess.check_call(cmd, shell=True,
-                                                stdout=open(os.devnull, 'wb'),
-                                                stderr=open(os.devnull, 'wb'))
-            except subprocess.CalledProcessError as e:
-                retcode = e.returncode
+        return self._check_call(cmd)
+    
+    def _check_call(self, cmd):
+        retcode = 0
+        with self._trace_span(cmd, 'check_call') as span:
+            start_time = time.time()
+            worker_cmd = self._worker_cmd(cmd)
+            if not self._dryrun and self._player:
+                retcode = self._player.cmd(cmd)[0]
+            elif not self._dryrun and worker_cmd:
+                retcode = self._worker.run(worker_cmd,
+                                           sudoworker.MODE_QUIET)[0]
+            elif not self._dryrun:
+                try:
+                    retcode = subprocess.check_call(
+                                        cmd, shell=True,
+                                        stdout=open(os.devnull, 'wb'),
+                                        stderr=open(os.devnull, 'wb'))
+                except subprocess.CalledProcessError as e:
+                    retcode = e.returncode
+            self._record_cmd('check_call', cmd, retcode, '', start_time)
+            span.args['retcode'] = retcode
         return retcode
+    
+    def check_call_many(self, cmds, max_workers=MAX_WORKERS):
+        """
+        Executes independent system commands concurrently, like
+        :func:`check_call`, with at most `max_workers` running at a time.
+        The commands are logged in the given order before running them, so
+        the log doesn't depend on the scheduling.
+        
+        :param cmds: List of commands.
+        :param max_workers: Maximum number of commands running at a time.
+        :returns: The list of return codes, in the order of the commands.
+        """
+        
+        if self._rootless:
+            cmds = [self._strip_sudo(cmd) for cmd in cmds]
+        for cmd in cmds:
+            self._log_cmd(cmd)
+        retcodes = [0] * len(cmds)
+        if self._dryrun or len(cmds) <= 1 or max_workers <= 1:
+            for i, cmd in enumerate(cmds):
+                retcodes[i] = self._check_call(cmd)
+            return retcodes
+        errors = []
+        pending = Queue.Queue()
+        for i in range(len(cmds)):
+            pending.put(i)
+        def worker():
+            while True:
+                try:
+                    i = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    retcodes[i] = self._check_call(cmds[i])
+                except Exception as e:
+                    # Raised in the caller's thread, i.e. SessionError
+                    errors.append(e)
+                    return
+        threads = [threading.Thread(target=worker)
+                   for i in range(min(max_workers, len(cmds)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            # join() without a timeout can't be interrupted in Python 2
+            while thread.is_alive():
+                thread.join(1)
+        if errors:
+            raise errors[0]
+        return retcodes
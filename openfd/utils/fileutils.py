@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+# ==========================================================================
+#
+# Copyright (C) 2013-2014 RidgeRun, LLC (http://www.ridgerun.com)
+#
+# Author: Jose Pablo Carballo <jose.carballo@ridgerun.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# Helpers for efficient (sparse, in-kernel) file copies.
+#
+# ==========================================================================
+
+"""
+The fileutils module copies data between files using `copy_file_range(2)`
+when available, falling back to plain reads and writes, skips the holes
+of sparse files using `lseek(2)` with `SEEK_DATA`/`SEEK_HOLE`, and punches
+holes with `fallocate(2)`. It also drops copied files from the page cache
+(`posix_fadvise(2)`) and copies extended attributes, which Python 2 doesn't
+expose.
+"""
+
+# ==========================================================================
+# Imports
+# ==========================================================================
+
+import os
+import errno
+import ctypes
+
+# ==========================================================================
+# Constants
+# ==========================================================================
+
+SEEK_DATA = 3
+SEEK_HOLE = 4
+
+#: Size of the chunks used by the copies.
+COPY_CHUNK_SIZE = 8 << 20
+
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+POSIX_FADV_DONTNEED = 4
+
+#: Maximum size of the extended attributes list and values.
+XATTR_SIZE_MAX = 65536
+
+# ==========================================================================
+# Globals
+# ==========================================================================
+
+_libc = ctypes.CDLL(None, use_errno=True)
+_copy_file_range = getattr(_libc, 'copy_file_range', None)
+if _copy_file_range:
+    _copy_file_range.restype = ctypes.c_ssize_t
+    _copy_file_range.argtypes = [ctypes.c_int,
+                                 ctypes.POINTER(ctypes.c_longlong),
+                                 ctypes.c_int,
+                                 ctypes.POINTER(ctypes.c_longlong),
+                                 ctypes.c_size_t, ctypes.c_uint]
+
+_fallocate = getattr(_libc, 'fallocate64', None)
+if _fallocate:
+    _fallocate.restype = ctypes.c_int
+    _fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_longlong,
+                           ctypes.c_longlong]
+
+_posix_fadvise = getattr(_libc, 'posix_fadvise64', None)
+if _posix_fadvise:
+    _posix_fadvise.restype = ctypes.c_int
+    _posix_fadvise.argtypes = [ctypes.c_int, ctypes.c_longlong,
+                               ctypes.c_longlong, ctypes.c_int]
+
+_llistxattr = getattr(_libc, 'llistxattr', None)
+_lgetxattr = getattr(_libc, 'lgetxattr', None)
+_lsetxattr = getattr(_libc, 'lsetxattr', None)
+if _llistxattr and _lgetxattr and _lsetxattr:
+    _llistxattr.restype = ctypes.c_ssize_t
+    _llistxattr.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_size_t]
+    _lgetxattr.restype = ctypes.c_ssize_t
+    _lgetxattr.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p,
+                           ctypes.c_size_t]
+    _lsetxattr.restype = ctypes.c_int
+    _lsetxattr.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p,
+                           ctypes.c_size_t, ctypes.c_int]
+else:
+    _llistxattr = None
+
+# ==========================================================================
+# Functions
+# ==========================================================================
+
+def create_sparse_file(filename, size_b):
+    """
+    Creates (or truncates) a file of the given size without allocating its
+    blocks.
+
+    :param filename: File name.
+    :param size_b: Size (bytes).
+    :exception IOError: On failure.
+    """
+
+    with open(filename, 'wb') as f:
+        f.truncate(size_b)
+
+def punch_hole(fd, offset, length):
+    """
+    Deallocates a region of a file, which then reads as zeros; the file size
+    is kept.
+
+    :param fd: File descriptor, open for writing.
+    :param offset: Offset of the region.
+    :param length: Length of the region (bytes).
+    :exception OSError: On failure, i.e. if the filesystem doesn't support
+        punching holes (`EOPNOTSUPP`).
+    """
+
+    if not _fallocate:
+        raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+    if _fallocate(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, offset,
+                  length) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+def data_segments(fd, size_b):
+    """
+    Returns the (offset, length) of the regions with data of a file,
+    skipping its holes. If the filesystem doesn't support `SEEK_DATA` the
+    whole file is returned as a single region.
+
+    :param fd: File descriptor.
+    :param size_b: File size (bytes).
+    """
+
+    segments = []
+    offset = 0
+    while offset < size_b:
+        try:
+            start = os.lseek(fd, offset, SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                break
+            return [(0, size_b)]
+        end = os.lseek(fd, start, SEEK_HOLE)
+        segments.append((start, end - start))
+        offset = end
+    return segments
+
+def _copy_rw(src_fd, dst_fd, src_offset, dst_offset, length):
+    while length > 0:
+        os.lseek(src_fd, src_offset, os.SEEK_SET)
+        data = os.read(src_fd, min(length, COPY_CHUNK_SIZE))
+        if not data:
+            break
+        os.lseek(dst_fd, dst_offset, os.SEEK_SET)
+        written = os.write(dst_fd, data)
+        src_offset += written
+        dst_offset += written
+        length -= written
+
+def copy_range(src_fd, dst_fd, src_offset, dst_offset, length):
+    """
+    Copies a region of a file into another file, in the kernel if possible.
+
+    :param src_fd: Source file descriptor.
+    :param dst_fd: Destination file descriptor.
+    :param src_offset: Offset in the source file.
+    :param dst_offset: Offset in the destination file.
+    :param length: Number of bytes to copy.
+    :exception OSError: On failure.
+    """
+
+    if _copy_file_range:
+        off_in = ctypes.c_longlong(src_offset)
+        off_out = ctypes.c_longlong(dst_offset)
+        while length > 0:
+            ret = _copy_file_range(src_fd, ctypes.byref(off_in), dst_fd,
+                                   ctypes.byref(off_out),
+                                   min(length, COPY_CHUNK_SIZE), 0)
+            if ret < 0:
+                err = ctypes.get_errno()
+                if err in (errno.ENOSYS, errno.EXDEV, errno.EINVAL,
+                           errno.EOPNOTSUPP):
+                    # Not supported for these files, copy by hand
+                    break
+                raise OSError(err, os.strerror(err))
+            if ret == 0:
+                return
+            length -= ret
+        src_offset, dst_offset = off_in.value, off_out.value
+    if length > 0:
+        _copy_rw(src_fd, dst_fd, src_offset, dst_offset, length)
+
+def copy_sparse(src, dst, dst_offset=0):
+    """
+    Copies the regions with data of the file `src` into the file `dst`,
+    starting at `dst_offset`. Holes in `src` are not written, so they remain
+    holes in `dst` (if it is a new sparse file).
+
+    :param src: Source file name.
+    :param dst: Destination file name, must exist; it is not truncated.
+    :param dst_offset: Offset in the destination file.
+    :returns: The number of bytes copied.
+    :exception OSError: On failure.
+    """
+
+    copied = 0
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        dst_fd = os.open(dst, os.O_WRONLY)
+        try:
+            size_b = os.fstat(src_fd).st_size
+            for offset, length in data_segments(src_fd, size_b):
+                copy_range(src_fd, dst_fd, offset, dst_offset + offset,
+                           length)
+                copied += length
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+    return copied
+
+def drop_cache(fd, offset=0, length=0):
+    """
+    Drops the clean pages of a file from the page cache
+    (`POSIX_FADV_DONTNEED`), i.e. after reading it once. Only a hint: errors
+    are ignored.
+
+    :param fd: File descriptor.
+    :param offset: Offset of the region.
+    :param length: Length of the region (bytes); 0 up to the end of the file.
+    """
+
+    if _posix_fadvise:
+        _posix_fadvise(fd, offset, length, POSIX_FADV_DONTNEED)
+
+def _xattr_error():
+    err = ctypes.get_errno()
+    if err in (errno.ENOTSUP, errno.EOPNOTSUPP, errno.ENODATA):
+        return None
+    return OSError(err, os.strerror(err))
+
+def copy_xattrs(src, dst):
+    """
+    Copies the extended attributes of a file (i.e. `security.capability`)
+    into another file, without following symbolic links. Attributes not
+    supported by the destination filesystem are skipped.
+
+    :param src: Source file name.
+    :param dst: Destination file name.
+    :exception OSError: On failure.
+    """
+
+    if not _llistxattr:
+        return
+    names = ctypes.create_string_buffer(XATTR_SIZE_MAX)
+    size = _llistxattr(src, names, XATTR_SIZE_MAX)
+    if size < 0:
+        error = _xattr_error()
+        if error:
+            raise error
+        return
+    value = ctypes.create_string_buffer(XATTR_SIZE_MAX)
+    for name in names.raw[:size].split('\0'):
+        if not name:
+            continue
+        length = _lgetxattr(src, name, value, XATTR_SIZE_MAX)
+        if length < 0:
+            error = _xattr_error()
+            if error:
+                raise error
+            continue
+        if _lsetxattr(dst, name, value.raw[:length], length, 0) != 0:
+            error = _xattr_error()
+            if error:
+                raise error
@@ -0,0 +1,386 @@
+#!/usr/bin/env python
+# ==========================================================================
+#
+# Copyright (C) 2013-2014 RidgeRun, LLC (http://www.ridgerun.com)
+#
+# Author: Jose Pablo Carballo <jose.carballo@ridgerun.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# In-process probes of the system state, based on sysfs and procfs.
+#
+# ==========================================================================
+
+"""
+The probe module reads the state of block devices, mounts and sockets
+directly from `/sys` and `/proc`, instead of spawning shell pipelines. Devices
+are compared by device number (or resolved path), so `/dev/sdb1` never
+matches `/dev/sdb10`.
+"""
+
+# ==========================================================================
+# Imports
+# ==========================================================================
+
+import os
+import re
+import stat
+import fcntl
+import struct
+
+# ==========================================================================
+# Constants
+# ==========================================================================
+
+SYS_CLASS_BLOCK = '/sys/class/block'
+SYS_BLOCK = '/sys/block'
+PROC_MOUNTINFO = '/proc/self/mountinfo'
+PROC_MDSTAT = '/proc/mdstat'
+PROC_NET_UDP = ['/proc/net/udp', '/proc/net/udp6']
+
+#: Size of the sectors reported by sysfs, regardless of the device.
+SYSFS_SECTOR_SIZE = 512
+
+# Block device ioctls, see linux/fs.h
+BLKSSZGET = 0x1268
+BLKPBSZGET = 0x127b
+BLKGETSIZE64 = 0x80081272
+
+# ==========================================================================
+# Public Classes
+# ==========================================================================
+
+class ProbeError(Exception):
+    """Probe exceptions."""
+
+class MountEntry(object):
+    """An entry (line) from `/proc/self/mountinfo`."""
+
+    def __init__(self, major, minor, mount_point, fstype, source):
+        self.major = major
+        self.minor = minor
+        self.mount_point = mount_point
+        self.fstype = fstype
+        self.source = source
+
+# ==========================================================================
+# Functions
+# ==========================================================================
+
+def _read(filename):
+    with open(filename) as f:
+        return f.read()
+
+def _unescape(field):
+    # mountinfo escapes spaces, tabs, newlines and backslashes as octal
+    return re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), field)
+
+def _block_name(device):
+    return os.path.basename(os.path.realpath(device))
+
+def _device_number(device):
+    try:
+        st = os.stat(device)
+    except OSError:
+        return None
+    if not stat.S_ISBLK(st.st_mode):
+        return None
+    return os.major(st.st_rdev), os.minor(st.st_rdev)
+
+def _device_attr(device, attrs):
+    # First non-empty attribute of the device in sysfs
+    devdir = os.path.join(SYS_CLASS_BLOCK, _block_name(device), 'device')
+    for attr in attrs:
+        try:
+            value = _read(os.path.join(devdir, attr)).strip()
+        except IOError:
+            continue
+        if value:
+            return value
+    return ''
+
+def _same_device(entry, device, number):
+    if number is not None:
+        return (entry.major, entry.minor) == number
+    return os.path.realpath(entry.source) == os.path.realpath(device)
+
+def read_mountinfo():
+    """
+    Reads the mount table of the current process.
+
+    :returns: A list of :class:`MountEntry`.
+    """
+
+    entries = []
+    for line in _read(PROC_MOUNTINFO).splitlines():
+        # Format: id parent major:minor root mount_point options [optional
+        # fields] - fstype source super_options
+        fields = line.split()
+        try:
+            sep = fields.index('-')
+            major, minor = fields[2].split(':')
+            entries.append(MountEntry(int(major), int(minor),
+                                      _unescape(fields[4]), fields[sep + 1],
+                                      _unescape(fields[sep + 2])))
+        except (ValueError, IndexError):
+            continue
+    return entries
+
+def device_size_b(device):
+    """
+    Returns the size of a block device (bytes), as reported by sysfs.
+
+    :param device: Device, i.e. '/dev/sdb'.
+    :exception ProbeError: When unable to obtain the size.
+    """
+
+    filename = os.path.join(SYS_CLASS_BLOCK, _block_name(device), 'size')
+    try:
+        return long(_read(filename).strip()) * SYSFS_SECTOR_SIZE
+    except (IOError, ValueError):
+        raise ProbeError('Unable to obtain the size for %s' % device)
+
+def _ioctl_info(device):
+    fd = os.open(device, os.O_RDONLY | os.O_NONBLOCK)
+    try:
+        size_b = struct.unpack('Q', fcntl.ioctl(fd, BLKGETSIZE64,
+                                                struct.pack('Q', 0)))[0]
+        logical = struct.unpack('i', fcntl.ioctl(fd, BLKSSZGET,
+                                                 struct.pack('i', 0)))[0]
+        physical = struct.unpack('I', fcntl.ioctl(fd, BLKPBSZGET,
+                                                  struct.pack('I', 0)))[0]
+    finally:
+        os.close(fd)
+    return long(size_b), logical, physical
+
+def _sysfs_info(sysdir, diskdir):
+    size_b = long(_read(os.path.join(sysdir, 'size')).strip())
+    queue = os.path.join(diskdir, 'queue')
+    logical = int(_read(os.path.join(queue, 'logical_block_size')).strip())
+    physical = int(_read(os.path.join(queue, 'physical_block_size')).strip())
+    return size_b * SYSFS_SECTOR_SIZE, logical, physical
+
+def device_info(device):
+    """
+    Returns the size, sector sizes and removable flag of a block device. The
+    sizes are read with ioctls if the device can be opened, otherwise (i.e.
+    without permissions on the device) from sysfs.
+
+    :param device: Device, i.e. '/dev/sdb'.
+    :returns: A dictionary with the keys 'size_b', 'logical_sector_size',
+        'physical_sector_size' (bytes) and 'removable'.
+    :exception ProbeError: When unable to obtain the information.
+    """
+
+    sysdir = os.path.realpath(os.path.join(SYS_CLASS_BLOCK,
+                                           _block_name(device)))
+    diskdir = sysdir
+    if os.path.isfile(os.path.join(sysdir, 'partition')):
+        # Queue limits and the removable flag belong to the whole disk
+        diskdir = os.path.dirname(sysdir)
+    try:
+        size_b, logical, physical = _ioctl_info(device)
+    except (IOError, OSError):
+        try:
+            size_b, logical, physical = _sysfs_info(sysdir, diskdir)
+        except (IOError, ValueError):
+            raise ProbeError('Unable to obtain the information for %s' %
+                             device)
+    try:
+        removable = _read(os.path.join(diskdir, 'removable')).strip() == '1'
+    except IOError:
+        removable = False
+    return {'size_b': size_b, 'logical_sector_size': logical,
+            'physical_sector_size': physical, 'removable': removable}
+
+def block_devices():
+    """
+    Returns the whole-disk block devices present in the system, i.e.
+    ['/dev/loop0', '/dev/sda', '/dev/sdb'], as reported by sysfs. Devices
+    without media (i.e. empty card readers) are included, with size 0.
+    """
+
+    try:
+        names = os.listdir(SYS_BLOCK)
+    except OSError:
+        return []
+    # Slashes in device names are exported as '!', i.e. 'cciss!c0d0'
+    return sorted('/dev/%s' % name.replace('!', '/') for name in names)
+
+def device_vendor(device):
+    """
+    Returns the vendor of a block device, i.e. 'Generic', as reported by
+    sysfs; empty if unknown (i.e. MMC cards and loop devices).
+
+    :param device: Device, i.e. '/dev/sdb'.
+    """
+
+    return _device_attr(device, ['vendor'])
+
+def device_model(device):
+    """
+    Returns the model of a block device, i.e. 'STORAGE DEVICE', as reported
+    by sysfs; empty if unknown (i.e. loop devices).
+
+    :param device: Device, i.e. '/dev/sdb'.
+    """
+
+    # SCSI/USB disks export a model, MMC cards a name
+    return _device_attr(device, ['model', 'name'])
+
+def device_partitions(device):
+    """
+    Returns the partitions of a block device, i.e. ['/dev/sdb1', '/dev/sdb2'],
+    as reported by sysfs.
+
+    :param device: Device, i.e. '/dev/sdb'.
+    """
+
+    partitions = []
+    name = _block_name(device)
+    devdir = os.path.dirname(os.path.realpath(device))
+    sysdir = os.path.join(SYS_CLASS_BLOCK, name)
+    try:
+        children = sorted(os.listdir(sysdir))
+    except OSError:
+        return partitions
+    for child in children:
+        if (child.startswith(name) and
+            os.path.isfile(os.path.join(sysdir, child, 'partition'))):
+            partitions.append(os.path.join(devdir, child))
+    return partitions
+
+def partition_extents(device):
+    """
+    Returns the extents of the partitions of a block device, as reported by
+    sysfs.
+
+    :param device: Device, i.e. '/dev/sdb'.
+    :returns: A list of (number, start, size) tuples, sorted by partition
+        number. The start and size are in :const:`SYSFS_SECTOR_SIZE` units.
+    :exception ProbeError: When unable to read the extents.
+    """
+
+    extents = []
+    sysdir = os.path.join(SYS_CLASS_BLOCK, _block_name(device))
+    for partition in device_partitions(device):
+        partdir = os.path.join(sysdir, os.path.basename(partition))
+        try:
+            extents.append((int(_read(os.path.join(partdir,
+                                                   'partition')).strip()),
+                            long(_read(os.path.join(partdir,
+                                                    'start')).strip()),
+                            long(_read(os.path.join(partdir,
+                                                    'size')).strip())))
+        except (IOError, ValueError):
+            raise ProbeError('Unable to read the extent of %s' % partition)
+    return sorted(extents)
+
+def device_mount_points(device, include_partitions=False):
+    """
+    Returns the directories where the given device is mounted.
+
+    :param device: Device, i.e. '/dev/sdb1'.
+    :param include_partitions: Also include the mount points of the device's
+        partitions.
+    """
+
+    devices = [device]
+    if include_partitions:
+        devices += device_partitions(device)
+    numbers = [(dev, _device_number(dev)) for dev in devices]
+    mount_points = []
+    for entry in read_mountinfo():
+        for dev, number in numbers:
+            if _same_device(entry, dev, number):
+                mount_points.append(entry.mount_point)
+                break
+    return mount_points
+
+def device_mount_point(device):
+    """
+    Returns the first directory where the given device is mounted, or an
+    empty string if not mounted.
+
+    :param device: Device, i.e. '/dev/sdb1'.
+    """
+
+    mount_points = device_mount_points(device)
+    return mount_points[0] if mount_points else ''
+
+def is_raid_member(device, include_partitions=False):
+    """
+    True if the given device is part of a RAID array (see `/proc/mdstat`),
+    false otherwise.
+
+    :param device: Device, i.e. '/dev/sdb'.
+    :param include_partitions: Also check the device's partitions.
+    """
+
+    names = [_block_name(device)]
+    if include_partitions:
+        names += [os.path.basename(p) for p in device_partitions(device)]
+    try:
+        mdstat = _read(PROC_MDSTAT)
+    except IOError:
+        return False
+    # Members are listed as 'sdb1[0]'
+    members = re.findall(r'(\S+)\[\d+\]', mdstat)
+    for name in names:
+        if name in members:
+            return True
+    return False
+
+def is_device_mounted(device):
+    """
+    True if the given device, or any of its partitions, is mounted or part of
+    a RAID array; false otherwise.
+
+    :param device: Device, i.e. '/dev/sdb'.
+    """
+
+    if device_mount_points(device, include_partitions=True):
+        return True
+    return is_raid_member(device, include_partitions=True)
+
+def file_usage_b(filename):
+    """
+    Returns the apparent size and the allocated size (bytes) of a file. Both
+    differ for sparse files, where the holes are not allocated.
+
+    :param filename: File name.
+    :returns: A list with the apparent and allocated sizes.
+    :exception ProbeError: When unable to stat the file.
+    """
+
+    try:
+        st = os.stat(filename)
+    except OSError as e:
+        raise ProbeError('Unable to stat %s: %s' % (filename, e.strerror))
+    # st_blocks is always in 512 bytes units
+    return [st.st_size, st.st_blocks * 512]
+
+def is_udp_port_open(port):
+    """
+    True if there is a socket bound to the given local UDP port (IPv4 or
+    IPv6), false otherwise.
+
+    :param port: UDP port.
+    """
+
+    for filename in PROC_NET_UDP:
+        try:
+            lines = _read(filename).splitlines()[1:]
+        except IOError:
+            continue
+        for line in lines:
+            fields = line.split()
+            try:
+                local_port = int(fields[1].split(':')[1], 16)
+            except (IndexError, ValueError):
+                continue
+            if local_port == int(port):
+                return True
+    return False
@@ -0,0 +1,841 @@
+#!/usr/bin/env python
+# ==========================================================================
+#
+# Copyright (C) 2013-2014 RidgeRun, LLC (http://www.ridgerun.com)
+#
+# Author: Jose Pablo Carballo <jose.carballo@ridgerun.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# Raw block writer for devices and image files.
+#
+# ==========================================================================
+
+"""
+The rawwriter module writes raw data (a file, a region of a file, zeros or
+the output of a decompressor) into a device or image file at a given offset,
+using large page-aligned buffers, optionally `O_DIRECT`, and a single
+`fdatasync` at the end.
+
+Writing into a device needs superuser access, so the writer is also a
+standalone program, executed through `sudo` (see :func:`raw_write_cmd`). It
+prints a report with the bytes written and the time taken:
+::
+    sudo python rawwriter.py --device /dev/sdb --file u-boot.imx --seek 1024
+    rawwriter: 358400 bytes in 0.041 s
+
+When writing the output of a decompressor, a second line reports the
+decompression and the writes separately:
+::
+    sudo python rawwriter.py --device /dev/sdb --skip-zeros --direct \\
+        --decompress 'xz -dc -T0 sd.img.xz'
+    rawwriter: 402653184 bytes in 9.870 s
+    rawwriter: stream 2147483648 bytes read in 6.125 s, written in 9.412 s, \\
+        1744830464 zero bytes skipped
+
+When reflashing a card that holds a previous build, `--compare` reads each
+block of the target first and writes only the blocks that differ; another
+line reports the comparison:
+::
+    sudo python rawwriter.py --device /dev/sdb --file sd.img --sparse \
+        --direct --compare
+    rawwriter: 50331648 bytes in 4.210 s
+    rawwriter: compare 402653184 bytes read in 1.912 s, 352321536 identical \
+        bytes skipped, written in 2.104 s
+
+Only the standard library (and :mod:`fileutils`, a sibling module) can be used
+here.
+"""
+
+# ==========================================================================
+# Imports
+# ==========================================================================
+
+import os
+import io
+import sys
+import time
+import mmap
+import stat
+import errno
+import fcntl
+import pipes
+import struct
+import Queue
+import argparse
+import threading
+import subprocess
+import xml.etree.ElementTree as ElementTree
+import fileutils
+
+# Exported into openfd.utils, without the report parsers, which every
+# helper program has under the same names
+__all__ = ['RawWriterError', 'RawWriter', 'WIPE_AUTO', 'WIPE_DISCARD',
+           'WIPE_ZEROOUT', 'WIPE_PUNCH', 'WIPE_ZEROS', 'WIPE_METHODS',
+           'dd_size', 'bmap_ranges', 'raw_write_cmd']
+
+# ==========================================================================
+# Constants
+# ==========================================================================
+
+#: Size of the write buffers.
+BUFFER_SIZE = 4 << 20
+
+#: Alignment required by O_DIRECT (logical block size of the devices).
+DIRECT_ALIGN = 4096
+
+#: Prefix of the report line.
+REPORT_PREFIX = 'rawwriter:'
+
+#: Granularity of the zero blocks skipped when writing streams.
+ZERO_BLOCK_SIZE = 64 << 10
+
+#: Buffers read ahead when writing streams.
+STREAM_BUFFERS = 4
+
+#: Granularity of the blocks compared against the target, and skipped if
+#: identical.
+COMPARE_BLOCK_SIZE = 1 << 20
+
+# Wipe methods
+WIPE_AUTO = 'auto'
+WIPE_DISCARD = 'discard'
+WIPE_ZEROOUT = 'zeroout'
+WIPE_PUNCH = 'punch'
+WIPE_ZEROS = 'zeros'
+
+WIPE_METHODS = [WIPE_AUTO, WIPE_DISCARD, WIPE_ZEROOUT, WIPE_PUNCH, WIPE_ZEROS]
+
+# Block device ioctls (linux/fs.h), argument: uint64_t range[2]
+BLKDISCARD = 0x1277
+BLKZEROOUT = 0x127f
+
+#: Sector size required for the ranges of the block device ioctls.
+IOCTL_ALIGN = 512
+
+# dd style size suffixes
+_DD_UNITS = {'c': 1, 'w': 2, 'b': 512, 'K': 1 << 10, 'k': 1 << 10,
+             'M': 1 << 20, 'G': 1 << 30, 'kB': 1000, 'MB': 1000 ** 2,
+             'GB': 1000 ** 3}
+
+# ==========================================================================
+# Public Classes
+# ==========================================================================
+
+class RawWriterError(Exception):
+    """Raw writer exceptions."""
+
+class RawWriter(object):
+    """
+    Writes raw data into a device or image file. Usage:
+    ::
+        writer = RawWriter('/dev/sdb', direct=True)
+        writer.write_file('u-boot.imx', offset=1024)
+        writer.close()
+
+    Writes with `O_DIRECT` are done for the aligned part of each region; the
+    unaligned head and tail go through the page cache. If the target doesn't
+    support `O_DIRECT` (i.e. files in tmpfs) all the writes are buffered.
+
+    In compare mode the target is read before writing, and the blocks of
+    :const:`COMPARE_BLOCK_SIZE` that already hold the data are skipped.
+    """
+
+    def __init__(self, target, direct=False, buffer_size=BUFFER_SIZE,
+                 compare=False):
+        """
+        :param target: Device or image file; it is not truncated.
+        :param direct: Write bypassing the page cache (`O_DIRECT`).
+        :param buffer_size: Size of the write buffers (bytes), multiple of
+            :const:`DIRECT_ALIGN`.
+        :param compare: Read the target first and write only the blocks
+            that differ.
+        :exception RawWriterError: When unable to open the target.
+        """
+
+        self._target = target
+        self._is_blk = False
+        self._buffer_size = buffer_size
+        self._buf = mmap.mmap(-1, buffer_size)
+        self._direct_fd = None
+        self._compare_fd = None
+        self._bytes = 0
+        self._compared = 0
+        self._identical = 0
+        self._compare_secs = 0.0
+        self._write_secs = 0.0
+        self._start = time.time()
+        try:
+            self._fd = os.open(target, os.O_WRONLY)
+            if compare:
+                self._compare_fd = os.open(target, os.O_RDONLY)
+        except OSError as e:
+            raise RawWriterError('Unable to open %s: %s' % (target, e.strerror))
+        self._is_blk = stat.S_ISBLK(os.fstat(self._fd).st_mode)
+        if direct and hasattr(os, 'O_DIRECT'):
+            try:
+                self._direct_fd = os.open(target, os.O_WRONLY | os.O_DIRECT)
+            except OSError:
+                self._direct_fd = None
+
+    @property
+    def bytes_written(self):
+        """Number of bytes written."""
+
+        return self._bytes
+
+    @property
+    def elapsed(self):
+        """Seconds since the writer was opened."""
+
+        return time.time() - self._start
+
+    @property
+    def compare_stats(self):
+        """
+        A tuple with the bytes compared against the target, the seconds
+        spent reading them, the identical bytes (skipped) and the seconds
+        spent writing the rest; none if not in compare mode.
+        """
+
+        if self._compare_fd is None:
+            return None
+        return (self._compared, self._compare_secs, self._identical,
+                self._write_secs)
+
+    def _write_buffered(self, offset, data):
+        os.lseek(self._fd, offset, os.SEEK_SET)
+        while data:
+            written = os.write(self._fd, data)
+            data = data[written:]
+
+    def _write_direct(self, offset, length):
+        # The data is in the aligned buffer, length is aligned too
+        os.lseek(self._direct_fd, offset, os.SEEK_SET)
+        try:
+            written = os.write(self._direct_fd, buffer(self._buf, 0, length))
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise
+            # O_DIRECT not really supported by the target, go buffered
+            os.close(self._direct_fd)
+            self._direct_fd = None
+            self._write_buffered(offset, self._buf[:length])
+            return
+        if written != length:
+            raise OSError(errno.EIO, 'Short write')
+
+    def _write_chunk_data(self, data, offset):
+        # Writes a chunk starting at an aligned offset (for O_DIRECT)
+        chunk = len(data)
+        aligned = 0
+        if self._direct_fd is not None:
+            aligned = chunk - chunk % DIRECT_ALIGN
+        if aligned:
+            self._buf.seek(0)
+            self._buf.write(data[:aligned])
+            self._write_direct(offset, aligned)
+        if aligned < chunk:
+            self._write_buffered(offset + aligned, data[aligned:])
+        self._bytes += chunk
+
+    def _read_target(self, offset, length):
+        os.lseek(self._compare_fd, offset, os.SEEK_SET)
+        data = ''
+        while len(data) < length:
+            block = os.read(self._compare_fd, length - len(data))
+            if not block:
+                break
+            data += block
+        # The blocks written are read back from the target when verifying
+        fileutils.drop_cache(self._compare_fd, offset, length)
+        return data
+
+    def _write_changed(self, data, offset):
+        # Writes only the blocks of a chunk that differ from the target
+        start = time.time()
+        old = self._read_target(offset, len(data))
+        self._compare_secs += time.time() - start
+        runs, identical = _changed_runs(data, old, offset)
+        self._compared += len(data)
+        self._identical += identical
+        start = time.time()
+        for run_start, run_end in runs:
+            self._write_chunk_data(data[run_start - offset:run_end - offset],
+                                   run_start)
+        self._write_secs += time.time() - start
+
+    def _write_region(self, src, src_offset, offset, length):
+        head = 0
+        if self._direct_fd is not None:
+            head = min(length, (DIRECT_ALIGN - offset % DIRECT_ALIGN) %
+                       DIRECT_ALIGN)
+        if head:
+            src.seek(src_offset)
+            self._write_buffered(offset, src.read(head))
+            self._bytes += head
+            src_offset += head
+            offset += head
+            length -= head
+        src.seek(src_offset)
+        while length > 0:
+            chunk = min(length, self._buffer_size)
+            data = src.read(chunk)
+            if len(data) != chunk:
+                raise RawWriterError('Unexpected end of data at %s' %
+                                     (src_offset + len(data)))
+            if self._compare_fd is not None:
+                self._write_changed(data, offset)
+            else:
+                self._write_chunk_data(data, offset)
+            src_offset += chunk
+            offset += chunk
+            length -= chunk
+
+    def write_file(self, filename, offset=0, skip=0, length=None):
+        """
+        Writes a file, or a region of it, into the target.
+
+        :param filename: Source file.
+        :param offset: Offset in the target (bytes).
+        :param skip: Offset in the source file (bytes).
+        :param length: Bytes to write; by default up to the end of the file.
+        :exception RawWriterError: On failure.
+        """
+
+        try:
+            with io.open(filename, 'rb') as src:
+                if length is None:
+                    length = os.fstat(src.fileno()).st_size - skip
+                self._write_region(src, skip, offset, length)
+        except (IOError, OSError) as e:
+            raise RawWriterError('Failed writing %s into %s: %s' %
+                                 (filename, self._target, e))
+
+    def write_data(self, data, offset):
+        """
+        Writes a buffer into the target.
+
+        :param data: Data to write (string).
+        :param offset: Offset in the target (bytes).
+        :exception RawWriterError: On failure.
+        """
+
+        try:
+            self._write_region(io.BytesIO(data), 0, offset, len(data))
+        except (IOError, OSError) as e:
+            raise RawWriterError('Failed writing into %s at %s: %s' %
+                                 (self._target, offset, e))
+
+    def write_sparse(self, filename, ranges=None):
+        """
+        Writes the regions of a file holding data into the target, at the same
+        offsets. The regions are read from the file (`SEEK_DATA`) unless
+        given.
+
+        :param filename: Source file.
+        :param ranges: List of (offset, length) tuples (bytes).
+        :exception RawWriterError: On failure.
+        """
+
+        try:
+            with io.open(filename, 'rb') as src:
+                if ranges is None:
+                    size_b = os.fstat(src.fileno()).st_size
+                    ranges = fileutils.data_segments(src.fileno(), size_b)
+                for offset, length in ranges:
+                    self._write_region(src, offset, offset, length)
+        except (IOError, OSError) as e:
+            raise RawWriterError('Failed writing %s into %s: %s' %
+                                 (filename, self._target, e))
+
+    def _read_stream(self, src, pending, stats):
+        try:
+            while True:
+                start = time.time()
+                data = src.read(self._buffer_size)
+                stats['read_secs'] += time.time() - start
+                pending.put(data)
+                if not data:
+                    break
+        except (IOError, OSError) as e:
+            stats['error'] = e
+            pending.put('')
+
+    def _write_chunk(self, data, offset, regions, skip_zeros):
+        # Writes the non-zero runs of the regions of a chunk of the stream
+        skipped = 0
+        for start, end in regions:
+            runs = [(start, end)]
+            if skip_zeros:
+                runs, zeros = _nonzero_runs(data, offset, start, end)
+                skipped += zeros
+            for run_start, run_end in runs:
+                self._write_region(io.BytesIO(data), run_start - offset,
+                                   run_start, run_end - run_start)
+        return skipped
+
+    def write_stream(self, src, ranges=None, skip_zeros=False):
+        """
+        Writes a stream (i.e. an image decompressed into a pipe) into the
+        target, from offset 0. The stream is read ahead by another thread,
+        so producing the stream (decompressing) and writing overlap.
+
+        :param src: File object to read the stream from.
+        :param ranges: Write only these regions of the stream, as (offset,
+            length) tuples (bytes) sorted by offset; the rest is discarded.
+        :param skip_zeros: Don't write the blocks of
+            :const:`ZERO_BLOCK_SIZE` that only hold zeros; as with the
+            unmapped regions, the target is left untouched there.
+        :returns: A tuple with the bytes read from the stream, the seconds
+            spent waiting for the stream, the seconds spent writing and the
+            zero bytes skipped.
+        :exception RawWriterError: On failure.
+        """
+
+        pending = Queue.Queue(STREAM_BUFFERS)
+        stats = {'read_secs': 0.0, 'error': None}
+        reader = threading.Thread(target=self._read_stream,
+                                  args=(src, pending, stats))
+        reader.daemon = True
+        reader.start()
+        offset = skipped = first = 0
+        write_secs = 0.0
+        try:
+            while True:
+                data = pending.get()
+                if not data:
+                    break
+                start = time.time()
+                regions, first = _mapped(ranges, offset, offset + len(data),
+                                         first)
+                skipped += self._write_chunk(data, offset, regions,
+                                             skip_zeros)
+                write_secs += time.time() - start
+                offset += len(data)
+        except (IOError, OSError) as e:
+            raise RawWriterError('Failed writing into %s at %s: %s' %
+                                 (self._target, offset, e))
+        if stats['error']:
+            raise RawWriterError('Failed reading the stream at %s: %s' %
+                                 (offset, stats['error']))
+        return offset, stats['read_secs'], write_secs, skipped
+
+    def write_zeros(self, offset, length):
+        """
+        Writes zeros into the target.
+
+        :param offset: Offset in the target (bytes).
+        :param length: Bytes to write.
+        :exception RawWriterError: On failure.
+        """
+
+        try:
+            self._write_region(_Zeros(), 0, offset, length)
+        except (IOError, OSError) as e:
+            raise RawWriterError('Failed writing zeros into %s: %s' %
+                                 (self._target, e))
+
+    def _is_zeroed(self, offset, length):
+        with io.open(self._target, 'rb') as f:
+            f.seek(offset)
+            while length > 0:
+                data = f.read(min(length, self._buffer_size))
+                if not data or data.count('\x00') != len(data):
+                    return False
+                length -= len(data)
+        return True
+
+    def _wipe(self, method, offset, length):
+        if method in [WIPE_DISCARD, WIPE_ZEROOUT]:
+            if offset % IOCTL_ALIGN or length % IOCTL_ALIGN:
+                raise OSError(errno.EINVAL, 'Unaligned range')
+            request = BLKDISCARD if method == WIPE_DISCARD else BLKZEROOUT
+            fcntl.ioctl(self._fd, request, struct.pack('QQ', offset, length))
+        elif method == WIPE_PUNCH:
+            fileutils.punch_hole(self._fd, offset, length)
+        else:
+            self._write_region(_Zeros(), 0, offset, length)
+            return
+        self._bytes += length
+
+    def wipe(self, offset, length, method=WIPE_AUTO):
+        """
+        Wipes a region of the target, so it reads as zeros. Methods:
+
+        * discard - `BLKDISCARD`, the device erases the blocks, no data is
+          transferred. After a discard some devices read zeros, others
+          (0xff or the old data) don't: in auto mode the region is read back
+          and the next method is tried if it isn't zeroed.
+        * zeroout - `BLKZEROOUT`, the kernel zeroes the blocks using the
+          fastest mechanism supported by the device.
+        * punch - `FALLOC_FL_PUNCH_HOLE`, for image files.
+        * zeros - buffered writes of zeros.
+        * auto - discard, zeroout and zeros for block devices; punch and
+          zeros for files.
+
+        :param offset: Offset in the target (bytes).
+        :param length: Bytes to wipe.
+        :param method: Wipe method, one of :const:`WIPE_METHODS`.
+        :returns: The method used.
+        :exception RawWriterError: On failure.
+        """
+
+        if method == WIPE_AUTO:
+            if self._is_blk:
+                methods = [WIPE_DISCARD, WIPE_ZEROOUT, WIPE_ZEROS]
+            else:
+                methods = [WIPE_PUNCH, WIPE_ZEROS]
+        else:
+            methods = [method]
+        for m in methods:
+            try:
+                self._wipe(m, offset, length)
+            except (IOError, OSError) as e:
+                if m == methods[-1]:
+                    raise RawWriterError('Failed wiping %s (%s): %s' %
+                                         (self._target, m, e))
+                continue
+            if (m == WIPE_DISCARD and method == WIPE_AUTO and
+                not self._is_zeroed(offset, length)):
+                self._bytes -= length
+                continue
+            return m
+
+    def close(self):
+        """
+        Flushes the data to the target (`fdatasync`) and closes it.
+
+        :exception RawWriterError: On failure.
+        """
+
+        try:
+            os.fdatasync(self._fd)
+        except OSError as e:
+            raise RawWriterError('Failed syncing %s: %s' %
+                                 (self._target, e.strerror))
+        finally:
+            os.close(self._fd)
+            if self._direct_fd is not None:
+                os.close(self._direct_fd)
+            if self._compare_fd is not None:
+                os.close(self._compare_fd)
+            self._buf.close()
+
+class _Zeros(object):
+    # Minimal file-like source of zeros
+
+    def seek(self, offset):
+        pass
+
+    def read(self, size):
+        return '\x00' * size
+
+# ==========================================================================
+# Functions
+# ==========================================================================
+
+def _mapped(ranges, start, end, first=0):
+    # Regions of [start, end) inside the ranges (all of it without ranges),
+    # and the index of the first range not finished before end; the ranges
+    # are sorted, so the next call can start there
+    if ranges is None:
+        return [(start, end)], first
+    regions = []
+    for i in xrange(first, len(ranges)):
+        offset, length = ranges[i]
+        if offset >= end:
+            break
+        if offset + length > start:
+            regions.append((max(offset, start), min(offset + length, end)))
+        if offset + length <= end:
+            first = i + 1
+    return regions, first
+
+def _nonzero_runs(data, data_offset, start, end):
+    # Splits [start, end) of data (at data_offset in the stream) into runs
+    # of non-zero blocks, aligned to ZERO_BLOCK_SIZE in the stream
+    runs = []
+    zeros = 0
+    block = start
+    while block < end:
+        block_end = min(end, (block // ZERO_BLOCK_SIZE + 1) * ZERO_BLOCK_SIZE)
+        chunk = data[block - data_offset:block_end - data_offset]
+        if chunk.count('\x00') == len(chunk):
+            zeros += len(chunk)
+        elif runs and runs[-1][1] == block:
+            runs[-1] = (runs[-1][0], block_end)
+        else:
+            runs.append((block, block_end))
+        block = block_end
+    return runs, zeros
+
+def _changed_runs(data, old, data_offset):
+    # Splits data (at data_offset in the target) into runs of blocks that
+    # differ from the old data of the target, aligned to COMPARE_BLOCK_SIZE
+    # in the target; returns the runs and the identical bytes
+    runs = []
+    identical = 0
+    block = data_offset
+    end = data_offset + len(data)
+    while block < end:
+        block_end = min(end, (block // COMPARE_BLOCK_SIZE + 1) *
+                        COMPARE_BLOCK_SIZE)
+        first, last = block - data_offset, block_end - data_offset
+        if data[first:last] == old[first:last]:
+            identical += last - first
+        elif runs and runs[-1][1] == block:
+            runs[-1] = (runs[-1][0], block_end)
+        else:
+            runs.append((block, block_end))
+        block = block_end
+    return runs, identical
+
+def dd_size(value):
+    """
+    Converts a size in the format of `dd` arguments (i.e. '512', '1K', '2M')
+    to bytes.
+
+    :param value: Size.
+    :exception ValueError: On an invalid size.
+    """
+
+    value = str(value).strip()
+    for suffix in sorted(_DD_UNITS, key=len, reverse=True):
+        if value.endswith(suffix):
+            return int(value[:-len(suffix)]) * _DD_UNITS[suffix]
+    return int(value)
+
+def bmap_ranges(filename):
+    """
+    Returns the mapped regions of a block map file (bmaptool format) as
+    (offset, length) tuples in bytes.
+
+    :param filename: Block map file.
+    :exception RawWriterError: When unable to read the block map.
+    """
+
+    try:
+        root = ElementTree.parse(filename).getroot()
+        image_size = int(root.find('ImageSize').text)
+        block_size = int(root.find('BlockSize').text)
+        ranges = []
+        for node in root.find('BlockMap'):
+            blocks = node.text.strip().split('-')
+            offset = int(blocks[0]) * block_size
+            end = min((int(blocks[-1]) + 1) * block_size, image_size)
+            ranges.append((offset, end - offset))
+    except (IOError, ElementTree.ParseError, AttributeError,
+            ValueError, TypeError) as e:
+        raise RawWriterError('Invalid block map %s: %s' % (filename, e))
+    return ranges
+
+def raw_write_cmd(target, filename='', offset=0, skip=0, length=None,
+                  zeros=False, sparse=False, bmap_file='', direct=False,
+                  wipe='', decompress='', skip_zeros=False, compare=False):
+    """
+    Returns the command that runs this module as a program, through `sudo`,
+    to write into the given target.
+
+    :param target: Device or image file.
+    :param filename: Source file.
+    :param offset: Offset in the target (bytes).
+    :param skip: Offset in the source file (bytes).
+    :param length: Bytes to write.
+    :param zeros: Write zeros instead of a file, `length` is required.
+    :param sparse: Write only the regions of the source file with data.
+    :param bmap_file: Write only the regions mapped in this block map.
+    :param direct: Write bypassing the page cache (`O_DIRECT`).
+    :param wipe: Wipe the region using this method (see
+        :func:`RawWriter.wipe`) instead of writing a file, `length` is
+        required.
+    :param decompress: Write the output of this command (i.e. 'xz -dc
+        sd.img.xz') instead of a file, see :func:`RawWriter.write_stream`.
+    :param skip_zeros: Don't write the zero blocks of the `decompress`
+        output.
+    :param compare: Read the target first and write only the blocks that
+        differ.
+    """
+
+    program = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+    cmd = 'sudo %s %s --device %s' % (sys.executable, program, target)
+    if wipe:
+        cmd += ' --wipe %s' % wipe
+    elif decompress:
+        cmd += ' --decompress %s' % pipes.quote(decompress)
+    elif zeros:
+        cmd += ' --zeros'
+    else:
+        cmd += ' --file %s' % filename
+    if offset:
+        cmd += ' --seek %s' % offset
+    if skip:
+        cmd += ' --skip %s' % skip
+    if length is not None:
+        cmd += ' --length %s' % length
+    if sparse:
+        cmd += ' --sparse'
+    if bmap_file:
+        cmd += ' --bmap %s' % bmap_file
+    if direct:
+        cmd += ' --direct'
+    if skip_zeros:
+        cmd += ' --skip-zeros'
+    if compare:
+        cmd += ' --compare'
+    return cmd
+
+def parse_report(output):
+    """
+    Parses the report printed by the writer program.
+
+    :param output: Output of the program.
+    :returns: A tuple with the bytes written, the seconds taken and the
+        wipe method used (empty if not wiping), or none if there is no report.
+    """
+
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) >= 5 and fields[0] == REPORT_PREFIX:
+            try:
+                method = fields[8] if len(fields) >= 9 else ''
+                return long(fields[1]), float(fields[4]), method
+            except ValueError:
+                return None
+    return None
+
+def parse_stream_report(output):
+    """
+    Parses the stream report printed by the writer program when writing the
+    output of a decompressor.
+
+    :param output: Output of the program.
+    :returns: A tuple with the bytes decompressed, the seconds spent waiting
+        for the decompressor, the seconds spent writing and the zero bytes
+        skipped, or none if there is no stream report.
+    """
+
+    for line in output.splitlines():
+        fields = line.split()
+        if (len(fields) >= 13 and fields[0] == REPORT_PREFIX and
+            fields[1] == 'stream'):
+            try:
+                return (long(fields[2]), float(fields[6]), float(fields[10]),
+                        long(fields[12]))
+            except ValueError:
+                return None
+    return None
+
+def parse_compare_report(output):
+    """
+    Parses the compare report printed by the writer program in compare
+    mode.
+
+    :param output: Output of the program.
+    :returns: A tuple with the bytes compared, the seconds spent reading
+        them from the target, the identical bytes skipped and the seconds
+        spent writing the rest, or none if there is no compare report.
+    """
+
+    for line in output.splitlines():
+        fields = line.split()
+        if (len(fields) >= 15 and fields[0] == REPORT_PREFIX and
+            fields[1] == 'compare'):
+            try:
+                return (long(fields[2]), float(fields[6]), long(fields[8]),
+                        float(fields[14]))
+            except ValueError:
+                return None
+    return None
+
+def _write_decompressed(writer, cmd, ranges, skip_zeros):
+    proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
+    try:
+        stream = writer.write_stream(proc.stdout, ranges, skip_zeros)
+    except RawWriterError:
+        proc.kill()
+        proc.wait()
+        raise
+    if proc.wait() != 0:
+        raise RawWriterError("'%s' failed with exit code %s" %
+                             (cmd, proc.returncode))
+    return stream
+
+def _main():
+    parser = argparse.ArgumentParser(description='Raw block writer')
+    parser.add_argument('--device', required=True,
+                        help='Device or image file to write into')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--file', help='Source file')
+    source.add_argument('--zeros', action='store_true',
+                        help='Write zeros (requires --length)')
+    source.add_argument('--wipe', choices=WIPE_METHODS,
+                        help='Wipe using the given method (requires --length)')
+    source.add_argument('--decompress', metavar='CMD',
+                        help='Write the output of this command, i.e. a '
+                        'decompressor')
+    parser.add_argument('--seek', type=long, default=0,
+                        help='Offset in the device (bytes)')
+    parser.add_argument('--skip', type=long, default=0,
+                        help='Offset in the source file (bytes)')
+    parser.add_argument('--length', type=long, default=None,
+                        help='Bytes to write')
+    parser.add_argument('--sparse', action='store_true',
+                        help='Write only the regions of the file with data')
+    parser.add_argument('--bmap',
+                        help='Write only the regions mapped in this block map')
+    parser.add_argument('--direct', action='store_true',
+                        help='Write bypassing the page cache (O_DIRECT)')
+    parser.add_argument('--skip-zeros', action='store_true',
+                        help="Don't write the zero blocks of the --decompress "
+                        "output")
+    parser.add_argument('--compare', action='store_true',
+                        help='Read the device first and write only the blocks '
+                        'that differ')
+    args = parser.parse_args()
+    if (args.zeros or args.wipe) and args.length is None:
+        parser.error('--zeros and --wipe require --length')
+    method = ''
+    stream = None
+    try:
+        writer = RawWriter(args.device, direct=args.direct,
+                           compare=args.compare)
+        try:
+            if args.wipe:
+                method = writer.wipe(args.seek, args.length, args.wipe)
+            elif args.decompress:
+                ranges = bmap_ranges(args.bmap) if args.bmap else None
+                stream = _write_decompressed(writer, args.decompress, ranges,
+                                             args.skip_zeros)
+            elif args.zeros:
+                writer.write_zeros(args.seek, args.length)
+            elif args.bmap:
+                writer.write_sparse(args.file, bmap_ranges(args.bmap))
+            elif args.sparse:
+                writer.write_sparse(args.file)
+            else:
+                writer.write_file(args.file, args.seek, args.skip,
+                                  args.length)
+        finally:
+            writer.close()
+    except RawWriterError as e:
+        sys.stderr.write('%s %s\n' % (REPORT_PREFIX, e))
+        return 1
+    report = '%s %s bytes in %.3f s' % (REPORT_PREFIX, writer.bytes_written,
+                                        writer.elapsed)
+    if method:
+        report += ' wiped with %s' % method
+    print report
+    if stream:
+        print ('%s stream %s bytes read in %.3f s, written in %.3f s, %s '
+               'zero bytes skipped' % ((REPORT_PREFIX,) + stream))
+    if writer.compare_stats:
+        print ('%s compare %s bytes read in %.3f s, %s identical bytes '
+               'skipped, written in %.3f s' %
+               ((REPORT_PREFIX,) + writer.compare_stats))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(_main())
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# ==========================================================================
+#
+# Copyright (C) 2013-2014 RidgeRun, LLC (http://www.ridgerun.com)
+#
+# Author: Jose Pablo Carballo <jose.carballo@ridgerun.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# Recording and replay of the system interactions of an installation.
+#
+# ==========================================================================
+
+"""
+The session module records the system commands executed by the
+:class:`Executer` (with their return code, output and duration) and the
+results of the system probes into a session file. The session can later be
+replayed, serving the recorded results instead of touching the system, with
+the original or scaled timings.
+
+Session file:
+::
+    {"version": 1,
+     "entries": [
+        {"type": "cmd", "method": "check_output", "cmd": "sudo fdisk -l ...",
+         "retcode": 0, "output": "...", "duration": 0.012},
+        {"type": "probe", "name": "device_size_b", "args": ["/dev/sdb"],
+         "kwargs": {}, "result": 3965190144, "error": null, "duration": 0.0}
+     ]}
+"""
+
+# ==========================================================================
+# Imports
+# ==========================================================================
+
+import json
+import time
+import threading
+
+# ==========================================================================
+# Constants
+# ==========================================================================
+
+SESSION_VERSION = 1
+
+TYPE_CMD = 'cmd'
+TYPE_PROBE = 'probe'
+
+# ==========================================================================
+# Functions
+# ==========================================================================
+
+def _to_str(value):
+    # JSON strings are loaded as unicode, the rest of the code uses str
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [_to_str(v) for v in value]
+    if isinstance(value, dict):
+        return dict((_to_str(k), _to_str(v)) for k, v in value.items())
+    return value
+
+def _probe_key(name, args, kwargs):
+    return json.dumps([name, list(args), kwargs], sort_keys=True)
+
+# ==========================================================================
+# Public Classes
+# ==========================================================================
+
+class SessionError(Exception):
+    """Session exceptions."""
+
+class SessionRecorder(object):
+    """
+    Records system commands and probes into a session.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = []
+
+    def add_cmd(self, method, cmd, retcode, output, duration):
+        """
+        Records a system command.
+
+        :param method: Executer method, i.e. 'check_output'.
+        :param cmd: Command.
+        :param retcode: Return code of the command.
+        :param output: Output of the command.
+        :param duration: Duration of the command (seconds).
+        """
+
+        entry = {'type': TYPE_CMD,
+                 'method': method,
+                 'cmd': cmd,
+                 'retcode': retcode,
+                 'output': output.decode('utf-8', 'replace'),
+                 'duration': duration}
+        with self._lock:
+            self._entries.append(entry)
+
+    def add_probe(self, name, args, kwargs, result, error, duration):
+        """
+        Records a system probe.
+
+        :param name: Probe name, i.e. 'device_size_b'.
+        :param args: Positional arguments of the probe.
+        :param kwargs: Keyword arguments of the probe.
+        :param result: Value returned by the probe.
+        :param error: Error message if the probe failed, none otherwise.
+        :param duration: Duration of the probe (seconds).
+        """
+
+        entry = {'type': TYPE_PROBE,
+                 'name': name,
+                 'args': list(args),
+                 'kwargs': kwargs,
+                 'result': result,
+                 'error': error,
+                 'duration': duration}
+        with self._lock:
+            self._entries.append(entry)
+
+    def write(self, filename):
+        """
+        Writes the session to a file.
+
+        :param filename: Output file.
+        :exception IOError: When unable to write the file.
+        """
+
+        with self._lock:
+            entries = list(self._entries)
+        with open(filename, 'w') as f:
+            json.dump({'version': SESSION_VERSION, 'entries': entries}, f,
+                      indent=1)
+
+class SessionPlayer(object):
+    """
+    Serves the results recorded in a session. Commands and probes are matched
+    by their text and arguments, in the order they were recorded.
+    """
+
+    def __init__(self, filename, time_scale=1.0):
+        """
+        :param filename: Session file.
+        :param time_scale: Factor applied to the recorded durations; 0
+            replays without waiting.
+        :exception SessionError: When unable to read the session file.
+        """
+
+        self._time_scale = time_scale
+        self._lock = threading.Lock()
+        self._cmds = {}
+        self._probes = {}
+        try:
+            with open(filename) as f:
+                session = json.load(f)
+        except (IOError, ValueError) as e:
+            raise SessionError('Unable to read session %s: %s' % (filename, e))
+        if session.get('version') != SESSION_VERSION:
+            raise SessionError('Unsupported session version in %s' % filename)
+        for entry in _to_str(session.get('entries', [])):
+            if entry['type'] == TYPE_CMD:
+                self._cmds.setdefault(entry['cmd'], []).append(entry)
+            elif entry['type'] == TYPE_PROBE:
+                key = _probe_key(entry['name'], entry['args'],
+                                 entry['kwargs'])
+                self._probes.setdefault(key, []).append(entry)
+
+    def __set_time_scale(self, time_scale):
+        self._time_scale = time_scale
+
+    def __get_time_scale(self):
+        return self._time_scale
+
+    time_scale = property(__get_time_scale, __set_time_scale,
+                          doc="""Factor applied to the recorded durations;
+                          0 replays without waiting.""")
+
+    def _next(self, entries, key):
+        with self._lock:
+            queue = entries.get(key)
+            if not queue:
+                return None
+            # The last occurrence is served repeatedly, i.e. for polling
+            return queue.pop(0) if len(queue) > 1 else queue[0]
+
+    def _wait(self, entry):
+        if self._time_scale > 0 and entry.get('duration'):
+            time.sleep(entry['duration'] * self._time_scale)
+
+    def cmd(self, cmd):
+        """
+        Returns the recorded results of a system command.
+
+        :param cmd: Command.
+        :returns: Returns a tuple with the return code and the output of the
+            command.
+        :exception SessionError: When the command is not in the session.
+        """
+
+        entry = self._next(self._cmds, cmd)
+        if entry is None:
+            raise SessionError("Command not found in the session: '%s'" % cmd)
+        self._wait(entry)
+        return entry['retcode'], entry['output']
+
+    def probe(self, name, args, kwargs):
+        """
+        Returns the recorded result of a system probe.
+
+        :param name: Probe name, i.e. 'device_size_b'.
+        :param args: Positional arguments of the probe.
+        :param kwargs: Keyword arguments of the probe.
+        :returns: Returns a tuple with the recorded result and error message
+            (none if the probe succeeded).
+        :exception SessionError: When the probe is not in the session.
+        """
+
+        entry = self._next(self._probes, _probe_key(name, args, kwargs))
+        if entry is None:
+            raise SessionError("Probe not found in the session: %s%s" %
+                               (name, tuple(args)))
+        self._wait(entry)
+        return entry['result'], entry['error']
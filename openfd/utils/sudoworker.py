@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+# ==========================================================================
+#
+# Copyright (C) 2013-2014 RidgeRun, LLC (http://www.ridgerun.com)
+#
+# Author: Jose Pablo Carballo <jose.carballo@ridgerun.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# Persistent privileged helper that executes commands received over a pipe.
+#
+# This module is executed as a standalone script through sudo, so it must
+# only depend on the Python standard library.
+#
+# ==========================================================================
+
+"""
+The sudoworker module implements a helper process that is started once with
+`sudo` and then receives commands over its `stdin`, one JSON object per line.
+This avoids a `sudo` (and PAM) round-trip for each privileged command.
+
+Request:
+::
+    {"id": 1, "cmd": "mkfs.ext4 /dev/sdb2 -L rootfs", "mode": "quiet"}
+
+Response:
+::
+    {"id": 1, "retcode": 0, "output": ""}
+
+Requests are executed concurrently, responses are matched by `id`.
+"""
+
+# ==========================================================================
+# Imports
+# ==========================================================================
+
+import os
+import sys
+import json
+import signal
+import threading
+import subprocess
+
+# Exported into openfd.utils
+__all__ = ['SudoWorkerError', 'SudoWorker', 'MODE_OUTPUT', 'MODE_CALL',
+           'MODE_QUIET']
+
+# ==========================================================================
+# Constants
+# ==========================================================================
+
+#: Return and log the output of the command (stdout and stderr).
+MODE_OUTPUT = 'output'
+
+#: Let the command print to the terminal.
+MODE_CALL = 'call'
+
+#: Discard the output of the command.
+MODE_QUIET = 'quiet'
+
+# ==========================================================================
+# Public Classes
+# ==========================================================================
+
+class SudoWorkerError(Exception):
+    """SudoWorker exceptions."""
+
+class SudoWorker(object):
+    """
+    Client side of the privileged helper. Starts the helper process via
+    `sudo` and sends it commands to execute as superuser.
+    """
+
+    def __init__(self, python=sys.executable):
+        """
+        :param python: Python interpreter used to run the helper.
+        """
+
+        self._python = python
+        self._proc = None
+        self._lock = threading.Lock()
+        self._next_id = 0
+        self._pending = {}
+        self._reader = None
+
+    @property
+    def is_alive(self):
+        """
+        True if the helper process is running, false otherwise.
+        """
+
+        return self._proc is not None and self._proc.poll() is None
+
+    def start(self):
+        """
+        Starts the helper process. The sudo credentials must be already cached
+        (see :func:`Executer.prompt_sudo`), the helper never prompts for a
+        password.
+
+        :exception SudoWorkerError: When the helper can't be started.
+        """
+
+        script = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+        try:
+            self._proc = subprocess.Popen(['sudo', '-n', self._python, script],
+                                          stdin=subprocess.PIPE,
+                                          stdout=subprocess.PIPE,
+                                          close_fds=True)
+        except OSError as e:
+            raise SudoWorkerError('Failed starting the sudo worker: %s' % e)
+        line = self._proc.stdout.readline()
+        try:
+            ready = json.loads(line).get('ready', False)
+        except ValueError:
+            ready = False
+        if not ready:
+            self._proc.wait()
+            self._proc = None
+            raise SudoWorkerError('The sudo worker failed to start')
+        self._reader = threading.Thread(target=self._read_responses)
+        self._reader.daemon = True
+        self._reader.start()
+
+    def stop(self):
+        """
+        Stops the helper process, waiting for any running command to finish.
+        """
+
+        if self._proc:
+            try:
+                self._proc.stdin.close()
+            except IOError:
+                pass
+            self._proc.wait()
+            self._proc = None
+
+    def _read_responses(self):
+        while True:
+            line = self._proc.stdout.readline()
+            if not line:
+                break
+            try:
+                response = json.loads(line)
+            except ValueError:
+                continue
+            with self._lock:
+                waiter = self._pending.pop(response.get('id'), None)
+            if waiter:
+                waiter[1] = (response.get('retcode', -1),
+                             response.get('output', '').encode('utf-8'))
+                waiter[0].set()
+        # The helper died: release anybody still waiting
+        with self._lock:
+            pending = self._pending.values()
+            self._pending = {}
+        for waiter in pending:
+            waiter[1] = (-1, 'The sudo worker terminated unexpectedly')
+            waiter[0].set()
+
+    def run(self, cmd, mode=MODE_OUTPUT):
+        """
+        Executes a command as superuser in the helper process.
+
+        :param cmd: Command (without the `sudo` prefix).
+        :param mode: Output handling: :const:`MODE_OUTPUT`,
+            :const:`MODE_CALL`, :const:`MODE_QUIET`.
+        :returns: Returns a tuple with the return code and the output of the
+            command (only for :const:`MODE_OUTPUT`).
+        """
+
+        waiter = [threading.Event(), None]
+        with self._lock:
+            if not self.is_alive:
+                return -1, 'The sudo worker is not running'
+            self._next_id += 1
+            request_id = self._next_id
+            self._pending[request_id] = waiter
+            request = json.dumps({'id': request_id, 'cmd': cmd, 'mode': mode})
+            try:
+                self._proc.stdin.write(request + '\n')
+                self._proc.stdin.flush()
+            except IOError:
+                self._pending.pop(request_id, None)
+                return -1, 'The sudo worker is not running'
+        # Event.wait() without a timeout can't be interrupted in Python 2
+        while not waiter[0].wait(1):
+            pass
+        return waiter[1]
+
+# ==========================================================================
+# Helper process
+# ==========================================================================
+
+def _restore_sigint():
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+def _execute(request, out_lock):
+    retcode = 0
+    output = ''
+    cmd = request.get('cmd', '')
+    mode = request.get('mode', MODE_OUTPUT)
+    try:
+        if mode == MODE_OUTPUT:
+            proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT,
+                                    preexec_fn=_restore_sigint)
+            output = proc.communicate()[0]
+        elif mode == MODE_CALL:
+            # stdout is our channel with the client, use the terminal instead
+            proc = subprocess.Popen(cmd, shell=True, stdout=sys.stderr,
+                                    preexec_fn=_restore_sigint)
+            proc.wait()
+        else:
+            with open(os.devnull, 'wb') as devnull:
+                proc = subprocess.Popen(cmd, shell=True, stdout=devnull,
+                                        stderr=devnull,
+                                        preexec_fn=_restore_sigint)
+                proc.wait()
+        retcode = proc.returncode
+    except OSError as e:
+        retcode = 127
+        output = str(e)
+    response = json.dumps({'id': request.get('id'), 'retcode': retcode,
+                           'output': output.decode('utf-8', 'replace')})
+    with out_lock:
+        sys.stdout.write(response + '\n')
+        sys.stdout.flush()
+
+def serve():
+    """
+    Main loop of the helper process: reads requests from `stdin` until EOF.
+    """
+
+    # Interrupts are handled by the client, which closes our stdin
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    out_lock = threading.Lock()
+    sys.stdout.write(json.dumps({'ready': True, 'pid': os.getpid()}) + '\n')
+    sys.stdout.flush()
+    while True:
+        line = sys.stdin.readline()
+        if not line:
+            break
+        try:
+            request = json.loads(line)
+        except ValueError:
+            continue
+        t = threading.Thread(target=_execute, args=(request, out_lock))
+        t.start()
+
+if __name__ == '__main__':
+    serve()
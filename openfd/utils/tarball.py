@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# ==========================================================================
+#
+# Copyright (C) 2013-2014 RidgeRun, LLC (http://www.ridgerun.com)
+#
+# Author: Jose Pablo Carballo <jose.carballo@ridgerun.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# Helpers to install a rootfs from a (compressed) tarball, and to stream
+# compressed images.
+#
+# ==========================================================================
+
+"""
+The tarball module builds the commands that stream a rootfs tarball into a
+directory: the tarball is decompressed and piped straight into `tar`, so it
+is read once and never extracted to an intermediate directory. Compressed
+SD card images (i.e. `sd.img.xz`) are streamed the same way into the raw
+writer, see :func:`rawwriter.RawWriter.write_stream`.
+
+The decompressor is picked by the extension of the tarball, preferring the
+multi-threaded implementations when installed (`xz -T0`, `pigz`, `lbzip2`,
+`pbzip2`). zstd and lz4 decompress on a single thread, which is still
+faster than the disk writes.
+"""
+
+# ==========================================================================
+# Imports
+# ==========================================================================
+
+import os
+import pipes
+
+# ==========================================================================
+# Constants
+# ==========================================================================
+
+#: Decompressors by tarball extension, in order of preference. Each one is a
+#: command that writes the decompressed tarball into stdout.
+DECOMPRESSORS = [
+    (('.tar.zst', '.tzst'), ['zstd -dc']),
+    (('.tar.xz', '.txz'), ['xz -dc -T0']),
+    (('.tar.gz', '.tgz'), ['pigz -dc', 'gzip -dc']),
+    (('.tar.bz2', '.tbz2', '.tbz'), ['lbzip2 -dc', 'pbzip2 -dc',
+                                     'bzip2 -dc']),
+    (('.tar.lz4',), ['lz4 -dc']),
+    (('.tar',), ['cat']),
+]
+
+#: Decompressors by compressed image extension (i.e. 'sd.img.xz'), in order
+#: of preference, as in :const:`DECOMPRESSORS`.
+IMAGE_DECOMPRESSORS = [
+    (('.zst',), ['zstd -dc']),
+    (('.xz',), ['xz -dc -T0']),
+    (('.gz',), ['pigz -dc', 'gzip -dc']),
+    (('.bz2',), ['lbzip2 -dc', 'pbzip2 -dc', 'bzip2 -dc']),
+    (('.lz4',), ['lz4 -dc']),
+]
+
+# ==========================================================================
+# Functions
+# ==========================================================================
+
+def is_tarball(path):
+    """
+    True if the given path has the extension of a supported tarball.
+
+    :param path: File name.
+    """
+
+    return _decompressors(path) is not None
+
+def is_compressed_image(path):
+    """
+    True if the given path has the extension of a supported compressed
+    image (i.e. 'sd.img.xz'), and is not a tarball.
+
+    :param path: File name.
+    """
+
+    return (not is_tarball(path) and
+            _decompressors(path, IMAGE_DECOMPRESSORS) is not None)
+
+def uncompressed_name(path):
+    """
+    Returns the name of a compressed image without the compression
+    extension, i.e. 'sd.img' for 'sd.img.xz'; the same name if not
+    compressed.
+
+    :param path: File name.
+    """
+
+    if is_compressed_image(path):
+        return os.path.splitext(path)[0]
+    return path
+
+def _decompressors(path, table=DECOMPRESSORS):
+    for extensions, cmds in table:
+        if path.endswith(extensions):
+            return cmds
+    return None
+
+def _installed(program):
+    for directory in os.environ.get('PATH', '').split(os.pathsep):
+        if os.access(os.path.join(directory, program), os.X_OK):
+            return True
+    return False
+
+def decompress_cmd(filename):
+    """
+    Returns the command that writes the decompressed tarball (or image) into
+    stdout; the first of its decompressors that is installed, or the last
+    one.
+
+    :param filename: Tarball or compressed image file name.
+    """
+
+    cmds = (_decompressors(filename) or
+            _decompressors(filename, IMAGE_DECOMPRESSORS) or ['cat'])
+    for cmd in cmds:
+        if _installed(cmd.split()[0]):
+            break
+    return '%s %s' % (cmd, pipes.quote(filename))
+
+def extract_cmd(tarball, directory):
+    """
+    Returns the command that streams the tarball into the given directory,
+    through `sudo`. Owners (numeric, as in the tarball), permissions and
+    extended attributes are preserved. The pipeline runs with `pipefail`,
+    so it fails if the decompressor does (i.e. on a truncated tarball).
+
+    :param tarball: Tarball file name.
+    :param directory: Destination directory, must exist.
+    """
+
+    pipeline = ("%s | sudo tar -x -p --numeric-owner --xattrs "
+                "--xattrs-include=\"*\" -f - -C %s" %
+                (decompress_cmd(tarball), directory))
+    return 'bash -o pipefail -c %s' % pipes.quote(pipeline)
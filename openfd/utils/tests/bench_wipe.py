@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# ==========================================================================
+#
+# Copyright (C) 2013-2014 RidgeRun, LLC (http://www.ridgerun.com)
+#
+# Author: Jose Pablo Carballo <jose.carballo@ridgerun.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# Benchmark of the wipe methods of the raw writer against dd.
+#
+# ==========================================================================
+
+"""
+Wipes the first 16 MB (the bootloader environment wipe of the sd mode) of a
+file-backed stand-in of an SD card, filled with data, using `dd` from
+`/dev/zero` (the former implementation) and each wipe method of the raw
+writer. When run as root the file is also attached to a loop device, to
+measure the block device methods (discard, zeroout).
+
+Usage: python bench_wipe.py [<dir>] [<runs>]
+"""
+
+import os, sys
+import time
+import subprocess
+import tempfile
+
+sys.path.insert(1, os.path.abspath('..'))
+
+import rawwriter
+from rawwriter import RawWriter
+from rawwriter import RawWriterError
+
+WIPE_SIZE = 16 << 20
+CARD_SIZE = 64 << 20
+
+def _fill(filename):
+    with open(filename, 'wb') as f:
+        chunk = os.urandom(1 << 20)
+        for i in range(CARD_SIZE >> 20):
+            f.write(chunk)
+        os.fsync(f.fileno())
+
+def _dd(target):
+    subprocess.check_call('dd if=/dev/zero of=%s bs=1M count=%s conv=notrunc,'
+                          'fsync 2>/dev/null' % (target, WIPE_SIZE >> 20),
+                          shell=True)
+    return 'dd'
+
+def _wipe(target, method):
+    writer = RawWriter(target)
+    try:
+        return writer.wipe(0, WIPE_SIZE, method)
+    finally:
+        writer.close()
+
+def _bench(name, filename, target, func, runs):
+    times = []
+    used = ''
+    for i in range(runs):
+        _fill(filename)
+        start = time.time()
+        try:
+            used = func(target)
+        except (RawWriterError, subprocess.CalledProcessError) as e:
+            print '%-22s unsupported (%s)' % (name, e)
+            return
+        times.append(time.time() - start)
+    times.sort()
+    median = times[len(times) // 2]
+    print '%-22s %8.1f ms  %8.1f MB/s  (%s)' % (name, median * 1000,
+            WIPE_SIZE / float(1 << 20) / median if median else 0, used)
+
+def main():
+    directory = sys.argv[1] if len(sys.argv) > 1 else tempfile.gettempdir()
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    fd, filename = tempfile.mkstemp(dir=directory, suffix='.img')
+    os.close(fd)
+    loop = None
+    try:
+        targets = [('file', filename)]
+        if os.geteuid() == 0:
+            _fill(filename)
+            loop = subprocess.check_output(['losetup', '-f', '--show',
+                                            filename]).strip()
+            targets.append(('loop', loop))
+        for kind, target in targets:
+            print '%s: %s (median of %d runs)' % (kind, target, runs)
+            _bench('dd', filename, target, _dd, runs)
+            for method in rawwriter.WIPE_METHODS:
+                _bench(method, filename, target,
+                       lambda t, m=method: _wipe(t, m), runs)
+    finally:
+        if loop:
+            subprocess.call(['losetup', '-d', loop])
+        os.remove(filename)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# ==========================================================================
+#
+# Copyright (C) 2013-2014 RidgeRun, LLC (http://www.ridgerun.com)
+#
+# Author: Jose Pablo Carballo <jose.carballo@ridgerun.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# Tests for the image compressor.
+#
+# ==========================================================================
+
+import os, sys
+import shutil
+import hashlib
+import tempfile
+import unittest
+import subprocess
+
+sys.path.insert(1, os.path.abspath('..'))
+
+import compressor
+from compressor import ImageCompressor
+from compressor import CompressorError
+
+class CompressorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.image = os.path.join(self.tmp, 'sd.img')
+        self.data = ''.join(chr(i % 251) for i in range(1 << 20))
+        # Data in the first and last chunks, a hole in between
+        with open(self.image, 'w') as f:
+            f.write(self.data)
+            f.seek((8 << 20) - 3)
+            f.write('end')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_compress(self):
+        comp = ImageCompressor(self.image, compressor.IMAGE_FORMAT_GZ,
+                               workers=3, chunk_size=1 << 20)
+        comp.run()
+        self.assertEqual(comp.output, self.image + '.gz')
+        self.assertEqual(comp.bytes_in, 8 << 20)
+        self.assertEqual(comp.bytes_out, os.path.getsize(comp.output))
+        self.assertEqual(comp.hole_chunks, 6)
+        # The concatenated chunks decompress as one
+        output = subprocess.check_output(['gzip', '-dc', comp.output])
+        with open(self.image) as f:
+            self.assertEqual(output, f.read())
+        self.assertTrue(os.path.isfile(self.image))
+        self.assertFalse(os.path.exists(comp.output + '.part'))
+
+    def test_checksum(self):
+        comp = ImageCompressor(self.image, compressor.IMAGE_FORMAT_GZ)
+        comp.run()
+        with open(comp.output) as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        with open(comp.checksum_file) as f:
+            self.assertEqual(f.read(), '%s  sd.img.gz\n' % digest)
+
+    def test_errors(self):
+        self.assertRaises(CompressorError, ImageCompressor, self.image,
+                          compressor.IMAGE_FORMAT_RAW)
+        comp = ImageCompressor(os.path.join(self.tmp, 'none.img'),
+                               compressor.IMAGE_FORMAT_GZ)
+        self.assertRaises(CompressorError, comp.run)
+
+    def test_compressed_name(self):
+        self.assertEqual(compressor.compressed_name('sd.img', 'zstd'),
+                         'sd.img.zst')
+        self.assertEqual(compressor.compressed_name('sd.img', 'raw'),
+                         'sd.img')
+
+if __name__ == '__main__':
+    unittest.main()
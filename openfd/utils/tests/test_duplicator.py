@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# ==========================================================================
+#
+# Copyright (C) 2013-2014 RidgeRun, LLC (http://www.ridgerun.com)
+#
+# Author: Jose Pablo Carballo <jose.carballo@ridgerun.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# Tests for the image duplicator.
+#
+# ==========================================================================
+
+import os, sys
+import time
+import shutil
+import tempfile
+import unittest
+import threading
+
+sys.path.insert(1, os.path.abspath('..'))
+
+import duplicator
+from duplicator import Duplicator
+from duplicator import DuplicatorError
+
+class DuplicatorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.image = os.path.join(self.tmp, 'sd.img')
+        self.data = ''.join(chr(i % 251) for i in range(3 << 20))
+        with open(self.image, 'w') as f:
+            f.write(self.data)
+            f.seek(16 << 20)
+            f.write('end')
+        self.targets = []
+        for i in range(3):
+            target = os.path.join(self.tmp, 'card%s.img' % i)
+            with open(target, 'w') as f:
+                f.write('x' * (4 << 20))
+            self.targets.append(target)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def read(self, target, offset, length):
+        with open(target) as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def test_duplicate(self):
+        dup = Duplicator(self.image, self.targets)
+        dup.run()
+        for target in dup.targets:
+            self.assertTrue(target.ok, target.error)
+        for target in self.targets:
+            self.assertEqual(self.read(target, 0, len(self.data)), self.data)
+            self.assertEqual(self.read(target, 16 << 20, 3), 'end')
+        self.assertEqual(dup.bytes_read, dup.bytes_total)
+
+    def test_ranges(self):
+        dup = Duplicator(self.image, self.targets[:2],
+                         ranges=[(1 << 20, 4096)])
+        dup.run()
+        self.assertEqual(dup.bytes_total, 4096)
+        for target in self.targets[:2]:
+            self.assertEqual(self.read(target, 0, 4096), 'x' * 4096)
+            self.assertEqual(self.read(target, 1 << 20, 4096),
+                             self.data[1 << 20:(1 << 20) + 4096])
+
+    def test_failed_target(self):
+        missing = os.path.join(self.tmp, 'none', 'card.img')
+        dup = Duplicator(self.image, [self.targets[0], missing,
+                                      self.targets[1]])
+        dup.run()
+        self.assertEqual([t.ok for t in dup.targets], [True, False, True])
+        self.assertTrue('Unable to open' in dup.targets[1].error)
+        self.assertEqual(self.read(self.targets[1], 0, len(self.data)),
+                         self.data)
+
+    def run_bounded(self, dup, timeout=20):
+        thread = threading.Thread(target=dup.run)
+        thread.daemon = True
+        thread.start()
+        thread.join(timeout)
+        self.assertFalse(thread.is_alive(), 'The duplication hangs')
+
+    def test_failed_write(self):
+        # /dev/full fails every write with ENOSPC
+        dup = Duplicator(self.image, [self.targets[0], '/dev/full',
+                                      self.targets[1]], direct=False)
+        self.run_bounded(dup)
+        self.assertEqual([t.ok for t in dup.targets], [True, False, True])
+        self.assertTrue('No space' in dup.targets[1].error)
+        for target in [self.targets[0], self.targets[1]]:
+            self.assertEqual(self.read(target, 0, len(self.data)), self.data)
+
+    def run_with_delays(self, delays, **kwargs):
+        # Runs a duplication into the targets; the writes into each one are
+        # delayed by the given seconds per buffer, or blocked if None
+        release = threading.Event()
+        class SlowWriter(duplicator.rawwriter.RawWriter):
+            def write_data(self, data, offset):
+                delay = delays.get(self._target, 0)
+                if delay is None:
+                    release.wait()
+                elif delay:
+                    time.sleep(delay)
+                super(SlowWriter, self).write_data(data, offset)
+        saved = (duplicator.rawwriter.RawWriter, duplicator.BUFFER_SIZE,
+                 duplicator.QUEUE_BUFFERS, duplicator.SLOW_WINDOW)
+        duplicator.rawwriter.RawWriter = SlowWriter
+        duplicator.BUFFER_SIZE = 64 << 10
+        duplicator.QUEUE_BUFFERS = 2
+        duplicator.SLOW_WINDOW = 0.5
+        try:
+            dup = Duplicator(self.image, sorted(delays), direct=False,
+                             **kwargs)
+            self.run_bounded(dup)
+        finally:
+            (duplicator.rawwriter.RawWriter, duplicator.BUFFER_SIZE,
+             duplicator.QUEUE_BUFFERS, duplicator.SLOW_WINDOW) = saved
+            release.set()
+        return dup
+
+    def test_slightly_slower_target(self):
+        # Writes slower than the queue wait, and 25% slower than the other
+        # device: both are written
+        dup = self.run_with_delays({self.targets[0]: 0.12,
+                                    self.targets[1]: 0.15},
+                                   ranges=[(0, 12 << 16)])
+        for target in dup.targets:
+            self.assertTrue(target.ok, target.error)
+        for target in self.targets[:2]:
+            self.assertEqual(self.read(target, 0, 12 << 16),
+                             self.data[:12 << 16])
+
+    def test_slow_target(self):
+        # A device that blocks is dropped for its speed, without holding up
+        # the other device until the stall timeout
+        dup = self.run_with_delays({self.targets[0]: 0,
+                                    self.targets[1]: None})
+        self.assertTrue(dup.targets[0].ok, dup.targets[0].error)
+        self.assertTrue('slower' in dup.targets[1].error,
+                        dup.targets[1].error)
+        self.assertEqual(self.read(self.targets[0], 0, len(self.data)),
+                         self.data)
+
+    def test_stalled_target(self):
+        dup = self.run_with_delays({self.targets[0]: None}, stall_timeout=1)
+        self.assertTrue('stalled' in dup.targets[0].error)
+
+    def test_invalid_image(self):
+        dup = Duplicator(os.path.join(self.tmp, 'none.img'), self.targets)
+        self.assertRaises(DuplicatorError, dup.run)
+
+    def test_reports(self):
+        output = ('duplicator: progress 2048 of 4096 bytes in 1.000 s\n'
+                  'duplicator: /dev/sdb 4096 bytes in 1.500 s\n'
+                  'duplicator: /dev/sdc failed after 1024 bytes in 0.500 s: '
+                  'Failed writing into /dev/sdc at 1024: [Errno 5] EIO\n')
+        lines = output.splitlines()
+        self.assertEqual(duplicator.parse_progress(lines[0]),
+                         (2048, 4096, 1.0))
+        self.assertEqual(duplicator.parse_progress(lines[1]), None)
+        self.assertEqual(duplicator.parse_report(output),
+            [('/dev/sdb', 4096, 1.5, ''),
+             ('/dev/sdc', 1024, 0.5,
+              'Failed writing into /dev/sdc at 1024: [Errno 5] EIO')])
+
+if __name__ == '__main__':
+    unittest.main()
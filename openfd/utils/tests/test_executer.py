@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# ==========================================================================
+#
+# Copyright (C) 2013-2014 RidgeRun, LLC (http://www.ridgerun.com)
+#
+# Author: Jose Pablo Carballo <jose.carballo@ridgerun.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# Tests for the concurrent execution of commands of the Executer.
+#
+# ==========================================================================
+
+import os, sys
+import time
+import unittest
+
+sys.path.insert(1, os.path.abspath('..'))
+
+from executer import Executer
+
+class ExecuterTestCase(unittest.TestCase):
+
+    def testCheckCallManyOrder(self):
+        e = Executer(enable_colors=False)
+        retcodes = e.check_call_many(['sleep 0.2; false', 'true', 'exit 3'])
+        self.assertEqual(retcodes, [1, 0, 3])
+
+    def testCheckCallManyConcurrent(self):
+        e = Executer(enable_colors=False)
+        start = time.time()
+        e.check_call_many(['sleep 0.3'] * 4, max_workers=4)
+        self.assertTrue(time.time() - start < 0.9)
+
+    def testCheckCallManyBounded(self):
+        e = Executer(enable_colors=False)
+        start = time.time()
+        e.check_call_many(['sleep 0.2'] * 4, max_workers=2)
+        self.assertTrue(time.time() - start >= 0.4)
+
+    def testCheckCallManyDryrun(self):
+        e = Executer(dryrun=True, enable_colors=False)
+        self.assertEqual(e.check_call_many(['false', 'false']), [0, 0])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# ==========================================================================
+#
+# Copyright (C) 2013-2014 RidgeRun, LLC (http://www.ridgerun.com)
+#
+# Author: Jose Pablo Carballo <jose.carballo@ridgerun.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# Tests for the device information probe (requires root, uses a loop device).
+#
+# ==========================================================================
+
+import os, sys
+import subprocess
+import tempfile
+import unittest
+
+sys.path.insert(1, os.path.abspath('..'))
+
+import probe
+from probe import ProbeError
+
+IMAGE_SIZE = 64 << 20
+
+class DeviceInfoTestCase(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.image = tempfile.mkstemp(suffix='.img')
+        os.ftruncate(fd, IMAGE_SIZE)
+        os.close(fd)
+        self.loop = subprocess.check_output(['losetup', '-f', '--show',
+                                             self.image]).strip()
+
+    def tearDown(self):
+        subprocess.call(['losetup', '-d', self.loop])
+        os.remove(self.image)
+
+    def testDeviceInfo(self):
+        info = probe.device_info(self.loop)
+        self.assertEqual(info['size_b'], IMAGE_SIZE)
+        self.assertEqual(info['logical_sector_size'], 512)
+        self.assertTrue(info['physical_sector_size'] >= 512)
+        self.assertFalse(info['removable'])
+
+    def testDeviceInfoSysfs(self):
+        # Without permissions on the device node the info comes from sysfs
+        pid = os.fork()
+        if pid == 0:
+            os.setuid(65534)
+            info = probe.device_info(self.loop)
+            os._exit(0 if info['size_b'] == IMAGE_SIZE else 1)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+
+    def testBlockDevices(self):
+        self.assertTrue(self.loop in probe.block_devices())
+        self.assertEqual(probe.device_vendor(self.loop), '')
+        self.assertEqual(probe.device_model(self.loop), '')
+
+    def testDeviceInfoMissing(self):
+        self.assertRaises(ProbeError, probe.device_info, '/dev/openfd-none')
+
+if __name__ == '__main__':
+    if os.geteuid() != 0:
+        print 'Loop devices require root, skipping'
+        sys.exit(0)
+    unittest.main()
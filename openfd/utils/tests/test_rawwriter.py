@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# ==========================================================================
+#
+# Copyright (C) 2013-2014 RidgeRun, LLC (http://www.ridgerun.com)
+#
+# Author: Jose Pablo Carballo <jose.carballo@ridgerun.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# Tests for the rawwriter module.
+#
+# ==========================================================================
+
+import os, sys
+import io
+import tempfile
+import unittest
+
+sys.path.insert(1, os.path.abspath('..'))
+
+import rawwriter
+from rawwriter import RawWriter
+
+class RawWriterTestCase(unittest.TestCase):
+    
+    def setUp(self):
+        fd, self.src = tempfile.mkstemp()
+        self.data = os.urandom(3 * rawwriter.DIRECT_ALIGN + 100)
+        os.write(fd, self.data)
+        os.close(fd)
+        fd, self.dst = tempfile.mkstemp()
+        os.write(fd, '\xff' * (1 << 16))
+        os.close(fd)
+    
+    def tearDown(self):
+        os.remove(self.src)
+        os.remove(self.dst)
+    
+    def _read_dst(self):
+        with open(self.dst, 'rb') as f:
+            return f.read()
+    
+    def test_write_file(self):
+        for direct in [False, True]:
+            writer = RawWriter(self.dst, direct=direct)
+            writer.write_file(self.src, offset=1024, skip=10)
+            writer.close()
+            dst = self._read_dst()
+            self.assertEqual(len(dst), 1 << 16)
+            self.assertEqual(dst[:1024], '\xff' * 1024)
+            self.assertEqual(dst[1024:1024 + len(self.data) - 10],
+                             self.data[10:])
+            self.assertEqual(writer.bytes_written, len(self.data) - 10)
+    
+    def test_write_zeros(self):
+        writer = RawWriter(self.dst, direct=True)
+        writer.write_zeros(512, 5000)
+        writer.close()
+        dst = self._read_dst()
+        self.assertEqual(dst[:512], '\xff' * 512)
+        self.assertEqual(dst[512:5512], '\x00' * 5000)
+        self.assertEqual(dst[5512:5513], '\xff')
+    
+    def test_wipe(self):
+        for method in [rawwriter.WIPE_AUTO, rawwriter.WIPE_ZEROS]:
+            writer = RawWriter(self.dst)
+            used = writer.wipe(8192, 16384, method)
+            writer.close()
+            self.assertTrue(used in [rawwriter.WIPE_PUNCH,
+                                     rawwriter.WIPE_ZEROS])
+            dst = self._read_dst()
+            self.assertEqual(len(dst), 1 << 16)
+            self.assertEqual(dst[8191:8192], '\xff')
+            self.assertEqual(dst[8192:24576], '\x00' * 16384)
+            self.assertEqual(dst[24576:24577], '\xff')
+    
+    def test_write_stream(self):
+        block = rawwriter.ZERO_BLOCK_SIZE
+        stream = ('\x00' * block + 'a' * 100 + '\x00' * (block - 100) +
+                  'b' * 10)
+        for direct in [False, True]:
+            with open(self.dst, 'wb') as f:
+                f.write('\xff' * (4 * block))
+            writer = RawWriter(self.dst, direct=direct)
+            size_b, read_secs, write_secs, skipped = writer.write_stream(
+                io.BytesIO(stream), skip_zeros=True)
+            writer.close()
+            self.assertEqual((size_b, skipped), (len(stream), block))
+            dst = self._read_dst()
+            # The zero block is skipped, the target keeps its data
+            self.assertEqual(dst[:block], '\xff' * block)
+            self.assertEqual(dst[block:len(stream)], stream[block:])
+            self.assertEqual(writer.bytes_written, len(stream) - block)
+
+    def test_write_stream_ranges(self):
+        writer = RawWriter(self.dst)
+        writer.write_stream(io.BytesIO('x' * 8192), ranges=[(100, 10),
+                                                             (4096, 20)])
+        writer.close()
+        dst = self._read_dst()
+        self.assertEqual(dst[:110], '\xff' * 100 + 'x' * 10)
+        self.assertEqual(dst[110:4096], '\xff' * 3986)
+        self.assertEqual(dst[4096:4117], 'x' * 20 + '\xff')
+
+    def test_compare(self):
+        block = rawwriter.COMPARE_BLOCK_SIZE
+        old = 'a' * (3 * block)
+        # Only the block that differs is written
+        data = old[:block + 10] + 'b' + old[block + 11:]
+        for direct in [False, True]:
+            with open(self.dst, 'wb') as f:
+                f.write(old)
+            writer = RawWriter(self.dst, direct=direct, compare=True)
+            writer.write_data(data, 0)
+            writer.close()
+            self.assertEqual(self._read_dst(), data)
+            self.assertEqual(writer.bytes_written, block)
+            compared, read_secs, identical, write_secs = writer.compare_stats
+            self.assertEqual((compared, identical), (3 * block, 2 * block))
+            # Written already, nothing differs now
+            writer = RawWriter(self.dst, direct=direct, compare=True)
+            writer.write_data(data, 0)
+            writer.close()
+            self.assertEqual(writer.bytes_written, 0)
+        self.assertEqual(RawWriter(self.dst).compare_stats, None)
+
+    def test_wipe_unsupported(self):
+        # Block device ioctls on a regular file
+        writer = RawWriter(self.dst)
+        self.assertRaises(rawwriter.RawWriterError, writer.wipe, 0, 4096,
+                          rawwriter.WIPE_DISCARD)
+        writer.close()
+    
+    def test_dd_size(self):
+        self.assertEqual(rawwriter.dd_size('512'), 512)
+        self.assertEqual(rawwriter.dd_size('1K'), 1024)
+        self.assertEqual(rawwriter.dd_size('2M'), 2 << 20)
+        self.assertEqual(rawwriter.dd_size('1kB'), 1000)
+        self.assertRaises(ValueError, rawwriter.dd_size, 'x')
+    
+    def test_report(self):
+        output = 'rawwriter: 358400 bytes in 0.041 s\n'
+        self.assertEqual(rawwriter.parse_report(output), (358400, 0.041, ''))
+        output = 'rawwriter: 4096 bytes in 0.001 s wiped with punch\n'
+        self.assertEqual(rawwriter.parse_report(output),
+                         (4096, 0.001, 'punch'))
+        self.assertEqual(rawwriter.parse_report('error'), None)
+        output += ('rawwriter: stream 8192 bytes read in 0.500 s, written in '
+                   '0.250 s, 4096 zero bytes skipped\n')
+        self.assertEqual(rawwriter.parse_stream_report(output),
+                         (8192, 0.5, 0.25, 4096))
+        self.assertEqual(rawwriter.parse_stream_report('error'), None)
+        output += ('rawwriter: compare 8192 bytes read in 0.100 s, 4096 '
+                   'identical bytes skipped, written in 0.200 s\n')
+        self.assertEqual(rawwriter.parse_compare_report(output),
+                         (8192, 0.1, 4096, 0.2))
+        self.assertEqual(rawwriter.parse_compare_report('error'), None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# ==========================================================================
+#
+# Copyright (C) 2013-2014 RidgeRun, LLC (http://www.ridgerun.com)
+#
+# Author: Jose Pablo Carballo <jose.carballo@ridgerun.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# Tests for the session module (record/replay of the Executer).
+#
+# ==========================================================================
+
+import os, sys
+import imp
+import time
+import logging
+import tempfile
+import unittest
+
+sys.path.insert(1, os.path.abspath('..'))
+
+import openfd.utils as utils
+from executer import Executer
+from session import SessionError
+from probe import ProbeError
+
+def _probe_size(device):
+    if device == '/dev/none':
+        raise ProbeError('Unable to obtain the size for %s' % device)
+    return 4 << 30
+
+class SessionTestCase(unittest.TestCase):
+    
+    @classmethod
+    def setUpClass(cls):
+        logger = utils.logger.init_global_logger('Session')
+        logger.setLevel(logging.DEBUG)
+        streamhandler = logging.StreamHandler()
+        streamhandler.setFormatter(logging.Formatter('%(msg)s'))
+        streamhandler.setLevel(logging.DEBUG)
+        logger.addHandler(streamhandler)
+    
+    def setUp(self):
+        fd, self.session_file = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        e = Executer(enable_colors=False)
+        e.record_session()
+        e.check_output('echo openfd; sleep 0.2')
+        e.check_call('false')
+        e.call('true')
+        e.probe(_probe_size, '/dev/sdb')
+        try:
+            e.probe(_probe_size, '/dev/none')
+        except ProbeError:
+            pass
+        e.save_session(self.session_file)
+    
+    def tearDown(self):
+        if os.path.exists(self.session_file):
+            os.remove(self.session_file)
+    
+    def testReplay(self):
+        e = Executer(enable_colors=False)
+        e.replay_session(self.session_file, time_scale=0)
+        self.assertEqual(e.check_output('echo openfd; sleep 0.2'),
+                         (0, 'openfd\n'))
+        self.assertEqual(e.check_call('false'), 1)
+        self.assertEqual(e.call('true'), 0)
+        self.assertEqual(e.probe(_probe_size, '/dev/sdb'), 4 << 30)
+        self.assertRaises(ProbeError, e.probe, _probe_size, '/dev/none')
+        self.assertRaises(SessionError, e.check_call, 'ls')
+    
+    def testReplayTimings(self):
+        e = Executer(enable_colors=False)
+        e.replay_session(self.session_file, time_scale=1.0)
+        start = time.time()
+        e.check_output('echo openfd; sleep 0.2')
+        self.assertTrue(time.time() - start >= 0.2)
+    
+    def testDryrun(self):
+        e = Executer(dryrun=True, enable_colors=False)
+        e.replay_session(self.session_file, time_scale=0)
+        self.assertEqual(e.check_output('echo openfd; sleep 0.2'), (0, ''))
+
+    def testCleanExit(self):
+        # The session is saved on the program exit path, after the sudo
+        # worker is stopped
+        os.remove(self.session_file)
+        program = os.path.abspath(os.path.join('..', '..', 'openfd'))
+        # Without leaving an 'openfdc' next to the program
+        dont_write_bytecode = sys.dont_write_bytecode
+        sys.dont_write_bytecode = True
+        try:
+            main = imp.load_source('openfd_main', program)
+        finally:
+            sys.dont_write_bytecode = dont_write_bytecode
+        main._logger = utils.logger.get_global_logger()
+        main._session_filename = self.session_file
+        e = utils.executer.init_global_executer(enable_colors=False)
+        e.rootless = True
+        e.record_session()
+        e.call('true')
+        # Stopping the worker leaves the rootless mode alone
+        e.stop_sudo_worker()
+        self.assertTrue(e.rootless)
+        self.assertRaises(SystemExit, main._clean_exit, 0)
+        self.assertFalse(e.rootless)
+        self.assertTrue(os.path.isfile(self.session_file))
+        e = Executer(enable_colors=False)
+        e.replay_session(self.session_file, time_scale=0)
+        self.assertEqual(e.call('true'), 0)
+
+if __name__ == '__main__':
+    unittest.main()
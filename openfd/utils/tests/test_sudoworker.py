@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# ==========================================================================
+#
+# Copyright (C) 2013-2014 RidgeRun, LLC (http://www.ridgerun.com)
+#
+# Author: Jose Pablo Carballo <jose.carballo@ridgerun.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# Tests for the sudo worker protocol, served in-process without sudo.
+#
+# ==========================================================================
+
+import os, sys
+import json
+import time
+import signal
+import tempfile
+import threading
+import traceback
+import unittest
+
+sys.path.insert(1, os.path.abspath('..'))
+
+import sudoworker
+from sudoworker import SudoWorker
+
+class PipeProcess(object):
+    """Stands for the helper process, served in-process over a pipe pair."""
+
+    def __init__(self, stdin, stdout):
+        self.stdin = stdin
+        self.stdout = stdout
+        self.returncode = None
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self):
+        self.returncode = 0
+        return 0
+
+class SudoWorkerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        req_r, req_w = os.pipe()
+        resp_r, resp_w = os.pipe()
+        self.proc = PipeProcess(os.fdopen(req_w, 'w'), os.fdopen(resp_r))
+        self.worker = SudoWorker()
+        self.results = {}
+        self.error = None
+        self.saved = sys.stdin, sys.stdout, sys.stderr
+        self.sigint = signal.getsignal(signal.SIGINT)
+        self.call_output = tempfile.TemporaryFile()
+        # serve() talks over stdin/stdout and sets a signal handler, so it
+        # runs in the main thread and the client in another one
+        sys.stdin = os.fdopen(req_r)
+        sys.stdout = os.fdopen(resp_w, 'w')
+        sys.stderr = self.call_output
+
+    def tearDown(self):
+        sys.stdin.close()
+        sys.stdout.close()
+        sys.stdin, sys.stdout, sys.stderr = self.saved
+        signal.signal(signal.SIGINT, self.sigint)
+        # The responses ended, so does the client reader
+        if self.worker._reader:
+            while self.worker._reader.is_alive():
+                self.worker._reader.join(1)
+        self.proc.stdout.close()
+        self.call_output.close()
+
+    def serve(self, client):
+        def run_client():
+            try:
+                client()
+            except Exception:
+                self.error = traceback.format_exc()
+            finally:
+                # EOF on the requests ends serve()
+                self.worker.stop()
+        thread = threading.Thread(target=run_client)
+        thread.daemon = True
+        thread.start()
+        sudoworker.serve()
+        while thread.is_alive():
+            thread.join(1)
+        self.assertEqual(self.error, None, self.error)
+
+    def connect(self):
+        # What SudoWorker.start() does, over the pipes
+        self.results['ready'] = json.loads(self.proc.stdout.readline())
+        self.worker._proc = self.proc
+        self.worker._reader = threading.Thread(
+            target=self.worker._read_responses)
+        self.worker._reader.daemon = True
+        self.worker._reader.start()
+
+    def test_modes(self):
+        def client():
+            self.connect()
+            self.results['output'] = self.worker.run(
+                'echo out; echo err >&2; exit 3', sudoworker.MODE_OUTPUT)
+            self.results['quiet'] = self.worker.run(
+                'echo hidden; exit 2', sudoworker.MODE_QUIET)
+            self.results['call'] = self.worker.run(
+                'echo shown', sudoworker.MODE_CALL)
+        self.serve(client)
+        self.assertEqual(self.results['ready'],
+                         {'ready': True, 'pid': os.getpid()})
+        self.assertEqual(self.results['output'], (3, 'out\nerr\n'))
+        self.assertEqual(self.results['quiet'], (2, ''))
+        # MODE_CALL output goes to the terminal (stderr), not to the client
+        self.assertEqual(self.results['call'], (0, ''))
+        self.call_output.seek(0)
+        self.assertEqual(self.call_output.read(), 'shown\n')
+
+    def test_concurrent_requests(self):
+        def run(name, cmd):
+            start = time.time()
+            self.results[name] = (self.worker.run(cmd),
+                                  time.time() - start)
+        def client():
+            self.connect()
+            slow = threading.Thread(target=run,
+                                    args=('slow', 'sleep 0.5; echo slow'))
+            slow.start()
+            time.sleep(0.1)
+            run('fast', 'echo fast')
+            slow.join()
+        self.serve(client)
+        # Each response matched its request, the fast one didn't wait
+        self.assertEqual(self.results['slow'][0], (0, 'slow\n'))
+        self.assertEqual(self.results['fast'][0], (0, 'fast\n'))
+        self.assertTrue(self.results['fast'][1] < 0.4)
+
+    def test_errors(self):
+        def client():
+            self.connect()
+            # Malformed requests are skipped, the next ones still served
+            self.proc.stdin.write('not json\n')
+            self.proc.stdin.flush()
+            self.results['missing'] = self.worker.run('openfd-none-command')
+            self.results['after'] = self.worker.run('echo ok')
+        self.serve(client)
+        retcode, output = self.results['missing']
+        self.assertEqual(retcode, 127)
+        self.assertTrue('not found' in output)
+        self.assertEqual(self.results['after'], (0, 'ok\n'))
+
+    def test_shutdown(self):
+        def client():
+            self.connect()
+            self.results['before'] = self.worker.run('echo up')
+            self.worker.stop()
+            self.results['after'] = self.worker.run('echo down')
+        self.serve(client)
+        self.assertEqual(self.results['before'], (0, 'up\n'))
+        self.assertEqual(self.results['after'],
+                         (-1, 'The sudo worker is not running'))
+        self.assertFalse(self.worker.is_alive)
+
+    def test_helper_died(self):
+        # No serve(): the helper says it's ready, then dies with a request
+        # still pending
+        sys.stdout.write(json.dumps({'ready': True, 'pid': 0}) + '\n')
+        sys.stdout.flush()
+        self.connect()
+        def run():
+            self.results['pending'] = self.worker.run('sleep 10')
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        while not self.worker._pending:
+            time.sleep(0.01)
+        sys.stdout.close()
+        while thread.is_alive():
+            thread.join(1)
+        self.assertEqual(self.results['pending'],
+                         (-1, 'The sudo worker terminated unexpectedly'))
+
+if __name__ == '__main__':
+    unittest.main()
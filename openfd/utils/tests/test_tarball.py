@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# ==========================================================================
+#
+# Copyright (C) 2013-2014 RidgeRun, LLC (http://www.ridgerun.com)
+#
+# Author: Jose Pablo Carballo <jose.carballo@ridgerun.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# Tests for the rootfs tarball helpers.
+#
+# ==========================================================================
+
+import os, sys
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+sys.path.insert(1, os.path.abspath('..'))
+
+import tarball
+
+class TarballTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = os.environ.get('PATH', '')
+        self.bin = tempfile.mkdtemp()
+        os.environ['PATH'] = self.bin
+
+    def tearDown(self):
+        os.environ['PATH'] = self.path
+        shutil.rmtree(self.bin)
+
+    def install(self, program):
+        filename = os.path.join(self.bin, program)
+        with open(filename, 'w') as f:
+            f.write('#!/bin/sh\n')
+        os.chmod(filename, 0755)
+
+    def test_is_tarball(self):
+        for name in ['rootfs.tar', 'rootfs.tar.zst', 'rootfs.tgz',
+                     'rootfs.tar.xz', 'rootfs.tar.bz2']:
+            self.assertTrue(tarball.is_tarball(name))
+        self.assertFalse(tarball.is_tarball('rootfs'))
+        self.assertFalse(tarball.is_tarball('rootfs.zst'))
+
+    def test_is_compressed_image(self):
+        for name in ['sd.img.xz', 'sd.img.zst', 'sd.img.gz', 'sd.img.bz2']:
+            self.assertTrue(tarball.is_compressed_image(name))
+        self.assertFalse(tarball.is_compressed_image('sd.img'))
+        self.assertFalse(tarball.is_compressed_image('rootfs.tar.xz'))
+        self.assertEqual(tarball.uncompressed_name('sd.img.zst'), 'sd.img')
+        self.assertEqual(tarball.uncompressed_name('sd.img'), 'sd.img')
+
+    def test_decompress_cmd(self):
+        # The multi-threaded decompressors, when installed
+        self.assertEqual(tarball.decompress_cmd('r.tar.gz'), 'gzip -dc r.tar.gz')
+        self.install('pigz')
+        self.assertEqual(tarball.decompress_cmd('r.tar.gz'), 'pigz -dc r.tar.gz')
+        self.assertEqual(tarball.decompress_cmd('r.tar.xz'),
+                         'xz -dc -T0 r.tar.xz')
+        self.assertEqual(tarball.decompress_cmd('sd.img.gz'),
+                         'pigz -dc sd.img.gz')
+
+    def test_extract_cmd(self):
+        self.install('zstd')
+        self.assertEqual(tarball.extract_cmd('r.tar.zst', '/media/rootfs'),
+                         "bash -o pipefail -c 'zstd -dc r.tar.zst | sudo tar "
+                         "-x -p --numeric-owner --xattrs --xattrs-include=\"*\" "
+                         "-f - -C /media/rootfs'")
+
+    def test_extract_cmd_fails(self):
+        # A decompressor that fails fails the whole pipeline
+        os.environ['PATH'] = self.path
+        tmp = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmp, 'r.tar.gz')
+            with open(filename, 'w') as f:
+                f.write('not gzip')
+            cmd = tarball.extract_cmd(filename, tmp).replace('sudo ', '')
+            with open(os.devnull, 'w') as null:
+                self.assertNotEqual(subprocess.call(cmd, shell=True,
+                                                    stderr=null), 0)
+        finally:
+            shutil.rmtree(tmp)
+
+if __name__ == '__main__':
+    unittest.main()
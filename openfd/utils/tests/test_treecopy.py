@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# ==========================================================================
+#
+# Copyright (C) 2013-2014 RidgeRun, LLC (http://www.ridgerun.com)
+#
+# Author: Jose Pablo Carballo <jose.carballo@ridgerun.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# Tests for the directory tree copy engine.
+#
+# ==========================================================================
+
+import os, sys
+import stat
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(1, os.path.abspath('..'))
+
+import treecopy
+from treecopy import TreeCopier
+from treecopy import TreeCopyError
+
+class TreeCopyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp, 'src')
+        self.dst = os.path.join(self.tmp, 'dst')
+        os.makedirs(os.path.join(self.src, 'etc', 'init.d'))
+        os.makedirs(os.path.join(self.src, 'bin'))
+        with open(os.path.join(self.src, 'etc', 'hostname'), 'w') as f:
+            f.write('board\n')
+        with open(os.path.join(self.src, 'bin', 'busybox'), 'w') as f:
+            f.write('B' * 200000)
+        os.chmod(os.path.join(self.src, 'bin', 'busybox'), 04755)
+        os.link(os.path.join(self.src, 'bin', 'busybox'),
+                os.path.join(self.src, 'bin', 'ls'))
+        os.symlink('busybox', os.path.join(self.src, 'bin', 'sh'))
+        os.symlink('etc/init.d', os.path.join(self.src, 'init'))
+        os.mkfifo(os.path.join(self.src, 'etc', 'fifo'))
+        with open(os.path.join(self.src, 'sparse'), 'w') as f:
+            f.seek(8 << 20)
+            f.write('end')
+        os.chmod(os.path.join(self.src, 'etc', 'init.d'), 0750)
+        os.utime(os.path.join(self.src, 'etc'), (1000000000, 1000000000))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_copy(self):
+        copier = TreeCopier(self.src, self.dst, workers=4)
+        copier.copy()
+        self.assertEqual(copier.errors, [])
+        dst = lambda *p: os.path.join(self.dst, *p)
+        with open(dst('etc', 'hostname')) as f:
+            self.assertEqual(f.read(), 'board\n')
+        busybox = os.stat(dst('bin', 'busybox'))
+        self.assertEqual(stat.S_IMODE(busybox.st_mode), 04755)
+        self.assertEqual(busybox.st_size, 200000)
+        # Hard link, not a second copy
+        self.assertEqual(os.stat(dst('bin', 'ls')).st_ino, busybox.st_ino)
+        self.assertEqual(os.readlink(dst('bin', 'sh')), 'busybox')
+        self.assertEqual(os.readlink(dst('init')), 'etc/init.d')
+        self.assertTrue(stat.S_ISFIFO(os.lstat(dst('etc', 'fifo')).st_mode))
+        self.assertEqual(stat.S_IMODE(os.stat(dst('etc', 'init.d')).st_mode),
+                         0750)
+        self.assertEqual(os.stat(dst('etc')).st_mtime, 1000000000)
+        sparse = os.stat(dst('sparse'))
+        self.assertEqual(sparse.st_size, (8 << 20) + 3)
+        self.assertTrue(sparse.st_blocks * 512 < 1 << 20)
+        self.assertEqual(copier.bytes_copied, 200000 + 6 + (8 << 20) + 3)
+
+    def test_copy_into_existing(self):
+        os.makedirs(os.path.join(self.dst, 'etc'))
+        with open(os.path.join(self.dst, 'etc', 'hostname'), 'w') as f:
+            f.write('previous contents\n')
+        TreeCopier(self.src, self.dst).copy()
+        with open(os.path.join(self.dst, 'etc', 'hostname')) as f:
+            self.assertEqual(f.read(), 'board\n')
+
+    def test_sync(self):
+        TreeCopier(self.src, self.dst).copy()
+        dst = lambda *p: os.path.join(self.dst, *p)
+        os.makedirs(dst('lost+found'))
+        os.makedirs(dst('var', 'stale'))
+        with open(dst('old'), 'w') as f:
+            f.write('stale\n')
+        # Rebuilt with the same contents, new times
+        os.utime(os.path.join(self.src, 'bin', 'busybox'), (1, 1))
+        with open(os.path.join(self.src, 'etc', 'hostname'), 'w') as f:
+            f.write('other\n')
+        os.utime(os.path.join(self.src, 'etc', 'hostname'), (2, 2))
+        copier = TreeCopier(self.src, self.dst, sync=True)
+        copier.copy()
+        self.assertEqual(copier.errors, [])
+        with open(dst('etc', 'hostname')) as f:
+            self.assertEqual(f.read(), 'other\n')
+        self.assertEqual(copier.bytes_copied, 6)
+        self.assertEqual(os.stat(dst('bin', 'busybox')).st_mtime, 1)
+        self.assertEqual(os.stat(dst('bin', 'ls')).st_ino,
+                         os.stat(dst('bin', 'busybox')).st_ino)
+        self.assertFalse(os.path.lexists(dst('old')))
+        self.assertFalse(os.path.lexists(dst('var')))
+        self.assertTrue(os.path.isdir(dst('lost+found')))
+        self.assertEqual(copier.files_removed, 2)
+        self.assertTrue(copier.files_unchanged > 0)
+
+    def test_invalid_source(self):
+        copier = TreeCopier(os.path.join(self.tmp, 'none'), self.dst)
+        self.assertRaises(TreeCopyError, copier.copy)
+
+    def test_reports(self):
+        output = ('treecopy: progress 10 files 2048 bytes in 1.000 s\n'
+                  'treecopy: 20 files 4096 bytes in 1.500 s\n')
+        self.assertEqual(treecopy.parse_progress(output.splitlines()[0]),
+                         (10, 2048, 1.0))
+        self.assertEqual(treecopy.parse_progress(output.splitlines()[1]),
+                         None)
+        self.assertEqual(treecopy.parse_report(output), (20, 4096, 1.5))
+        self.assertEqual(treecopy.parse_sync_report(output), None)
+        output += 'treecopy: 2 files 6 bytes in 0.100 s, 30 unchanged, 1 removed'
+        self.assertEqual(treecopy.parse_sync_report(output), (30, 1))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# ==========================================================================
+#
+# Copyright (C) 2013-2014 RidgeRun, LLC (http://www.ridgerun.com)
+#
+# Author: Jose Pablo Carballo <jose.carballo@ridgerun.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# The Tracer module records timed spans of the installer's activity.
+#
+# ==========================================================================
+
+"""
+The tracer module records spans (a name, a start time and a duration) for
+system commands, U-Boot interactions, transfers and installer phases. Spans
+are exported in the Chrome trace-event format, which can be opened with
+`chrome://tracing` or https://ui.perfetto.dev.
+
+Usage:
+::
+    with utils.trace_span('tftp', 'transfer', file=filename) as span:
+        ...
+        span.args['bytes'] = size_b
+"""
+
+# ==========================================================================
+# Imports
+# ==========================================================================
+
+import os
+import time
+import json
+import threading
+
+# ==========================================================================
+# Globals
+# ==========================================================================
+
+_tracer = None
+
+# ==========================================================================
+# Functions
+# ==========================================================================
+
+def init_global_tracer(enabled=False):
+    """
+    Inits the global `Tracer` instance.
+
+    :param enabled: Enable recording of spans.
+    :returns: The global tracer instance.
+    """
+
+    global _tracer
+    if not _tracer:
+        _tracer = Tracer(enabled=enabled)
+    return _tracer
+
+def get_global_tracer():
+    """
+    Returns the global `Tracer` instance.
+
+    :returns: The global tracer instance.
+    """
+
+    return _tracer
+
+def trace_span(name, category='', **args):
+    """
+    Returns a span in the global tracer, to be used in a `with` statement. If
+    the global tracer is not initialized or disabled the span is not recorded.
+
+    :param name: Span name.
+    :param category: Span category, i.e. 'cmd', 'uboot', 'phase'.
+    :param args: Additional information for the span.
+    """
+
+    if _tracer:
+        return _tracer.span(name, category, **args)
+    return Span(None, name, category, args)
+
+# ==========================================================================
+# Public classes
+# ==========================================================================
+
+class Span(object):
+    """
+    A timed span. Extra information (i.e. the number of bytes moved) can be
+    attached to :attr:`args` while the span is open.
+    """
+
+    def __init__(self, tracer, name, category, args):
+        self._tracer = tracer
+        self._start = 0
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self._start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type:
+            self.args['error'] = str(exc_value) or exc_type.__name__
+        if self._tracer:
+            self._tracer.add_span(self, self._start, time.time())
+        return False
+
+class Tracer(object):
+    """
+    Class to record spans and export them in the Chrome trace-event format.
+    """
+
+    def __init__(self, enabled=False):
+        """
+        :param enabled: Enable recording of spans.
+        :type enabled: boolean
+        """
+
+        self._enabled = enabled
+        self._lock = threading.Lock()
+        self._events = []
+
+    def __set_enabled(self, enabled):
+        self._enabled = enabled
+
+    def __get_enabled(self):
+        return self._enabled
+
+    enabled = property(__get_enabled, __set_enabled,
+                       doc="""Enable recording of spans.""")
+
+    def span(self, name, category='', **args):
+        """
+        Returns a span to be used in a `with` statement.
+
+        :param name: Span name.
+        :param category: Span category, i.e. 'cmd', 'uboot', 'phase'.
+        :param args: Additional information for the span.
+        """
+
+        return Span(self if self._enabled else None, name, category, args)
+
+    def add_span(self, span, start, end):
+        """
+        Records a finished span.
+
+        :param span: :class:`Span` instance.
+        :param start: Start time (seconds since the epoch).
+        :param end: End time (seconds since the epoch).
+        """
+
+        event = {'name': span.name,
+                 'cat': span.category,
+                 'ph': 'X',
+                 'ts': int(start * 1e6),
+                 'dur': int((end - start) * 1e6),
+                 'pid': os.getpid(),
+                 'tid': threading.current_thread().ident,
+                 'args': span.args}
+        with self._lock:
+            self._events.append(event)
+
+    def write(self, filename):
+        """
+        Writes the recorded spans to a file in the Chrome trace-event format.
+
+        :param filename: Output file.
+        :exception IOError: When unable to write the file.
+        """
+
+        with self._lock:
+            events = sorted(self._events, key=lambda e: e['ts'])
+        pid = os.getpid()
+        meta = [{'name': 'process_name', 'ph': 'M', 'pid': pid,
+                 'args': {'name': 'openfd'}}]
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': meta + events,
+                       'displayTimeUnit': 'ms'}, f)
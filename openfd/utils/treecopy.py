@@ -0,0 +1,576 @@
+#!/usr/bin/env python
+# ==========================================================================
+#
+# Copyright (C) 2013-2014 RidgeRun, LLC (http://www.ridgerun.com)
+#
+# Author: Jose Pablo Carballo <jose.carballo@ridgerun.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# Directory tree copy engine, used to install root filesystems.
+#
+# ==========================================================================
+
+"""
+The treecopy module copies a directory tree (i.e. a root filesystem) into
+another directory, replacing `find . | sudo cpio -pdum`:
+
+ * The tree is walked once; the files are copied by a pool of threads, so
+   the metadata operations of many small files overlap.
+ * The data is copied in the kernel (`copy_file_range(2)`), skipping the
+   holes of sparse files; the source files are dropped from the page cache
+   once copied.
+ * Hard links, symbolic links, device nodes, FIFOs, owners, permissions,
+   modification times and extended attributes are preserved. Owners are
+   only preserved when running as root, as cpio does.
+ * In sync mode the destination is updated in place, as `rsync --delete`:
+   the files with the same size and modification time (or, if the times
+   differ, the same contents) are not written again, and the entries not in
+   the source are removed.
+
+Writing into a mounted partition needs superuser access, so the engine is
+also a standalone program, executed through `sudo` (see
+:func:`copy_tree_cmd`). It prints its progress periodically and a final
+report:
+::
+    sudo python treecopy.py --src rootfs --dst /media/rootfs
+    treecopy: progress 5120 files 104857600 bytes in 1.000 s
+    treecopy: 20480 files 419430400 bytes in 3.912 s
+
+In sync mode the final report also counts the entries left unchanged and
+the ones removed:
+::
+    treecopy: 12 files 5242880 bytes in 1.204 s, 20468 unchanged, 3 removed
+
+Only the standard library (and :mod:`fileutils`, a sibling module) can be used
+here.
+"""
+
+# ==========================================================================
+# Imports
+# ==========================================================================
+
+import os
+import re
+import sys
+import stat
+import shutil
+import time
+import errno
+import Queue
+import argparse
+import threading
+import fileutils
+
+# Exported into openfd.utils, without the report parsers, which every
+# helper program has under the same names
+__all__ = ['TreeCopyError', 'TreeCopier', 'copy_tree_cmd', 'copy_file_cmd']
+
+# ==========================================================================
+# Constants
+# ==========================================================================
+
+#: Threads copying files.
+DEFAULT_WORKERS = 8
+
+#: Files of this size (bytes) or more are copied skipping their holes.
+SPARSE_MIN_SIZE = 64 << 10
+
+#: Seconds between progress reports.
+PROGRESS_INTERVAL = 1.0
+
+#: Prefix of the report lines.
+REPORT_PREFIX = 'treecopy:'
+
+#: Entries of the destination's top directory that sync mode never removes.
+SYNC_KEEP = ['lost+found']
+
+#: Chunk size (bytes) used to compare the contents of files.
+COMPARE_CHUNK_SIZE = 1 << 20
+
+# Pending files queued for the workers, bounds the memory used by the walk
+_QUEUE_SIZE = 4096
+
+# ==========================================================================
+# Public Classes
+# ==========================================================================
+
+class TreeCopyError(Exception):
+    """Tree copy exceptions."""
+
+class TreeCopier(object):
+    """Copies a directory tree, see :mod:`treecopy`."""
+
+    def __init__(self, src, dst, workers=DEFAULT_WORKERS, sync=False):
+        """
+        :param src: Source directory.
+        :param dst: Destination directory, created if needed.
+        :param workers: Threads copying files.
+        :param sync: Sync mode, only write the entries that changed and
+            remove the ones not in the source.
+        """
+
+        self._src = src
+        self._dst = dst
+        self._workers = max(workers, 1)
+        self._sync = sync
+        self._preserve_owner = os.geteuid() == 0
+        self._lock = threading.Lock()
+        self._files = 0
+        self._bytes = 0
+        self._unchanged = 0
+        self._removed = 0
+        self._start_time = None
+        self._errors = []
+        self._warnings = []
+
+    @property
+    def files_copied(self):
+        """Number of entries (files, directories, links...) copied."""
+
+        return self._files
+
+    @property
+    def bytes_copied(self):
+        """Bytes of file data copied."""
+
+        return self._bytes
+
+    @property
+    def files_unchanged(self):
+        """Number of entries left as they were (sync mode)."""
+
+        return self._unchanged
+
+    @property
+    def files_removed(self):
+        """Number of entries removed from the destination (sync mode)."""
+
+        return self._removed
+
+    @property
+    def elapsed(self):
+        """Seconds since the copy started."""
+
+        if self._start_time is None:
+            return 0.0
+        return time.time() - self._start_time
+
+    @property
+    def errors(self):
+        """List of errors (strings), the entries that couldn't be copied."""
+
+        return self._errors
+
+    @property
+    def warnings(self):
+        """List of warnings (strings), the entries skipped."""
+
+        return self._warnings
+
+    def _count(self, size_b=0):
+        with self._lock:
+            self._files += 1
+            self._bytes += size_b
+
+    def _count_unchanged(self):
+        with self._lock:
+            self._unchanged += 1
+
+    def _error(self, path, e):
+        with self._lock:
+            self._errors.append('%s: %s' % (path, e))
+
+    def _set_owner(self, dst, st, fd=None):
+        if not self._preserve_owner:
+            return
+        if fd is not None:
+            os.fchown(fd, st.st_uid, st.st_gid)
+        else:
+            os.lchown(dst, st.st_uid, st.st_gid)
+
+    def _remove(self, dst):
+        # Unconditional replace, like 'cpio -u'
+        if not os.path.lexists(dst):
+            return
+        if not os.path.isdir(dst) or os.path.islink(dst):
+            os.unlink(dst)
+        elif self._sync:
+            # A directory replaced by another type of entry
+            shutil.rmtree(dst)
+
+    def _lstat(self, dst):
+        try:
+            return os.lstat(dst)
+        except OSError:
+            return None
+
+    def _same_metadata(self, st, dst_st):
+        if (st.st_mode != dst_st.st_mode or
+            int(st.st_mtime) != int(dst_st.st_mtime)):
+            return False
+        if self._preserve_owner:
+            return (st.st_uid, st.st_gid) == (dst_st.st_uid, dst_st.st_gid)
+        return True
+
+    def _same_data(self, src, dst, st, dst_st):
+        if not stat.S_ISREG(dst_st.st_mode) or st.st_size != dst_st.st_size:
+            return False
+        if int(st.st_mtime) == int(dst_st.st_mtime):
+            return True
+        # Rebuilt files get new times, compare their contents
+        with open(src, 'rb') as src_f:
+            with open(dst, 'rb') as dst_f:
+                while True:
+                    data = src_f.read(COMPARE_CHUNK_SIZE)
+                    if data != dst_f.read(COMPARE_CHUNK_SIZE):
+                        return False
+                    if not data:
+                        return True
+
+    def _set_metadata(self, src, dst, st):
+        # chown() clears the setuid bits and security.capability
+        self._set_owner(dst, st)
+        os.chmod(dst, stat.S_IMODE(st.st_mode))
+        fileutils.copy_xattrs(src, dst)
+        os.utime(dst, (st.st_atime, st.st_mtime))
+
+    def _copy_data(self, src_fd, dst_fd, size_b):
+        if size_b >= SPARSE_MIN_SIZE:
+            os.ftruncate(dst_fd, size_b)
+            for offset, length in fileutils.data_segments(src_fd, size_b):
+                fileutils.copy_range(src_fd, dst_fd, offset, offset, length)
+        else:
+            data = os.read(src_fd, size_b)
+            while data:
+                data = data[os.write(dst_fd, data):]
+
+    def _copy_file(self, src, dst, st):
+        if self._sync:
+            dst_st = self._lstat(dst)
+            if dst_st and self._same_data(src, dst, st, dst_st):
+                if not self._same_metadata(st, dst_st):
+                    self._set_metadata(src, dst, st)
+                self._count_unchanged()
+                return
+        self._remove(dst)
+        src_fd = os.open(src, os.O_RDONLY)
+        try:
+            dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                             0600)
+            try:
+                self._copy_data(src_fd, dst_fd, st.st_size)
+                # chown() clears the setuid bits, so before chmod()
+                self._set_owner(dst, st, dst_fd)
+                os.fchmod(dst_fd, stat.S_IMODE(st.st_mode))
+            finally:
+                os.close(dst_fd)
+            fileutils.drop_cache(src_fd)
+        finally:
+            os.close(src_fd)
+        # After chown(), which clears security.capability
+        fileutils.copy_xattrs(src, dst)
+        os.utime(dst, (st.st_atime, st.st_mtime))
+        self._count(st.st_size)
+
+    def _worker(self, pending):
+        while True:
+            item = pending.get()
+            if item is None:
+                return
+            src, dst, st = item
+            try:
+                self._copy_file(src, dst, st)
+            except (OSError, IOError) as e:
+                self._error(src, e)
+
+    def _same_special(self, src, dst, st):
+        dst_st = self._lstat(dst)
+        if not dst_st or stat.S_IFMT(st.st_mode) != stat.S_IFMT(dst_st.st_mode):
+            return False
+        if stat.S_ISLNK(st.st_mode):
+            return os.readlink(src) == os.readlink(dst)
+        return (st.st_rdev == dst_st.st_rdev and
+                self._same_metadata(st, dst_st))
+
+    def _copy_special(self, src, dst, st):
+        if self._sync and self._same_special(src, dst, st):
+            self._count_unchanged()
+            return
+        self._remove(dst)
+        if stat.S_ISLNK(st.st_mode):
+            os.symlink(os.readlink(src), dst)
+            self._set_owner(dst, st)
+        else:
+            try:
+                os.mknod(dst, st.st_mode, st.st_rdev)
+            except OSError as e:
+                if e.errno == errno.EPERM and not self._preserve_owner:
+                    # As cpio, device nodes need superuser access
+                    self._warnings.append('%s: skipped, %s' % (src, e))
+                    return
+                raise
+            self._set_owner(dst, st)
+            os.chmod(dst, stat.S_IMODE(st.st_mode))
+            os.utime(dst, (st.st_atime, st.st_mtime))
+        self._count()
+
+    def _make_dir(self, src, dst, st):
+        if os.path.isdir(dst) and not os.path.islink(dst):
+            if self._sync:
+                self._count_unchanged()
+                return
+        else:
+            self._remove(dst)
+            os.mkdir(dst, 0700)
+        self._count()
+
+    def _finish_dir(self, src, dst, st):
+        if self._sync and self._same_metadata(st, os.lstat(dst)):
+            return
+        self._set_metadata(src, dst, st)
+
+    def _remove_stale(self, dst_root, names):
+        keep = set(names)
+        if dst_root == os.path.normpath(self._dst):
+            keep.update(SYNC_KEEP)
+        for name in os.listdir(dst_root):
+            if name not in keep:
+                self._remove(os.path.join(dst_root, name))
+                with self._lock:
+                    self._removed += 1
+
+    def _walk(self, pending, dirs, links):
+        inodes = {}
+        def walk_error(e):
+            self._error(e.filename, e)
+        for root, dirnames, filenames in os.walk(self._src,
+                                                 onerror=walk_error):
+            rel = os.path.relpath(root, self._src)
+            dst_root = os.path.normpath(os.path.join(self._dst, rel))
+            try:
+                st = os.lstat(root)
+                self._make_dir(root, dst_root, st)
+            except OSError as e:
+                self._error(root, e)
+                del dirnames[:]
+                continue
+            dirs.append((root, dst_root, st))
+            if self._sync:
+                try:
+                    self._remove_stale(dst_root, dirnames + filenames)
+                except OSError as e:
+                    self._error(dst_root, e)
+            # os.walk() lists symbolic links to directories as directories
+            names = filenames + [d for d in dirnames
+                                 if os.path.islink(os.path.join(root, d))]
+            for name in sorted(names):
+                src = os.path.join(root, name)
+                dst = os.path.join(dst_root, name)
+                try:
+                    st = os.lstat(src)
+                    if stat.S_ISREG(st.st_mode):
+                        key = (st.st_dev, st.st_ino)
+                        if st.st_nlink > 1 and key in inodes:
+                            links.append((inodes[key], dst, src))
+                            continue
+                        inodes[key] = dst
+                        pending.put((src, dst, st))
+                    else:
+                        self._copy_special(src, dst, st)
+                except OSError as e:
+                    self._error(src, e)
+
+    def copy(self):
+        """
+        Copies the tree. The errors on single entries don't stop the copy,
+        see :attr:`errors`.
+
+        :exception TreeCopyError: When the source is not a directory.
+        """
+
+        if not os.path.isdir(self._src):
+            raise TreeCopyError('Not a directory: %s' % self._src)
+        self._start_time = time.time()
+        pending = Queue.Queue(_QUEUE_SIZE)
+        threads = [threading.Thread(target=self._worker, args=(pending,))
+                   for i in range(self._workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        dirs = []
+        links = []
+        try:
+            self._walk(pending, dirs, links)
+        finally:
+            for thread in threads:
+                pending.put(None)
+            for thread in threads:
+                # join() without a timeout can't be interrupted in Python 2
+                while thread.is_alive():
+                    thread.join(1)
+        # Hard links, once their targets are copied
+        for target, dst, src in links:
+            try:
+                if (self._sync and os.path.lexists(dst) and
+                    os.path.samefile(target, dst)):
+                    self._count_unchanged()
+                    continue
+                self._remove(dst)
+                os.link(target, dst)
+                self._count()
+            except OSError as e:
+                self._error(src, e)
+        # Children first, creating entries changes the directory times
+        for src, dst, st in reversed(dirs):
+            try:
+                self._finish_dir(src, dst, st)
+            except OSError as e:
+                self._error(src, e)
+
+# ==========================================================================
+# Functions
+# ==========================================================================
+
+def copy_tree_cmd(src, dst, workers=DEFAULT_WORKERS, sync=False):
+    """
+    Returns the command that runs this module as a program, through `sudo`,
+    to copy the given tree.
+
+    :param src: Source directory.
+    :param dst: Destination directory.
+    :param workers: Threads copying files.
+    :param sync: Sync mode, see :class:`TreeCopier`.
+    """
+
+    program = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+    cmd = ('sudo %s %s --src %s --dst %s --workers %s' %
+           (sys.executable, program, src, dst, workers))
+    if sync:
+        cmd += ' --sync'
+    return cmd
+
+def copy_file_cmd(src, dst, only_changed=False):
+    """
+    Returns the command that copies a single file (i.e. a kernel image)
+    through `sudo`.
+
+    :param src: Source file.
+    :param dst: Destination file or directory.
+    :param only_changed: Skip the copy when the destination already has the
+        same contents.
+    """
+
+    cmd = 'sudo cp %s %s' % (src, dst)
+    if only_changed:
+        target = dst
+        if os.path.isdir(dst):
+            target = os.path.join(dst, os.path.basename(src))
+        cmd = 'sudo cmp -s %s %s || %s' % (src, target, cmd)
+    return cmd
+
+def _parse_line(line):
+    fields = line.split()
+    if len(fields) >= 6 and fields[0] == REPORT_PREFIX:
+        progress = fields[1] == 'progress'
+        if progress:
+            fields = fields[1:]
+        try:
+            return progress, int(fields[1]), long(fields[3]), float(fields[6])
+        except (ValueError, IndexError):
+            return None
+    return None
+
+def parse_progress(line):
+    """
+    Parses a progress line printed by the copy program.
+
+    :param line: Output line of the program.
+    :returns: A tuple with the files copied, the bytes copied and the seconds
+        elapsed, or none if the line is not a progress report.
+    """
+
+    report = _parse_line(line)
+    if report and report[0]:
+        return report[1:]
+    return None
+
+def parse_report(output):
+    """
+    Parses the final report printed by the copy program.
+
+    :param output: Output of the program.
+    :returns: A tuple with the files copied, the bytes copied and the seconds
+        taken, or none if there is no report.
+    """
+
+    for line in output.splitlines():
+        report = _parse_line(line)
+        if report and not report[0]:
+            return report[1:]
+    return None
+
+def parse_sync_report(output):
+    """
+    Parses the counters that the copy program adds to its final report in
+    sync mode.
+
+    :param output: Output of the program.
+    :returns: A tuple with the entries unchanged and the entries removed, or
+        none if there is no sync report.
+    """
+
+    for line in output.splitlines():
+        match = re.search(r', (\d+) unchanged, (\d+) removed$', line.strip())
+        if line.startswith(REPORT_PREFIX) and match:
+            return int(match.group(1)), int(match.group(2))
+    return None
+
+def _report(copier, progress=False, sync=False):
+    line = '%s %s files %s bytes in %.3f s' % (REPORT_PREFIX,
+            copier.files_copied, copier.bytes_copied, copier.elapsed)
+    if progress:
+        line = line.replace(REPORT_PREFIX, REPORT_PREFIX + ' progress', 1)
+    elif sync:
+        line += ', %s unchanged, %s removed' % (copier.files_unchanged,
+                                                 copier.files_removed)
+    sys.stdout.write(line + '\n')
+    sys.stdout.flush()
+
+def _main():
+    parser = argparse.ArgumentParser(description='Directory tree copy')
+    parser.add_argument('--src', required=True, help='Source directory')
+    parser.add_argument('--dst', required=True, help='Destination directory')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help='Threads copying files')
+    parser.add_argument('--sync', action='store_true', default=False,
+                        help='Only write the entries that changed, remove '
+                        'the ones not in the source')
+    args = parser.parse_args()
+    copier = TreeCopier(args.src, args.dst, args.workers, args.sync)
+    done = threading.Event()
+    def progress():
+        while not done.wait(PROGRESS_INTERVAL):
+            _report(copier, progress=True)
+    reporter = threading.Thread(target=progress)
+    reporter.daemon = True
+    reporter.start()
+    try:
+        copier.copy()
+    except TreeCopyError as e:
+        sys.stderr.write('%s %s\n' % (REPORT_PREFIX, e))
+        return 1
+    finally:
+        done.set()
+        reporter.join()
+    for warning in copier.warnings:
+        sys.stderr.write('%s %s\n' % (REPORT_PREFIX, warning))
+    for error in copier.errors:
+        sys.stderr.write('%s %s\n' % (REPORT_PREFIX, error))
+    _report(copier, sync=args.sync)
+    return 1 if copier.errors else 0
+
+if __name__ == '__main__':
+    sys.exit(_main())